@@ -0,0 +1,195 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from overlay_cache import DiskLRUCache, content_hash
+
+
+# Shared by the overlayer and LatentSync apps, so it lives outside either app's directory.
+DOWNLOAD_CACHE_DIR = Path(os.environ.get("DRIVE_DOWNLOAD_CACHE_DIR", Path.home() / ".cache" / "drive_downloads"))
+DOWNLOAD_CACHE_MAX_BYTES = 50 * 1024 ** 3
+# Optional Drive API key; with it the remote md5/size are known, otherwise HTTP headers are used.
+DRIVE_API_KEY = os.environ.get("GDRIVE_API_KEY")
+# A Drive ID whose remote checksum/size can't be learned is trusted for this long before re-downloading.
+UNVERIFIED_SOURCE_TTL_SECONDS = 12 * 3600
+# ioctl request that clones a file's extents (reflink) on btrfs/XFS/overlayfs.
+FICLONE = 0x40049409
+BLOB_NAME = "blob"
+
+
+def remote_identity(file_id, file_url):
+    """
+    What the remote side says about a Drive file's contents: {'md5', 'size'} from the Drive API when
+    GDRIVE_API_KEY is set, otherwise the ETag/Content-Length of a HEAD request. Empty if unknown.
+    """
+    try:
+        if DRIVE_API_KEY:
+            response = requests.get(f"https://www.googleapis.com/drive/v3/files/{file_id}",
+                                    params={'fields': 'md5Checksum,size', 'key': DRIVE_API_KEY}, timeout=30)
+            response.raise_for_status()
+            data = response.json()
+            return {'md5': data.get('md5Checksum'), 'size': data.get('size')}
+        response = requests.head(file_url, allow_redirects=True, timeout=30)
+        # Large Drive files answer with an HTML confirmation page, whose headers say nothing about the file.
+        if not response.ok or response.headers.get('Content-Type', '').startswith('text/html'):
+            return {}
+        identity = {'etag': response.headers.get('ETag'), 'size': response.headers.get('Content-Length')}
+        return {key: value for key, value in identity.items() if value}
+    except (requests.RequestException, ValueError):
+        return {}
+
+
+def place_file(source, destination):
+    """
+    Puts a copy of source at destination as cheaply as the filesystem allows: a reflink, else a
+    hardlink, else a plain copy. Returns which one was used.
+    """
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    # Built under a temporary name and renamed into place, so readers never see a partial file.
+    tmp_path = destination.with_name(f".{destination.name}.tmp{os.getpid()}_{threading.get_ident()}")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        try:
+            with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = 'reflink'
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            try:
+                os.link(source, tmp_path)
+                method = 'hardlink'
+            except OSError:
+                if not Path(source).exists():
+                    raise FileNotFoundError(source)
+                shutil.copyfile(source, tmp_path)
+                method = 'copy'
+        os.replace(tmp_path, destination)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return method
+
+
+class DownloadCache:
+    """
+    Content-addressed cache of downloaded Drive files, shared between processes.
+
+    Blobs are stored once per SHA-256 of their contents in a DiskLRUCache (size cap, LRU eviction).
+    A separate sources.json maps a Drive file ID plus its remote checksum/size to the blob, so a
+    repeat download of an unchanged file is a lookup, and two IDs with the same bytes share a blob.
+    Files are handed to the apps by reflink/hardlink, so the apps can still delete their own copies.
+    """
+
+    def __init__(self, cache_dir=DOWNLOAD_CACHE_DIR, max_bytes=DOWNLOAD_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.blobs = DiskLRUCache(self.cache_dir / "blobs", max_bytes, shared=True)
+        self.partial_dir = self.cache_dir / "partial"
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self._sources_path = self.cache_dir / "sources.json"
+        self._sources_lock_path = self.cache_dir / "sources.lock"
+        self._lock = threading.Lock()
+
+    def _update_sources(self, update):
+        """Runs update(sources) on the source map under an inter-process lock and saves it."""
+        with self._lock, open(self._sources_lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self._sources_path, "r", encoding="utf-8") as f:
+                    sources = json.load(f)
+            except (OSError, ValueError):
+                sources = {}
+            result = update(sources)
+            tmp_path = self._sources_path.with_suffix(f".tmp{os.getpid()}")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sources, f)
+            os.replace(tmp_path, self._sources_path)
+            return result
+
+    @staticmethod
+    def source_key(file_id, identity):
+        return ":".join([file_id] + [f"{key}={identity[key]}" for key in sorted(identity)])
+
+    def lookup(self, source_key, verified):
+        """Returns (blob_path, meta) for a known source, or (None, None)."""
+        def find(sources):
+            entry = sources.get(source_key)
+            if entry and not verified and time.time() - entry['stored'] > UNVERIFIED_SOURCE_TTL_SECONDS:
+                del sources[source_key]
+                return None
+            return entry
+        entry = self._update_sources(find)
+        if not entry:
+            return None, None
+        entry_dir, meta = self.blobs.get(entry['hash'])
+        if entry_dir is None:
+            return None, None
+        return entry_dir / BLOB_NAME, meta
+
+    def store(self, source_key, downloaded_path, name):
+        """Adds a finished download (deduplicated by content) and maps source_key to it. Returns the blob path."""
+        digest = content_hash(downloaded_path)
+        entry_dir, meta = self.blobs.get(digest)
+        if entry_dir is None:
+            meta = {'name': name, 'size': os.path.getsize(downloaded_path)}
+            entry_dir = self.blobs.put(digest, meta,
+                                       lambda tmp_dir: os.replace(downloaded_path, Path(tmp_dir) / BLOB_NAME))
+        else:
+            Path(downloaded_path).unlink(missing_ok=True)
+
+        def remember(sources):
+            sources[source_key] = {'hash': digest, 'stored': time.time()}
+        self._update_sources(remember)
+        return entry_dir / BLOB_NAME, meta
+
+    def fetch(self, file_id, file_url, destination, download):
+        """
+        Places Drive file file_id at destination (a file path, or an existing directory to keep the
+        remote file name), downloading it with download(file_url, partial_dir) -> downloaded_path only
+        on a cache miss. Returns (path, cache_hit).
+        """
+        identity = remote_identity(file_id, file_url)
+        source_key = self.source_key(file_id, identity)
+        blob_path, meta = self.lookup(source_key, verified=bool(identity))
+        cache_hit = blob_path is not None
+        if not cache_hit:
+            download_dir = self.partial_dir / f"{file_id}.{os.getpid()}_{threading.get_ident()}"
+            download_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                downloaded_path = download(file_url, download_dir)
+                if not downloaded_path or not Path(downloaded_path).exists() \
+                        or Path(downloaded_path).stat().st_size == 0:
+                    raise IOError(f"Download of Drive file {file_id} failed or is empty")
+                blob_path, meta = self.store(source_key, downloaded_path, Path(downloaded_path).name)
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+        destination = Path(destination)
+        if destination.is_dir():
+            destination = destination / meta['name']
+        try:
+            place_file(blob_path, destination)
+        except FileNotFoundError:
+            # Evicted by another process between the lookup and the hand-off.
+            if cache_hit:
+                self._update_sources(lambda sources: sources.pop(source_key, None))
+                return self.fetch(file_id, file_url, destination, download)
+            raise
+        return destination, cache_hit
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_download_cache():
+    """The process-wide DownloadCache."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = DownloadCache()
+        return _shared_cache
@@ -0,0 +1,108 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import gdown
+import requests
+
+from download_cache import get_download_cache
+
+
+# Per-file download URL; {file_id} is filled in. Point these at a local HTTP server to test without Drive.
+DRIVE_FILE_URL = os.environ.get("GDRIVE_FILE_URL", "https://drive.google.com/uc?id={file_id}")
+# When set, folders are listed from this URL ({folder_id} filled in), which must return a JSON list of
+# {"id": ..., "name": ...}; otherwise gdown lists the Drive folder page.
+DRIVE_FOLDER_LIST_URL = os.environ.get("GDRIVE_FOLDER_LIST_URL")
+# Concurrent file downloads per folder.
+DOWNLOAD_WORKERS = 4
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.webm', '.flv', '.wmv')
+
+
+def drive_file_id(file_url):
+    """The file ID in a Drive share link, or None."""
+    match = re.search(r'[-\w]{25,}(?=/|$|&|\?)', file_url or "")
+    return match.group(0) if match else None
+
+
+def drive_folder_id(folder_url):
+    match = re.search(r'folders/([-\w]+)', folder_url) or re.search(r'[-\w]{25,}', folder_url)
+    if match:
+        return match.group(match.lastindex or 0)
+    return folder_url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def list_drive_folder(folder_url):
+    """Returns [(file_id, relative_path)] for every file in a Drive folder (recursively), without downloading."""
+    if DRIVE_FOLDER_LIST_URL:
+        response = requests.get(DRIVE_FOLDER_LIST_URL.format(folder_id=drive_folder_id(folder_url)), timeout=60)
+        response.raise_for_status()
+        return [(entry['id'], entry['name']) for entry in response.json()]
+    files = gdown.download_folder(folder_url, quiet=True, use_cookies=True, remaining_ok=True, skip_download=True)
+    return [(entry.id, entry.path) for entry in files or []]
+
+
+class _NameAllocator:
+    """Hands out unique file names in one directory across download threads."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._taken = set()
+        self._lock = threading.Lock()
+
+    def allocate(self, filename):
+        stem, suffix = Path(filename).stem, Path(filename).suffix
+        with self._lock:
+            candidate, n = filename, 1
+            while candidate in self._taken or (self.directory / candidate).exists():
+                candidate = f"{stem}_{n}{suffix}"
+                n += 1
+            self._taken.add(candidate)
+            return self.directory / candidate
+
+
+def _gdown_into(file_url, directory):
+    return gdown.download(file_url, output=str(directory) + os.sep, quiet=True)
+
+
+def download_drive_file(file_id, destination):
+    """
+    Places one Drive file at destination (a file path, or a directory to keep the remote file name)
+    through the shared download cache: only a miss is downloaded, and the file is moved into place
+    atomically, so readers never see a half-written file. Returns the destination path.
+    """
+    path, _ = get_download_cache().fetch(file_id, DRIVE_FILE_URL.format(file_id=file_id), destination, _gdown_into)
+    return path
+
+
+def iter_folder_downloads(folder_url, destination_dir, max_workers=DOWNLOAD_WORKERS, extensions=VIDEO_EXTENSIONS,
+                          rename_suffix='.mp4', keep_tree=False):
+    """
+    Downloads the matching files of a Drive folder concurrently into destination_dir and yields
+    (path, error) for each file as soon as it has landed (path None on failure), in completion order.
+    extensions=None takes every file; rename_suffix (if any) replaces each file's extension, as the
+    overlayer expects; keep_tree recreates the folder's sub-directories instead of flattening them.
+    """
+    destination_dir = Path(destination_dir)
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    names = _NameAllocator(destination_dir)
+    entries = [(file_id, path) for file_id, path in list_drive_folder(folder_url)
+               if extensions is None or Path(path).suffix.lower() in extensions]
+    if not entries:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(entries)))) as executor:
+        futures = {}
+        for file_id, path in entries:
+            filename = Path(path).stem + (rename_suffix or Path(path).suffix)
+            if keep_tree:
+                destination = destination_dir / Path(path).with_name(filename)
+            else:
+                destination = names.allocate(filename)
+            futures[executor.submit(download_drive_file, file_id, destination)] = path
+        for future in as_completed(futures):
+            try:
+                yield future.result(), None
+            except Exception as e:
+                print(f"Failed to download {futures[future]}: {e}")
+                yield None, f"{futures[future]}: {e}"
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from overlay_cache import DiskLRUCache, content_hash, file_fingerprint
+
+
+# Shared by every LatentSync process on the host, like the Drive download cache.
+FEATURE_CACHE_ROOT = Path(os.environ.get("LATENTSYNC_FEATURE_CACHE_DIR",
+                                         Path.home() / ".cache" / "latentsync_features"))
+AUDIO_FEATURE_CACHE_DIR = FEATURE_CACHE_ROOT / "audio"
+AUDIO_FEATURE_CACHE_MAX_BYTES = 5 * 1024 ** 3
+# Bump when the stored layout changes so old entries stop matching.
+AUDIO_FEATURE_FORMAT = "npy-v1"
+FEATURE_FILE = "features.npy"
+FACE_ALIGNMENT_CACHE_DIR = FEATURE_CACHE_ROOT / "face_alignment"
+FACE_ALIGNMENT_CACHE_MAX_BYTES = 20 * 1024 ** 3
+FACE_ALIGNMENT_FORMAT = "npy-mmap-v1"
+FACE_ALIGNMENT_FILES = ('faces.npy', 'boxes.npy', 'affine_matrices.npy')
+
+_content_hash_memo = {}
+_content_hash_memo_lock = threading.Lock()
+
+
+def memoized_content_hash(path):
+    """content_hash, computed once per file_fingerprint for the life of the process."""
+    fingerprint = file_fingerprint(path)
+    with _content_hash_memo_lock:
+        if fingerprint in _content_hash_memo:
+            return _content_hash_memo[fingerprint]
+    value = content_hash(path)
+    with _content_hash_memo_lock:
+        _content_hash_memo[fingerprint] = value
+    return value
+
+
+class AudioFeatureCache:
+    """
+    Caches audio encoder outputs keyed by the audio's content hash, the sample rate the encoder
+    resamples to and the extractor's identity (model file, settings). A parameter sweep or a batch
+    reusing a voice track then skips the audio encoder. Features are stored as .npy in a shared
+    DiskLRUCache; torch tensors come back as tensors.
+    """
+
+    def __init__(self, extractor_id, sample_rate, cache_dir=AUDIO_FEATURE_CACHE_DIR,
+                 max_bytes=AUDIO_FEATURE_CACHE_MAX_BYTES):
+        self.extractor_id = extractor_id
+        self.sample_rate = sample_rate
+        self.cache = DiskLRUCache(cache_dir, max_bytes, shared=True)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, audio_path):
+        identity = f"{memoized_content_hash(audio_path)}|{self.sample_rate}|{self.extractor_id}|{AUDIO_FEATURE_FORMAT}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def get_or_compute(self, audio_path, compute):
+        """Returns (features, cache_hit); compute(audio_path) runs the encoder on a miss."""
+        key = self.cache_key(audio_path)
+        entry_dir, meta = self.cache.get(key)
+        if entry_dir is not None:
+            try:
+                features = np.load(entry_dir / FEATURE_FILE)
+                self.hits += 1
+                return self._restore(features, meta), True
+            except (OSError, ValueError):
+                self.cache.remove(key)
+        features = compute(audio_path)
+        is_tensor = hasattr(features, 'detach')
+        array = features.detach().cpu().numpy() if is_tensor else np.asarray(features)
+        meta = {'source': str(audio_path), 'tensor': is_tensor, 'dtype': str(array.dtype),
+                'shape': list(array.shape)}
+        self.cache.put(key, meta, lambda tmp_dir: np.save(tmp_dir / FEATURE_FILE, array))
+        self.misses += 1
+        return features, False
+
+    @staticmethod
+    def _restore(features, meta):
+        if meta.get('tensor'):
+            import torch
+            return torch.from_numpy(features)
+        return features
+
+    def wrap(self, compute):
+        """compute(audio_path) -> features, with the cache in front of it."""
+        def cached(audio_path, *args, **kwargs):
+            if args or kwargs:
+                return compute(audio_path, *args, **kwargs)
+            features, _ = self.get_or_compute(audio_path, compute)
+            return features
+        return cached
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class FaceAlignmentCache:
+    """
+    Caches the per-frame face alignment of a video (aligned face crops, face boxes and affine
+    matrices) keyed by the video's content hash and the face processor's settings, so lipsyncing
+    the same avatar against new audio skips face detection. Each array is one .npy file, loaded
+    memory-mapped (copy-on-write), so a hit costs no detection and no up-front read.
+
+    The pipeline cuts the video to the audio's length before aligning it, and alignment is per frame,
+    so an entry serves any job that needs at most as many frames (its first rows). A longer
+    alignment of the same video replaces a shorter one, never the other way round.
+    """
+
+    def __init__(self, processor_id, cache_dir=FACE_ALIGNMENT_CACHE_DIR, max_bytes=FACE_ALIGNMENT_CACHE_MAX_BYTES):
+        self.processor_id = processor_id
+        self.cache = DiskLRUCache(cache_dir, max_bytes, shared=True)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, video_path):
+        identity = f"{memoized_content_hash(video_path)}|{self.processor_id}|{FACE_ALIGNMENT_FORMAT}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def load(self, video_path, frame_count):
+        """(faces, boxes, affine_matrices) of the first frame_count frames in the pipeline's types, or None."""
+        key = self.cache_key(video_path)
+        entry_dir, meta = self.cache.get(key)
+        if entry_dir is None:
+            return None
+        if meta.get('frames', 0) < frame_count:
+            return None
+        try:
+            faces, boxes, affine_matrices = (np.load(entry_dir / name, mmap_mode='c')[:frame_count]
+                                             for name in FACE_ALIGNMENT_FILES)
+        except (OSError, ValueError):
+            self.cache.remove(key)
+            return None
+        if meta.get('tensors'):
+            import torch
+            faces = torch.from_numpy(faces)
+            affine_matrices = [torch.from_numpy(matrix) for matrix in affine_matrices]
+        else:
+            affine_matrices = list(affine_matrices)
+        boxes = [tuple(box) for box in boxes.tolist()]
+        self.hits += 1
+        return faces, boxes, affine_matrices
+
+    def store(self, video_path, faces, boxes, affine_matrices):
+        """Caches an alignment unless the entry already covers at least as many frames."""
+        self.misses += 1
+        key = self.cache_key(video_path)
+        _, meta = self.cache.get(key)
+        if meta and meta.get('frames', 0) >= len(faces):
+            return
+        is_tensor = hasattr(faces, 'detach')
+        arrays = (
+            faces.detach().cpu().numpy() if is_tensor else np.asarray(faces),
+            np.asarray(boxes),
+            np.stack([matrix.detach().cpu().numpy() if hasattr(matrix, 'detach') else np.asarray(matrix)
+                      for matrix in affine_matrices]),
+        )
+
+        def write_files(tmp_dir):
+            for name, array in zip(FACE_ALIGNMENT_FILES, arrays):
+                np.save(tmp_dir / name, array)
+        meta = {'source': str(video_path), 'frames': len(arrays[0]), 'tensors': is_tensor}
+        self.cache.put(key, meta, write_files)
+
+    def wrap(self, affine_transform_video, current_video_path):
+        """
+        affine_transform_video(video_frames) -> (faces, boxes, affine_matrices), with the cache in
+        front of it. The frames don't say which video they came from, so current_video_path()
+        names the video of the running job (None skips the cache).
+        """
+        def cached(video_frames, *args, **kwargs):
+            video_path = current_video_path()
+            if video_path is None or args or kwargs:
+                return affine_transform_video(video_frames, *args, **kwargs)
+            result = self.load(video_path, len(video_frames))
+            if result is not None:
+                return result
+            faces, boxes, affine_matrices = affine_transform_video(video_frames)
+            self.store(video_path, faces, boxes, affine_matrices)
+            return faces, boxes, affine_matrices
+        return cached
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -1,36 +1,55 @@
+import asyncio
+import codecs
 import gradio as gr
 from pathlib import Path
-from scripts.inference import main
-import argparse
 from datetime import datetime
-import gdown
 import os
-import re
 import tempfile
-import torch
 import glob
-from omegaconf import OmegaConf
 import shutil
+from collections import deque
+
+from drive_download import download_drive_file, drive_file_id, iter_folder_downloads
+from latentsync_worker import get_worker, get_workers, run_pipeline
 
 # --- CONFIGURATION ---
-# Config for the main model processing
-CONFIG_PATH = Path("configs/unet/stage2.yaml")
-CHECKPOINT_PATH = Path("checkpoints/latentsync_unet.pt")
+# The model config and checkpoint live in latentsync_worker (CONFIG_PATH, CHECKPOINT_PATH).
 # Log files
 LOG_FILE_PATH = Path("/workspace/latentsync.log")
 BATCH_LOG_FILE_PATH = Path("/workspace/latentsync_batch.log")
 # Directory for batch mode outputs
 OUTPUT_DIR = Path("./outputs")
+# Lines of each log shown in the UI, and the block size the tail is read backwards in.
+LOG_TAIL_LINES = 50
+LOG_TAIL_BLOCK_BYTES = 64 * 1024
+# How often the open page is sent new log lines and output files.
+LIVE_POLL_SECONDS = 2
+# A live stream ends after this many polls without news (10 minutes), so abandoned tabs don't keep
+# polling for good; "Refresh Outputs & Logs" starts it again.
+LIVE_IDLE_POLLS = 300
 
 
 # --- LOGGING & BATCH MODE HELPER FUNCTIONS (Verified and Working) ---
 
+def tail_lines(path, line_count=LOG_TAIL_LINES):
+    """The last line_count lines of a text file, read backwards from the end in blocks."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= line_count:
+            step = min(LOG_TAIL_BLOCK_BYTES, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return data.decode("utf-8", errors="replace").splitlines()[-line_count:]
+
+
 def read_log_file():
     """Read the last 50 lines of the main log file."""
     try:
         if not LOG_FILE_PATH.exists(): return "Log file not found."
-        with open(LOG_FILE_PATH, "r", encoding="utf-8") as f:
-            return "".join(f.readlines()[-50:]).strip()
+        return "\n".join(tail_lines(LOG_FILE_PATH)).strip()
     except Exception as e:
         return f"Error reading log file: {str(e)}"
 
@@ -39,21 +58,130 @@ def read_batch_log_file():
     """Read the last 50 lines of the batch log file."""
     try:
         if not BATCH_LOG_FILE_PATH.exists(): return "Batch log file not found."
-        with open(BATCH_LOG_FILE_PATH, "r", encoding="utf-8") as f:
-            return "".join(f.readlines()[-50:]).strip()
+        return "\n".join(tail_lines(BATCH_LOG_FILE_PATH)).strip()
     except Exception as e:
         return f"Error reading batch log file: {str(e)}"
 
 
-def refresh_all_outputs():
-    """Reads both log files and gets a list of all batch output videos."""
-    single_log = read_log_file()
-    batch_log = read_batch_log_file()
-    batch_files = []
-    if OUTPUT_DIR.exists():
-        path_objects = sorted([f for f in OUTPUT_DIR.glob("*.mp4")], key=os.path.getmtime, reverse=True)
-        batch_files = [str(p) for p in path_objects]
-    return single_log, batch_log, batch_files
+def list_output_videos():
+    """Batch output videos, newest first."""
+    if not OUTPUT_DIR.exists():
+        return []
+    return [str(p) for p in sorted(OUTPUT_DIR.glob("*.mp4"), key=os.path.getmtime, reverse=True)]
+
+
+class LogFollower:
+    """
+    Follows a growing log file: starts from its tail, then each poll() reads only the bytes appended
+    since the last one (starting over if the file was truncated or replaced) and keeps the last
+    LOG_TAIL_LINES lines. poll() returns the text to show, or None if nothing changed.
+    """
+
+    def __init__(self, path, missing_message):
+        self.path = Path(path)
+        self.missing_message = missing_message
+        self.lines = deque(maxlen=LOG_TAIL_LINES)
+        # The unterminated last line, undecoded: a read can end inside a multi-byte character.
+        self.partial = b""
+        self.offset = 0
+        self.inode = None
+        self.shown = None
+
+    def poll(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self.inode = None
+            return self._show(self.missing_message)
+        try:
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # First poll, or the log was rotated/truncated: start from its tail.
+                self.lines.clear()
+                self.lines.extend(tail_lines(self.path))
+                self.offset, self.inode = stat.st_size, stat.st_ino
+                self.partial = self._unterminated_line(stat.st_size)
+                if self.partial and self.lines:
+                    # The last line is still being written; the next poll continues it.
+                    self.lines.pop()
+            elif stat.st_size > self.offset:
+                with open(self.path, "rb") as f:
+                    f.seek(self.offset)
+                    chunk = f.read(stat.st_size - self.offset)
+                self.offset += len(chunk)
+                *complete, self.partial = (self.partial + chunk).split(b"\n")
+                self.lines.extend(line.decode("utf-8", errors="replace") for line in complete)
+        except OSError as e:
+            return self._show(f"Error reading {self.path.name}: {str(e)}")
+        # Without final=True, an incomplete trailing character waits for the next poll instead of showing as U+FFFD.
+        partial = codecs.getincrementaldecoder("utf-8")(errors="replace").decode(self.partial)
+        lines = list(self.lines) + ([partial] if partial else [])
+        return self._show("\n".join(lines[-LOG_TAIL_LINES:]).strip())
+
+    def _unterminated_line(self, size):
+        """The bytes after the file's last newline (empty if it ends with one), read backwards in blocks."""
+        data = b""
+        with open(self.path, "rb") as f:
+            position = size
+            while position > 0 and b"\n" not in data:
+                step = min(LOG_TAIL_BLOCK_BYTES, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        return data.rsplit(b"\n", 1)[-1]
+
+    def _show(self, text):
+        if text == self.shown:
+            return None
+        self.shown = text
+        return text
+
+
+class OutputWatcher:
+    """
+    Tracks the batch output videos. The directory is only listed again when its mtime changes (a file
+    was added, renamed or removed), so an idle poll costs one stat. poll() returns the newest-first
+    list when it changed, else None.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.mtime = None
+        self.shown = None
+
+    def poll(self):
+        try:
+            mtime = self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime and self.shown is not None:
+            return None
+        self.mtime = mtime
+        files = list_output_videos()
+        if files == self.shown:
+            return None
+        self.shown = files
+        return files
+
+
+async def stream_outputs():
+    """
+    Pushes the logs and batch outputs to the page: every LIVE_POLL_SECONDS it sends whatever changed
+    (new log lines, new output files) and leaves the rest untouched. Returns after LIVE_IDLE_POLLS
+    polls in a row without a change. Async, so a waiting stream holds no worker thread; a poll is
+    a few stats and small reads.
+    """
+    followers = (LogFollower(LOG_FILE_PATH, "Log file not found."),
+                 LogFollower(BATCH_LOG_FILE_PATH, "Batch log file not found."))
+    outputs = OutputWatcher(OUTPUT_DIR)
+    idle_polls = 0
+    while idle_polls < LIVE_IDLE_POLLS:
+        updates = [follower.poll() for follower in followers] + [outputs.poll()]
+        if any(update is not None for update in updates):
+            idle_polls = 0
+            yield tuple(gr.update() if update is None else update for update in updates)
+        else:
+            idle_polls += 1
+        await asyncio.sleep(LIVE_POLL_SECONDS)
 
 
 def list_folders(gdrive_url, progress=gr.Progress()):
@@ -66,7 +194,11 @@ def list_folders(gdrive_url, progress=gr.Progress()):
     try:
         if not gdrive_url: raise gr.Error("Please provide a Google Drive Folder URL.")
         progress(0.1, desc="Starting folder download")
-        gdown.download_folder(gdrive_url, output=str(temp_dir), quiet=False, use_cookies=True, remaining_ok=True)
+        # Concurrent per-file downloads through the shared download cache; repeat packs are hardlinked in.
+        for path, error in iter_folder_downloads(gdrive_url, temp_dir, extensions=None, rename_suffix=None,
+                                                 keep_tree=True):
+            if error:
+                print(f"Skipped {error}")
         # Handle cases where gdown creates a subfolder with the content
         subdirs = [d for d in temp_dir.iterdir() if d.is_dir()]
         content_path = subdirs[0] if len(subdirs) == 1 else temp_dir
@@ -81,7 +213,10 @@ def list_folders(gdrive_url, progress=gr.Progress()):
 
 
 def process_batch(local_batch_path, selected_folders, guidance_scale, inference_steps, seed):
-    """Clears old outputs, then processes selected folders without updating UI."""
+    """
+    Clears old outputs, then processes selected folders without updating UI. Folders are pipelined:
+    the next ones are re-timed and resampled on the CPU while the GPUs run the current ones.
+    """
     if OUTPUT_DIR.exists():
         print(f"Clearing previous batch outputs in {OUTPUT_DIR}...")
         shutil.rmtree(OUTPUT_DIR)
@@ -91,6 +226,7 @@ def process_batch(local_batch_path, selected_folders, guidance_scale, inference_
             raise gr.Error("Please list folders and select at least one to process.")
         with open(BATCH_LOG_FILE_PATH, "w", encoding="utf-8") as f:
             f.write(f"--- New Batch Started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
+        jobs = []
         for folder in selected_folders:
             folder_path = Path(local_batch_path) / folder
             video_files = glob.glob(f"{folder_path}/*.[mM][pP]4") + glob.glob(f"{folder_path}/*.[mM][oO][vV]")
@@ -98,23 +234,25 @@ def process_batch(local_batch_path, selected_folders, guidance_scale, inference_
             if not video_files or not audio_files:
                 log_msg = f"{folder} status: skipped (missing video or audio)"
                 with open(BATCH_LOG_FILE_PATH, "a", encoding="utf-8") as f: f.write(log_msg + "\n")
-                torch.cuda.empty_cache()
                 continue
-            video_path, audio_path = video_files[0], audio_files[0]
-            log_msg = f"{folder} status: processing"
+            # The folder name is the output name, so batch outputs land in OUTPUT_DIR.
+            jobs.append({'folder': folder, 'video_path': Path(video_files[0]).absolute().as_posix(),
+                         'audio_path': Path(audio_files[0]).absolute().as_posix(),
+                         'output_path': lipsync_output_path(video_files[0], folder),
+                         'guidance_scale': guidance_scale, 'inference_steps': inference_steps, 'seed': seed})
             with open(BATCH_LOG_FILE_PATH, "a", encoding="utf-8") as f:
-                f.write(log_msg + "\n")
-            try:
-                # Use the single-file processing logic for each item, passing the folder name
-                # as `output_name` to direct output to the correct directory.
-                process_video_for_single_mode(video_path, audio_path, guidance_scale, inference_steps, seed,
-                                              output_name=folder)
-                log_msg = f"{folder} status: complete"
-            except Exception as e:
-                log_msg = f"{folder} status: FAILED with error: {e}"
+                f.write(f"{folder} status: queued\n")
+        folders = {job['output_path']: job.pop('folder') for job in jobs}
+        for job, result, error in run_pipeline(get_workers(), jobs):
+            folder = folders[job['output_path']]
+            if error:
+                log_msg = f"{folder} status: FAILED with error: {error}"
+            else:
+                log_msg = (f"{folder} status: complete (prepare {result['prepare_seconds']}s on CPU, "
+                           f"inference {result['job_seconds']}s on {', '.join(result['devices'])}"
+                           f"{', ' + str(result['segments']) + ' segments' if result['segments'] > 1 else ''})")
             with open(BATCH_LOG_FILE_PATH, "a", encoding="utf-8") as f:
                 f.write(log_msg + "\n")
-            torch.cuda.empty_cache()
     except Exception as e:
         error_message = f"Batch processing error: {str(e)}"
         with open(BATCH_LOG_FILE_PATH, "a", encoding="utf-8") as f:
@@ -124,26 +262,14 @@ def process_batch(local_batch_path, selected_folders, guidance_scale, inference_
 
 # --- ORIGINAL FUNCTIONS FOR SINGLE-FILE MODE (Restored and Integrated) ---
 
-def convert_gdrive_url_for_single_mode(gdrive_url):
-    try:
-        file_id_match = re.search(r'[-\w]{25,}(?=/|$)', gdrive_url)
-        if not file_id_match: return None
-        file_id = file_id_match.group(0)
-        return f"https://drive.google.com/uc?export=download&id={file_id}"
-    except:
-        return None
-
-
 def download_gdrive_file_for_single_mode(gdrive_url):
     """Original download function that returns a status message."""
     try:
         if not gdrive_url: return None, None, "Please provide a Google Drive URL"
-        direct_url = convert_gdrive_url_for_single_mode(gdrive_url)
-        if not direct_url: return None, None, "Invalid Google Drive URL."
+        file_id = drive_file_id(gdrive_url)
+        if not file_id: return None, None, "Invalid Google Drive URL."
         temp_dir = Path(tempfile.gettempdir())
-        temp_file_path = gdown.download(direct_url, quiet=False, output=str(temp_dir) + "/")
-        if not temp_file_path or not os.path.exists(temp_file_path) or os.path.getsize(temp_file_path) == 0:
-            return None, None, "Download failed."
+        temp_file_path = str(download_drive_file(file_id, temp_dir))
         return temp_file_path, temp_file_path, f"File downloaded as {os.path.basename(temp_file_path)}"
     except Exception as e:
         return None, None, f"Error downloading file: {str(e)}"
@@ -152,10 +278,26 @@ def download_gdrive_file_for_single_mode(gdrive_url):
 def process_video_for_single_mode(video_path, audio_path, guidance_scale, inference_steps, seed, gdrive_url=None,
                                   output_name=None):
     """Original processing function, modified to handle different output directories."""
-    # If called from batch (`output_name` is provided), use main output dir. Otherwise, use temp.
+    result_path, _ = run_lipsync(video_path, audio_path, guidance_scale, inference_steps, seed, gdrive_url,
+                                 output_name)
+    return result_path
+
+
+def lipsync_output_path(video_path, output_name=None):
+    """Batch items (with output_name) go to OUTPUT_DIR, single videos to ./temp."""
     output_dir = OUTPUT_DIR if output_name else Path("./temp")
     output_dir.mkdir(parents=True, exist_ok=True)
+    current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Use output_name for batch items, otherwise generate from video stem
+    out_stem = output_name if output_name else Path(video_path).stem
+    return str(output_dir / f"{out_stem}_{current_time}.mp4")
+
 
+def run_lipsync(video_path, audio_path, guidance_scale, inference_steps, seed, gdrive_url=None, output_name=None):
+    """
+    Runs one video through the resident LatentSync worker, whose models stay loaded between calls.
+    Returns (output_path, job_seconds).
+    """
     if gdrive_url and not video_path:
         video_path, _, download_status = download_gdrive_file_for_single_mode(gdrive_url)
         if not video_path: raise gr.Error(download_status)
@@ -163,48 +305,18 @@ def process_video_for_single_mode(video_path, audio_path, guidance_scale, infere
 
     video_path = Path(video_path).absolute().as_posix()
     audio_path = Path(audio_path).absolute().as_posix()
-    current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_path = lipsync_output_path(video_path, output_name)
 
-    # Use output_name for batch items, otherwise generate from video stem
-    out_stem = output_name if output_name else Path(video_path).stem
-    output_path = str(output_dir / f"{out_stem}_{current_time}.mp4")
-
-    config = OmegaConf.load(CONFIG_PATH)
-    config["run"].update(
-        {"guidance_scale": guidance_scale, "inference_steps": inference_steps, "batch_size": 8, "use_multi_gpu": True})
-
-    num_gpus = torch.cuda.device_count()
-    if num_gpus < 1: raise gr.Error("No CUDA-capable GPUs detected.")
-
-    args = create_args(video_path, audio_path, output_path, inference_steps, guidance_scale, seed, num_gpus)
+    worker = get_worker()
     try:
-        main(config=config, args=args)
-        result_path = Path(output_path)
-        if not result_path.exists() or result_path.stat().st_size == 0:
-            raise gr.Error(f"Processing failed: Output file at {output_path} is empty or not created.")
-        torch.cuda.empty_cache()
-        return str(result_path.absolute())
+        result = worker.run(video_path, audio_path, output_path, guidance_scale, inference_steps, seed)
     except Exception as e:
-        torch.cuda.empty_cache()
         raise gr.Error(f"Error during processing: {str(e)}")
-
-
-def create_args(video_path: str, audio_path: str, output_path: str, inference_steps: int, guidance_scale: float,
-                seed: int, num_gpus: int) -> argparse.Namespace:
-    """Universal argument creation for the main inference script."""
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--inference_ckpt_path", type=str, required=True)
-    parser.add_argument("--video_path", type=str, required=True)
-    parser.add_argument("--audio_path", type=str, required=True)
-    parser.add_argument("--video_out_path", type=str, required=True)
-    parser.add_argument("--inference_steps", type=int, default=20)
-    parser.add_argument("--guidance_scale", type=float, default=1.0)
-    parser.add_argument("--seed", type=int, default=1247)
-    parser.add_argument("--num_gpus", type=int, default=1)
-    return parser.parse_args(
-        ["--inference_ckpt_path", CHECKPOINT_PATH.absolute().as_posix(), "--video_path", video_path, "--audio_path",
-         audio_path, "--video_out_path", output_path, "--inference_steps", str(inference_steps), "--guidance_scale",
-         str(guidance_scale), "--seed", str(seed), "--num_gpus", str(num_gpus)])
+    timing = (f"{Path(output_path).name}: inference {result['job_seconds']}s (models loaded once in "
+              f"{result['load_seconds']}s, {worker.stats()['jobs_done']} jobs served)")
+    # stdout is redirected to LOG_FILE_PATH by the start scripts.
+    print(timing)
+    return result['output_path'], result['job_seconds']
 
 
 def toggle_batch_mode(batch_mode):
@@ -271,8 +383,13 @@ with gr.Blocks(title="Summit Lipsync") as demo:
         video_input, gdrive_url_input, download_btn, download_status, audio_input, process_btn, video_output,
         batch_gdrive_url, list_folders_btn, folder_list, batch_process_btn, batch_output_files
     ])
-    refresh_log_btn.click(fn=refresh_all_outputs, inputs=[],
-                          outputs=[log_display, batch_log_display, batch_output_files])
+    # Live logs and outputs from page load until they go quiet; the button shows the current state and
+    # restarts the stream in place of the page-load one. The streams are async and one per visitor,
+    # so they take no worker threads and need no concurrency limit.
+    live_outputs = demo.load(fn=stream_outputs, inputs=None,
+                             outputs=[log_display, batch_log_display, batch_output_files], concurrency_limit=None)
+    refresh_log_btn.click(fn=stream_outputs, inputs=[], outputs=[log_display, batch_log_display, batch_output_files],
+                          cancels=[live_outputs], concurrency_limit=None)
 
     # --- Single-mode listeners use original functions ---
     download_btn.click(fn=download_gdrive_file_for_single_mode, inputs=[gdrive_url_input],
@@ -288,4 +405,6 @@ with gr.Blocks(title="Summit Lipsync") as demo:
                             outputs=None)
 
 if __name__ == "__main__":
+    # Start loading the models on every device now, so the first request doesn't pay for it.
+    get_workers()
     demo.launch(server_name="0.0.0.0", server_port=7861)
@@ -60,6 +60,13 @@ cd LatentSync
 echo "📥 Running LatentSync environment setup..."
 # The setup_env.sh script sets up a conda environment and installs required packages.
 cp /summitweb/gradio_app.py /workspace/LatentSync/gradio_app.py
+# Modules gradio_app.py imports: the Drive download cache and the resident inference worker.
+cp /summitweb/drive_download.py /workspace/LatentSync/drive_download.py
+cp /summitweb/download_cache.py /workspace/LatentSync/download_cache.py
+cp /summitweb/overlay_cache.py /workspace/LatentSync/overlay_cache.py
+cp /summitweb/media_probe.py /workspace/LatentSync/media_probe.py
+cp /summitweb/latentsync_worker.py /workspace/LatentSync/latentsync_worker.py
+cp /summitweb/feature_cache.py /workspace/LatentSync/feature_cache.py
 
 #!/bin/bash
 
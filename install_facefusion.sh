@@ -44,6 +44,11 @@ cd LatentSync
 echo "📥 Running LatentSync environment setup..."
 # The setup_env.sh script sets up a conda environment and installs required packages.
 cp /summitweb/gradio_app.py /workspace/LatentSync/gradio_app.py
+# Modules gradio_app.py imports: the Drive download cache and the resident inference worker.
+for module in drive_download.py download_cache.py overlay_cache.py media_probe.py latentsync_worker.py \
+    feature_cache.py; do
+    cp /summitweb/$module /workspace/LatentSync/$module
+done
 
 #!/bin/bash
 
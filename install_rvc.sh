@@ -62,6 +62,13 @@ echo "📥 Running LatentSync environment setup..."
 sed -i 's/xformers==0\.0\.26/xformers==0.0.25.post1/g' requirements.txt
 sed -i 's/mediapipe==0\.10\.11/mediapipe==0.10\.13/g' requirements.txt
 cp /summitweb/gradio_app.py /workspace/LatentSync/gradio_app.py
+# Modules gradio_app.py imports: the Drive download cache and the resident inference worker.
+cp /summitweb/drive_download.py /workspace/LatentSync/drive_download.py
+cp /summitweb/download_cache.py /workspace/LatentSync/download_cache.py
+cp /summitweb/overlay_cache.py /workspace/LatentSync/overlay_cache.py
+cp /summitweb/media_probe.py /workspace/LatentSync/media_probe.py
+cp /summitweb/latentsync_worker.py /workspace/LatentSync/latentsync_worker.py
+cp /summitweb/feature_cache.py /workspace/LatentSync/feature_cache.py
 
 #!/bin/bash
 
@@ -0,0 +1,697 @@
+"""
+Resident LatentSync inference worker: loads the models once and keeps them warm across jobs.
+
+    python latentsync_worker.py --backend stub --video in.mp4 --audio in.wav --repeat 3
+    python latentsync_worker.py --backend stub --video in.mp4 --audio in.wav --repeat 6 --pipeline
+
+gradio_app.py submits every single-video and batch job to one worker through a local queue, instead of
+calling scripts.inference.main (which rebuilds the UNet, VAE and audio encoder) per video. The worker
+reports its model load time once and each job's time separately, so the savings can be measured.
+
+Batches are pipelined and scheduled across devices (run_pipeline): a CPU pool runs the backend's prepare()
+stage (re-timing and resampling the inputs) for the next jobs while one worker per device (get_workers) runs
+inference. Prepared jobs wait in a bounded queue, longest clip first, and whichever device is idle takes the
+next one. A clip longer than its fair share of the batch is cut into segments that run on several devices
+at once and are joined afterwards. LATENTSYNC_DEVICES (e.g. "cuda:0,cuda:2") limits the devices used.
+
+Audio encoder outputs are cached by audio content (feature_cache.AudioFeatureCache), so re-runs on the
+same voice track with other guidance/steps/seed skip the audio encoder. Face alignment is cached per video
+(feature_cache.FaceAlignmentCache), so one avatar lipsynced to many scripts is only face-detected once.
+
+LATENTSYNC_BACKEND=stub swaps the models for a CPU-only stand-in that muxes the audio onto the video with
+ffmpeg, so the queue, scheduling and timing can be exercised without a GPU or checkpoints; it runs on
+LATENTSYNC_STUB_DEVICES fake "cpu:N" devices.
+"""
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from feature_cache import AudioFeatureCache, FaceAlignmentCache
+from overlay_cache import sampled_content_hash
+
+
+CONFIG_PATH = Path("configs/unet/stage2.yaml")
+CHECKPOINT_PATH = Path("checkpoints/latentsync_unet.pt")
+WHISPER_CHECKPOINTS = {768: "checkpoints/whisper/small.pt", 384: "checkpoints/whisper/tiny.pt"}
+# 'latentsync' (the real models) or 'stub' (CPU stand-in for testing).
+DEFAULT_BACKEND = os.environ.get("LATENTSYNC_BACKEND", "latentsync")
+# Simulated model load and per-job inference time of the stub backend.
+STUB_LOAD_SECONDS = float(os.environ.get("LATENTSYNC_STUB_LOAD_SECONDS", "2"))
+STUB_INFER_SECONDS = float(os.environ.get("LATENTSYNC_STUB_INFER_SECONDS", "1"))
+# Bump when the face alignment the pipeline computes changes (e.g. a LatentSync upgrade).
+FACE_PROCESSOR_VERSION = "latentsync-affine-v1"
+# LatentSync works on 25 fps video and 16 kHz audio.
+MODEL_FPS = 25
+MODEL_AUDIO_RATE = 16000
+# Pipelined batches: CPU threads preparing jobs, and prepared jobs allowed to wait per device.
+PREPARE_WORKERS = 2
+PREFETCH_JOBS = 2
+# Fake devices of the stub backend, for testing the multi-device scheduler on CPU.
+STUB_DEVICES = int(os.environ.get("LATENTSYNC_STUB_DEVICES", "2"))
+# A long clip is only cut into segments of at least this length; shorter pieces cost more in
+# per-segment face detection and overhead than they save.
+MIN_SEGMENT_SECONDS = 20
+
+# read_video/read_audio of the LatentSync pipeline serve the job's prepared inputs on the thread running it.
+_prepared_inputs = threading.local()
+_prepared_readers_lock = threading.Lock()
+# Pipelines without a generator argument draw their latents from the process-wide RNGs, which
+# set_seed resets on every device; concurrent jobs take turns seeding and drawing under this lock.
+_global_rng_lock = threading.Lock()
+
+
+def prepare_dir_for(output_path):
+    return Path(output_path).parent / f".prepare_{Path(output_path).stem}"
+
+
+def conform_inputs(video_path, audio_path, prepare_dir):
+    """
+    The CPU-bound conversions LatentSync would otherwise do inline: the video re-timed to MODEL_FPS and
+    the audio resampled to mono MODEL_AUDIO_RATE wav. Returns (video_path, audio_path) in prepare_dir.
+    """
+    prepare_dir = Path(prepare_dir)
+    prepare_dir.mkdir(parents=True, exist_ok=True)
+    conformed_video, conformed_audio = prepare_dir / "video_25fps.mp4", prepare_dir / "audio_16k.wav"
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(video_path), '-r', str(MODEL_FPS),
+                    '-an', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-y', str(conformed_video)],
+                   check=True, capture_output=True, text=True)
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(audio_path), '-vn', '-ac', '1',
+                    '-ar', str(MODEL_AUDIO_RATE), '-y', str(conformed_audio)], check=True, capture_output=True,
+                   text=True)
+    return str(conformed_video), str(conformed_audio)
+
+
+class LatentSyncBackend:
+    """
+    The LatentSync models, built the way scripts/inference.py builds them but only once: the
+    scheduler, whisper audio encoder, VAE and UNet are loaded in load() and reused by every infer().
+    """
+
+    name = 'latentsync'
+
+    def __init__(self, device="cuda", config_path=CONFIG_PATH, checkpoint_path=CHECKPOINT_PATH):
+        self.device = device
+        self.config_path = Path(config_path)
+        self.checkpoint_path = Path(checkpoint_path)
+        self.pipeline = None
+        self._current_video = None
+
+    def load(self):
+        import torch
+        from diffusers import AutoencoderKL, DDIMScheduler
+        from omegaconf import OmegaConf
+        from latentsync.models.unet import UNet3DConditionModel
+        from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+        from latentsync.whisper.audio2feature import Audio2Feature
+
+        if torch.cuda.device_count() < 1:
+            raise RuntimeError("No CUDA-capable GPUs detected.")
+        # Parts of the pipeline allocate on the current device ("cuda"), so make it this worker's one;
+        # the current device is per thread, and load() and infer() both run on the worker thread.
+        if self.device.startswith("cuda:"):
+            torch.cuda.set_device(self.device)
+        self.config = OmegaConf.load(self.config_path)
+        fp16_supported = torch.cuda.get_device_capability(self.device)[0] > 7
+        self.dtype = torch.float16 if fp16_supported else torch.float32
+        whisper_path = WHISPER_CHECKPOINTS.get(self.config.model.cross_attention_dim)
+        if whisper_path is None:
+            raise NotImplementedError(f"No whisper model for cross_attention_dim "
+                                      f"{self.config.model.cross_attention_dim}")
+        scheduler = DDIMScheduler.from_pretrained("configs")
+        audio_encoder = Audio2Feature(model_path=whisper_path, device=self.device,
+                                      num_frames=self.config.data.num_frames,
+                                      audio_feat_length=self.config.data.audio_feat_length)
+        extractor_id = (f"whisper:{sampled_content_hash(whisper_path)}:frames={self.config.data.num_frames}:"
+                        f"feat_len={list(self.config.data.audio_feat_length)}")
+        self.audio_features = AudioFeatureCache(extractor_id, MODEL_AUDIO_RATE)
+        # The pipeline calls audio2feat(audio_path) once per job; the cache answers repeats of the same audio.
+        audio_encoder.audio2feat = self.audio_features.wrap(audio_encoder.audio2feat)
+        vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=self.dtype)
+        vae.config.scaling_factor = 0.18215
+        vae.config.shift_factor = 0
+        unet, _ = UNet3DConditionModel.from_pretrained(OmegaConf.to_container(self.config.model),
+                                                       self.checkpoint_path.absolute().as_posix(), device="cpu")
+        unet = unet.to(dtype=self.dtype)
+        self.pipeline = LipsyncPipeline(vae=vae, audio_encoder=audio_encoder, denoising_unet=unet,
+                                        scheduler=scheduler).to(self.device)
+        processor_id = f"{FACE_PROCESSOR_VERSION}:resolution={self.config.data.resolution}:fps={MODEL_FPS}"
+        self.face_alignment = FaceAlignmentCache(processor_id)
+        if hasattr(self.pipeline, 'affine_transform_video'):
+            self.pipeline.affine_transform_video = self.face_alignment.wrap(self.pipeline.affine_transform_video,
+                                                                            lambda: self._current_video)
+        else:
+            print("This LatentSync pipeline has no affine_transform_video; face alignment is not cached.")
+
+    def prepare(self, video_path, audio_path, output_path, **_):
+        """
+        CPU stage: conforms the inputs to the model's frame and sample rates and decodes the audio. The
+        conformed video stays on disk and is decoded by infer(): decoded frames run to gigabytes per
+        minute of HD video, too much to hold for every job waiting in the queue. Face alignment stays
+        in the pipeline, which builds its face detector on the GPU per call.
+        """
+        from latentsync.utils.util import read_audio
+
+        conformed_video, conformed_audio = conform_inputs(video_path, audio_path, prepare_dir_for(output_path))
+        return {
+            'video_path': video_path,
+            'audio_path': audio_path,
+            'conformed_video': str(conformed_video),
+            'audio_samples': read_audio(conformed_audio),
+            'prepare_dir': str(prepare_dir_for(output_path)),
+        }
+
+    @staticmethod
+    def _install_prepared_readers():
+        """
+        Replaces the pipeline module's read_video/read_audio (once per process) with versions that
+        read the prepared (already conformed) video and return the prepared samples of the job running
+        on the calling thread. Workers on other devices run their own jobs concurrently, so the
+        prepared inputs are thread-local.
+        """
+        from latentsync.pipelines import lipsync_pipeline
+
+        with _prepared_readers_lock:
+            if getattr(lipsync_pipeline, '_serves_prepared_inputs', False):
+                return
+            read_video, read_audio = lipsync_pipeline.read_video, lipsync_pipeline.read_audio
+
+            def prepared_video(path, *args, **kwargs):
+                prepared = getattr(_prepared_inputs, 'current', None)
+                if prepared and str(path) == prepared['video_path']:
+                    return read_video(prepared['conformed_video'], change_fps=False)
+                return read_video(path, *args, **kwargs)
+
+            def prepared_audio(path, *args, **kwargs):
+                prepared = getattr(_prepared_inputs, 'current', None)
+                if prepared and str(path) == prepared['audio_path']:
+                    return prepared['audio_samples']
+                return read_audio(path, *args, **kwargs)
+
+            lipsync_pipeline.read_video, lipsync_pipeline.read_audio = prepared_video, prepared_audio
+            lipsync_pipeline._serves_prepared_inputs = True
+
+    @contextlib.contextmanager
+    def _use_prepared(self, prepared):
+        """Serves the prepared video and samples to the pipeline's read_video/read_audio for one call."""
+        if not prepared:
+            yield
+            return
+        self._install_prepared_readers()
+        _prepared_inputs.current = prepared
+        try:
+            yield
+        finally:
+            _prepared_inputs.current = None
+            shutil.rmtree(prepared['prepare_dir'], ignore_errors=True)
+
+    @staticmethod
+    def _seed_globally(seed):
+        import torch
+        from accelerate.utils import set_seed
+
+        if seed != -1:
+            set_seed(seed)
+        else:
+            torch.seed()
+
+    @contextlib.contextmanager
+    def _seeded(self, seed, kwargs, parameters):
+        """
+        Makes the job's random draws depend only on its seed while other devices run jobs too: a
+        generator of its own where the pipeline takes one, else seeding and drawing the initial
+        latents under _global_rng_lock (or just seeding, if the pipeline's draw can't be wrapped).
+        """
+        import torch
+
+        if 'generator' in parameters:
+            generator = torch.Generator(device=self.device)
+            if seed != -1:
+                generator.manual_seed(seed)
+            else:
+                generator.seed()
+            kwargs['generator'] = generator
+            yield
+            return
+        prepare_latents = getattr(self.pipeline, 'prepare_latents', None)
+        if prepare_latents is None:
+            self._seed_globally(seed)
+            yield
+            return
+
+        def seeded_prepare_latents(*args, **latent_kwargs):
+            with _global_rng_lock:
+                self._seed_globally(seed)
+                return prepare_latents(*args, **latent_kwargs)
+
+        self.pipeline.prepare_latents = seeded_prepare_latents
+        try:
+            yield
+        finally:
+            self.pipeline.prepare_latents = prepare_latents
+
+    def infer(self, video_path, audio_path, output_path, guidance_scale, inference_steps, seed, prepared=None):
+        import torch
+
+        kwargs = {
+            'video_path': video_path,
+            'audio_path': audio_path,
+            'video_out_path': output_path,
+            'num_frames': self.config.data.num_frames,
+            'num_inference_steps': inference_steps,
+            'guidance_scale': guidance_scale,
+            'weight_dtype': self.dtype,
+            'width': self.config.data.resolution,
+            'height': self.config.data.resolution,
+            'mask_image_path': self.config.data.mask_image_path,
+        }
+        # Newer pipelines take a scratch directory (which they empty first), older ones write a mask
+        # video next to the output. Jobs on other devices run at the same time, so each gets its own.
+        parameters = inspect.signature(self.pipeline.__call__).parameters
+        temp_dir = None
+        if 'temp_dir' in parameters:
+            temp_dir = tempfile.mkdtemp(prefix=f".temp_{Path(output_path).stem}_", dir=Path(output_path).parent)
+            kwargs['temp_dir'] = temp_dir
+        if 'video_mask_path' in parameters:
+            kwargs['video_mask_path'] = output_path.replace(".mp4", "_mask.mp4")
+        self._current_video = video_path
+        try:
+            with self._use_prepared(prepared), self._seeded(seed, kwargs, parameters):
+                self.pipeline(**kwargs)
+        finally:
+            self._current_video = None
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            torch.cuda.empty_cache()
+
+
+class StubBackend:
+    """
+    CPU stand-in with the LatentSync backend's interface: load() takes STUB_LOAD_SECONDS, prepare()
+    does the real input conforming, and infer() holds the "GPU" for STUB_INFER_SECONDS, then writes the
+    conformed video with the job's audio (stream-copied video) to the output path.
+    """
+
+    name = 'stub'
+
+    def __init__(self, device="cpu", load_seconds=STUB_LOAD_SECONDS, infer_seconds=STUB_INFER_SECONDS):
+        self.device = device
+        self.load_seconds = load_seconds
+        self.infer_seconds = infer_seconds
+
+    def load(self):
+        if not shutil.which('ffmpeg'):
+            raise RuntimeError("The stub backend needs ffmpeg on PATH.")
+        time.sleep(self.load_seconds)
+        self.audio_features = AudioFeatureCache(f"stub-rms:{MODEL_FPS}", MODEL_AUDIO_RATE)
+        self.audio2feat = self.audio_features.wrap(self._audio_rms)
+
+    @staticmethod
+    def _audio_rms(audio_path):
+        """Stand-in audio features: the RMS level of each video frame's worth of audio."""
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(audio_path), '-ac', '1',
+                                 '-ar', str(MODEL_AUDIO_RATE), '-f', 'f32le', '-'], check=True, capture_output=True)
+        samples = np.frombuffer(result.stdout, dtype=np.float32)
+        frame = MODEL_AUDIO_RATE // MODEL_FPS
+        frames = samples[:len(samples) // frame * frame].reshape(-1, frame)
+        return np.sqrt((frames ** 2).mean(axis=1))
+
+    def prepare(self, video_path, audio_path, output_path, **_):
+        conformed_video, conformed_audio = conform_inputs(video_path, audio_path, prepare_dir_for(output_path))
+        return {'video_path': conformed_video, 'audio_path': conformed_audio,
+                'prepare_dir': str(prepare_dir_for(output_path))}
+
+    def infer(self, video_path, audio_path, output_path, guidance_scale, inference_steps, seed, prepared=None):
+        if prepared is None:
+            prepared = self.prepare(video_path, audio_path, output_path)
+        try:
+            self.audio2feat(audio_path)
+            time.sleep(self.infer_seconds)
+            subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', prepared['video_path'],
+                            '-i', prepared['audio_path'], '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy',
+                            '-c:a', 'aac', '-shortest', '-y', str(output_path)],
+                           check=True, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(prepared['prepare_dir'], ignore_errors=True)
+
+
+BACKENDS = {'latentsync': LatentSyncBackend, 'stub': StubBackend}
+
+
+class InferenceWorker:
+    """
+    A thread that owns one backend: it loads the models on start, then runs queued jobs one at a
+    time with the models kept in memory. submit() returns a Future of the job's result dict, and
+    blocks while max_queued jobs are already waiting (0 = unbounded).
+    """
+
+    def __init__(self, backend, max_queued=PREFETCH_JOBS):
+        self.backend = backend
+        self.jobs = queue.Queue(maxsize=max_queued)
+        self.load_seconds = None
+        self.load_error = None
+        self.job_seconds = []
+        self._loaded = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{backend.name}-worker", daemon=True)
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if not self._started:
+                self._thread.start()
+                self._started = True
+        return self
+
+    def wait_until_loaded(self, timeout=None):
+        """Blocks until the models are loaded; raises if loading failed."""
+        self.start()
+        self._loaded.wait(timeout)
+        if self.load_error:
+            raise RuntimeError(f"{self.backend.name} backend failed to load: {self.load_error}")
+        return self.load_seconds
+
+    def submit(self, video_path, audio_path, output_path, guidance_scale=2.0, inference_steps=25, seed=1247,
+               prepared=None):
+        """Queues a job; prepared is the backend's prepare() output, if that stage already ran."""
+        self.start()
+        future = Future()
+        self.jobs.put((future, {'video_path': str(video_path), 'audio_path': str(audio_path),
+                                'output_path': str(output_path), 'guidance_scale': guidance_scale,
+                                'inference_steps': int(inference_steps), 'seed': int(seed),
+                                'prepared': prepared}))
+        return future
+
+    def run(self, *args, **kwargs):
+        """submit() and wait: returns {'output_path', 'job_seconds', 'load_seconds'}."""
+        return self.submit(*args, **kwargs).result()
+
+    def stats(self):
+        return {
+            'backend': self.backend.name,
+            'device': self.backend.device,
+            'load_seconds': self.load_seconds,
+            'jobs_done': len(self.job_seconds),
+            'mean_job_seconds': round(sum(self.job_seconds) / len(self.job_seconds), 2) if self.job_seconds else None,
+            'queued': self.jobs.qsize(),
+            'audio_feature_cache': self._cache_stats('audio_features'),
+            'face_alignment_cache': self._cache_stats('face_alignment'),
+        }
+
+    def _cache_stats(self, name):
+        cache = getattr(self.backend, name, None)
+        return cache.stats() if cache else None
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            self.backend.load()
+            self.load_seconds = round(time.perf_counter() - start, 2)
+            print(f"[{self.backend.name} worker] models loaded on {self.backend.device} in {self.load_seconds}s")
+        except Exception as e:
+            self.load_error = str(e)
+            print(f"[{self.backend.name} worker] model load failed: {e}")
+        self._loaded.set()
+        while True:
+            future, job = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                self._discard(job)
+                continue
+            if self.load_error:
+                self._discard(job)
+                future.set_exception(RuntimeError(f"{self.backend.name} backend failed to load: {self.load_error}"))
+                continue
+            job_start = time.perf_counter()
+            try:
+                self.backend.infer(**job)
+                output_path = Path(job['output_path'])
+                if not output_path.exists() or output_path.stat().st_size == 0:
+                    raise RuntimeError(f"Output file at {output_path} is empty or not created.")
+                job_seconds = round(time.perf_counter() - job_start, 2)
+                self.job_seconds.append(job_seconds)
+                print(f"[{self.backend.name} worker] {output_path.name} done in {job_seconds}s "
+                      f"(models loaded once in {self.load_seconds}s)")
+                future.set_result({'output_path': str(output_path.absolute()), 'job_seconds': job_seconds,
+                                   'load_seconds': self.load_seconds})
+            except Exception as e:
+                future.set_exception(e)
+
+    @staticmethod
+    def _discard(job):
+        if job.get('prepared'):
+            shutil.rmtree(job['prepared']['prepare_dir'], ignore_errors=True)
+
+
+def media_duration(path):
+    """Container duration in seconds (audio-only files too), or None if ffprobe can't tell."""
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0',
+                                 str(path)], check=True, capture_output=True, text=True)
+        return float(result.stdout.strip())
+    except (subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def plan_units(jobs, device_count):
+    """
+    Turns jobs into schedulable units, longest first. A job's length is its audio's (the output follows
+    the audio). A job longer than the batch's fair share per device, whose video covers its audio, is
+    cut into up to device_count frame-aligned segments of at least MIN_SEGMENT_SECONDS.
+    """
+    estimates = [media_duration(job['audio_path']) or 0.0 for job in jobs]
+    fair_share = sum(estimates) / max(1, device_count)
+    units = []
+    for job_index, (job, seconds) in enumerate(zip(jobs, estimates)):
+        pieces = 1
+        if device_count > 1 and seconds > fair_share and seconds >= 2 * MIN_SEGMENT_SECONDS:
+            video_seconds = media_duration(job['video_path']) or 0.0
+            if video_seconds >= seconds:
+                pieces = min(device_count, int(seconds // MIN_SEGMENT_SECONDS))
+        if pieces == 1:
+            units.append({'job_index': job_index, 'segment': None, 'start': 0.0, 'seconds': seconds})
+            continue
+        # Segment boundaries on whole frames, so the joined video keeps its frame timing.
+        frame_count = int(round(seconds * MODEL_FPS))
+        bounds = [round(frame_count * k / pieces) / MODEL_FPS for k in range(pieces + 1)]
+        for segment in range(pieces):
+            units.append({'job_index': job_index, 'segment': segment, 'segments': pieces, 'start': bounds[segment],
+                          'seconds': bounds[segment + 1] - bounds[segment] if segment < pieces - 1
+                          else seconds - bounds[segment]})
+    units.sort(key=lambda unit: -unit['seconds'])
+    return units
+
+
+def segments_dir_for(output_path):
+    return Path(output_path).parent / f".segments_{Path(output_path).stem}"
+
+
+def cut_segment(job, unit):
+    """The job's video and audio between unit['start'] and its end, as a job writing into the segments dir."""
+    segment_dir = segments_dir_for(job['output_path']) / str(unit['segment'])
+    segment_dir.mkdir(parents=True, exist_ok=True)
+    video_path, audio_path = segment_dir / "video.mp4", segment_dir / "audio.wav"
+    window = ['-ss', f"{unit['start']:.3f}", '-t', f"{unit['seconds']:.3f}"]
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error'] + window + ['-i', job['video_path'], '-an',
+                    '-r', str(MODEL_FPS), '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18',
+                    '-y', str(video_path)], check=True, capture_output=True, text=True)
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error'] + window + ['-i', job['audio_path'], '-vn',
+                    '-ac', '1', '-ar', str(MODEL_AUDIO_RATE), '-y', str(audio_path)],
+                   check=True, capture_output=True, text=True)
+    return dict(job, video_path=str(video_path), audio_path=str(audio_path),
+                output_path=str(segment_dir / "lipsync.mp4"))
+
+
+def join_segments(segment_paths, output_path):
+    """Concatenates the lipsynced segments of one job (video stream-copied, audio re-encoded)."""
+    list_path = Path(output_path).with_suffix(".segments.txt")
+    # Quoted like overlayer.write_concat_list (not imported: it isn't installed next to LatentSync).
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in segment_paths:
+            escaped = str(Path(path).absolute()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', str(list_path), '-c:v', 'copy', '-c:a', 'aac', '-y', str(output_path)],
+                       check=True, capture_output=True, text=True)
+    finally:
+        list_path.unlink(missing_ok=True)
+
+
+def run_pipeline(workers, jobs, prepare_workers=PREPARE_WORKERS):
+    """
+    Runs jobs (dicts of submit() arguments) on one worker per device (a single worker is fine too).
+    prepare_workers threads cut segments and run the backend's CPU prepare() stage, longest unit first,
+    into a queue bounded at PREFETCH_JOBS per device, which holds back preparation once it is full;
+    each device takes the next prepared unit whenever it is idle. Yields (job, result, error) in
+    completion order; result has 'prepare_seconds', 'devices' and 'segments' added.
+    """
+    if isinstance(workers, InferenceWorker):
+        workers = [workers]
+    healthy = []
+    for worker in workers:
+        try:
+            worker.wait_until_loaded()
+            healthy.append(worker)
+        except RuntimeError as e:
+            print(f"Leaving {worker.backend.device} out of the batch: {e}")
+    if not healthy:
+        raise RuntimeError("No inference worker could load its models.")
+    units = plan_units(jobs, len(healthy))
+    ready = queue.Queue(maxsize=len(healthy) * PREFETCH_JOBS)
+    results = queue.Queue()
+
+    def prepare(unit):
+        start = time.perf_counter()
+        try:
+            job = jobs[unit['job_index']]
+            unit_job = cut_segment(job, unit) if unit['segment'] is not None else job
+            prepared = healthy[0].backend.prepare(**unit_job)
+            # Blocks while the queue is full: backpressure on the CPU stage.
+            ready.put((unit, unit_job, prepared, round(time.perf_counter() - start, 2)))
+        except Exception as e:
+            results.put((unit, None, e))
+
+    def run_device(worker):
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            unit, unit_job, prepared, prepare_seconds = item
+            try:
+                result = worker.run(prepared=prepared, **unit_job)
+                results.put((unit, dict(result, prepare_seconds=prepare_seconds, device=worker.backend.device), None))
+            except Exception as e:
+                results.put((unit, None, e))
+
+    device_threads = [threading.Thread(target=run_device, args=(worker,), daemon=True) for worker in healthy]
+    for thread in device_threads:
+        thread.start()
+    segment_results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, prepare_workers)) as executor:
+            for unit in units:
+                executor.submit(prepare, unit)
+            for _ in units:
+                unit, result, error = results.get()
+                job = jobs[unit['job_index']]
+                if unit['segment'] is None:
+                    if result:
+                        result = dict(result, devices=[result.pop('device')], segments=1)
+                    yield job, result, error
+                    continue
+                done = segment_results.setdefault(unit['job_index'], {})
+                done[unit['segment']] = (result, error)
+                if len(done) < unit['segments']:
+                    continue
+                yield (job,) + _join_job(job, [done[k] for k in range(unit['segments'])])
+    finally:
+        for _ in device_threads:
+            ready.put(None)
+
+
+def _join_job(job, segment_outcomes):
+    """Joins a split job's segment outputs; returns (result, error)."""
+    try:
+        errors = [error for _, error in segment_outcomes if error]
+        if errors:
+            return None, errors[0]
+        results = [result for result, _ in segment_outcomes]
+        join_segments([result['output_path'] for result in results], job['output_path'])
+        # The segments ran concurrently, so the job took as long as its slowest segment.
+        return {'output_path': str(Path(job['output_path']).absolute()),
+                'job_seconds': max(result['job_seconds'] for result in results),
+                'prepare_seconds': round(sum(result['prepare_seconds'] for result in results), 2),
+                'load_seconds': results[0]['load_seconds'],
+                'devices': sorted({result['device'] for result in results}),
+                'segments': len(results)}, None
+    except Exception as e:
+        return None, e
+    finally:
+        shutil.rmtree(segments_dir_for(job['output_path']), ignore_errors=True)
+
+
+def device_names(backend_name=None):
+    """Devices to run workers on: LATENTSYNC_DEVICES, else every CUDA device (fake CPU ones for the stub)."""
+    configured = os.environ.get("LATENTSYNC_DEVICES")
+    if configured:
+        return [device.strip() for device in configured.split(",") if device.strip()]
+    if (backend_name or DEFAULT_BACKEND) == 'stub':
+        return [f"cpu:{k}" for k in range(max(1, STUB_DEVICES))]
+    import torch
+    return [f"cuda:{k}" for k in range(torch.cuda.device_count())] or ["cuda"]
+
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def get_workers(backend_name=None):
+    """The process-wide workers, one per device, started (and loading their models) on first use."""
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            backend_cls = BACKENDS[backend_name or DEFAULT_BACKEND]
+            _workers = [InferenceWorker(backend_cls(device=device)).start() for device in device_names(backend_name)]
+        return _workers
+
+
+def get_worker(backend_name=None):
+    """The worker single-video requests use: the first device's."""
+    return get_workers(backend_name)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a resident LatentSync worker: model load vs per-job time.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=DEFAULT_BACKEND)
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--audio", required=True)
+    parser.add_argument("--repeat", type=int, default=3, help="Jobs to run on the same loaded models.")
+    parser.add_argument("--output-dir", default="./outputs/worker_bench")
+    parser.add_argument("--inference-steps", type=int, default=25)
+    parser.add_argument("--guidance-scale", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1247)
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Prepare the next jobs on a CPU pool and schedule them across all devices.")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = get_workers(args.backend)
+    worker = workers[0]
+    worker.wait_until_loaded()
+    job_args = [{'video_path': args.video, 'audio_path': args.audio,
+                 'output_path': str(output_dir / f"{Path(args.video).stem}_{k}.mp4"),
+                 'guidance_scale': args.guidance_scale, 'inference_steps': args.inference_steps, 'seed': args.seed}
+                for k in range(args.repeat)]
+    start = time.perf_counter()
+    if args.pipeline:
+        jobs = []
+        for _, result, error in run_pipeline(workers, job_args):
+            if error:
+                raise error
+            jobs.append(result)
+    else:
+        jobs = [worker.run(**job) for job in job_args]
+    stats = worker.stats()
+    if args.pipeline:
+        stats['devices'] = [other.stats() for other in workers]
+    stats['batch_wall_seconds'] = round(time.perf_counter() - start, 2)
+    # What the same jobs would have cost with a model load per job, as before the worker.
+    stats['per_job_load_seconds_saved'] = round((stats['load_seconds'] or 0) * (len(jobs) - 1), 2)
+    print(json.dumps({'jobs': jobs, 'stats': stats}, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from pathlib import Path
+
+
+# Concurrent ffprobe processes used by probe_all.
+PROBE_WORKERS = 8
+
+_probe_memo = {}
+_keyframe_memo = {}
+_probe_memo_lock = threading.Lock()
+
+
+def _memo_key(path):
+    st = os.stat(path)
+    return (str(Path(path).absolute()), st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _parse_rate(rate):
+    try:
+        value = Fraction(rate)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return value if value > 0 else None
+
+
+def _stream_rotation(stream):
+    rotation = stream.get('tags', {}).get('rotate')
+    if rotation is None:
+        for side_data in stream.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = side_data['rotation']
+                break
+    try:
+        return int(float(rotation or 0)) % 360
+    except (TypeError, ValueError):
+        return 0
+
+
+def _parse_probe(path, probe):
+    streams = probe.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None:
+        return None
+    fps = _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')) or Fraction(30)
+    rotation = _stream_rotation(video)
+    coded_width, coded_height = int(video.get('width', 0)), int(video.get('height', 0))
+    # ffmpeg auto-rotates on decode, so filters see the display orientation.
+    width, height = (coded_height, coded_width) if rotation in (90, 270) else (coded_width, coded_height)
+    duration = probe.get('format', {}).get('duration') or video.get('duration')
+    return {
+        'path': str(path),
+        'width': width,
+        'height': height,
+        'coded_width': coded_width,
+        'coded_height': coded_height,
+        'rotation': rotation,
+        # Exact rational frame rate, e.g. "30000/1001", usable directly in ffmpeg filters.
+        'fps': f"{fps.numerator}/{fps.denominator}",
+        'fps_float': float(fps),
+        'duration': float(duration) if duration else 0.0,
+        'nb_frames': int(video['nb_frames']) if str(video.get('nb_frames', '')).isdigit() else None,
+        'video_codec': video.get('codec_name'),
+        'has_audio': audio is not None,
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'audio_sample_rate': int(audio['sample_rate']) if audio and audio.get('sample_rate') else None,
+    }
+
+
+def probe_media(path):
+    """
+    Returns stream metadata for a media file from `ffprobe -show_format -show_streams`, or None if
+    it has no readable video stream. Results are memoized per file (path, inode, size, mtime), so
+    repeated calls for an unchanged file don't start another ffprobe.
+    """
+    path = Path(path)
+    try:
+        memo_key = _memo_key(path)
+    except OSError:
+        return None
+    with _probe_memo_lock:
+        if memo_key in _probe_memo:
+            return _probe_memo[memo_key]
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams',
+                                 str(path)], check=True, capture_output=True, text=True)
+        info = _parse_probe(path, json.loads(result.stdout))
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"ffprobe failed for {path}: {getattr(e, 'stderr', None) or e}")
+        info = None
+    with _probe_memo_lock:
+        _probe_memo[memo_key] = info
+    return info
+
+
+def probe_all(paths, max_workers=PROBE_WORKERS):
+    """Probes all paths in one concurrent pass and returns {str(path): info or None}."""
+    unique_paths = list(dict.fromkeys(str(path) for path in paths))
+    if not unique_paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_paths)))) as executor:
+        return dict(zip(unique_paths, executor.map(probe_media, unique_paths)))
+
+
+def probe_keyframes(path):
+    """
+    Returns (frame_times, keyframe_times) of the first video stream, sorted, in seconds from the start
+    of the file as ffmpeg's -ss counts them, or None on failure. Reads packet headers only (no decoding)
+    and is memoized like probe_media.
+    """
+    try:
+        memo_key = _memo_key(path)
+    except OSError:
+        return None
+    with _probe_memo_lock:
+        if memo_key in _keyframe_memo:
+            return _keyframe_memo[memo_key]
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                                 'packet=pts_time,flags:format=start_time', '-of', 'json', str(path)],
+                                check=True, capture_output=True, text=True)
+        probe = json.loads(result.stdout)
+        start_time = float(probe.get('format', {}).get('start_time') or 0.0)
+        frame_times, keyframe_times = [], []
+        for packet in probe.get('packets', []):
+            try:
+                seconds = float(packet['pts_time']) - start_time
+            except (KeyError, ValueError):
+                continue
+            # Packets before the start are dropped by the edit list and never shown.
+            if seconds < 0:
+                continue
+            frame_times.append(seconds)
+            if 'K' in packet.get('flags', ''):
+                keyframe_times.append(seconds)
+        keyframes = (sorted(frame_times), sorted(keyframe_times))
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"ffprobe keyframe scan failed for {path}: {getattr(e, 'stderr', None) or e}")
+        keyframes = None
+    with _probe_memo_lock:
+        _keyframe_memo[memo_key] = keyframes
+    return keyframes
@@ -0,0 +1,485 @@
+"""
+Benchmarks for the avatar overlay pipeline.
+
+    python overlay_bench.py compositing --avatars 200
+    python overlay_bench.py suite --resolutions 1280x720 1920x1080 --avatar-counts 1 8 --output run.json
+    python overlay_bench.py compare baseline.json run.json --threshold 0.1
+    python overlay_bench.py chunking --duration 120 --chunk-counts 1 2 4 8
+    python overlay_bench.py calibrate --duration 20
+
+The suite builds synthetic main/avatar clips locally with ffmpeg lavfi sources and runs each
+scenario in a fresh child process (with its own empty cache directory unless --warm-cache),
+so peak RSS and cache state are measured per scenario.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from overlay_compositor import PreviewCompositor
+
+
+SUITE_MODES = ('previews', 'parallel', 'parallel-fanout', 'sequential', 'sequential-segmented')
+DEFAULT_SUITE_MODES = ('previews', 'parallel', 'sequential')
+SYNTHETIC_FPS = 30
+# Result fields compared by `compare`, with the direction that counts as a regression.
+HIGHER_IS_WORSE = ('wall_seconds', 'peak_rss_mb')
+LOWER_IS_WORSE = ('frames_per_second',)
+
+
+def make_synthetic_avatar(height, width, rng):
+    """Random noise 'person' on a pure green background, like a keyed avatar frame."""
+    avatar = np.zeros((height, width, 3), dtype=np.uint8)
+    avatar[:, :] = (0, 255, 0)
+    person = rng.integers(0, 256, size=(height // 2, width // 2, 3), dtype=np.uint8)
+    avatar[height // 4:height // 4 + person.shape[0], width // 4:width // 4 + person.shape[1]] = person
+    return avatar
+
+
+def reference_composite(background_bgr, avatar_bgr, x, y):
+    from overlayer import overlay_alpha, remove_green_background_with_alpha
+    avatar_rgba = remove_green_background_with_alpha(avatar_bgr)
+    background_rgb = cv2.cvtColor(background_bgr, cv2.COLOR_BGR2RGB)
+    composite_rgb = overlay_alpha(background_rgb.copy(), avatar_rgba, x, y)
+    return cv2.cvtColor(composite_rgb, cv2.COLOR_RGB2BGR)
+
+
+def bench_compositing(avatar_count, width, height, repeat, seed=0):
+    """
+    Times the float reference path against PreviewCompositor on the same synthetic previews
+    and checks that both agree within one LSB.
+    """
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    avatar_h, avatar_w = height // 3, height // 5
+    avatars = [make_synthetic_avatar(avatar_h, avatar_w, rng) for _ in range(avatar_count)]
+    positions = [(int(rng.integers(0, width // 2)), height - avatar_h) for _ in range(avatar_count)]
+
+    reference_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        reference_outputs = [reference_composite(background, avatar, x, y)
+                             for avatar, (x, y) in zip(avatars, positions)]
+        reference_times.append(time.perf_counter() - start)
+
+    compositor = PreviewCompositor()
+    fixed_point_times = []
+    for _ in range(repeat):
+        backgrounds = [background.copy() for _ in range(avatar_count)]
+        start = time.perf_counter()
+        fixed_point_outputs = compositor.composite_batch(
+            [(bg, avatar, x, y) for bg, avatar, (x, y) in zip(backgrounds, avatars, positions)])
+        fixed_point_times.append(time.perf_counter() - start)
+
+    max_abs_diff = max(int(np.abs(ref.astype(np.int16) - out.astype(np.int16)).max())
+                       for ref, out in zip(reference_outputs, fixed_point_outputs))
+    reference_best, fixed_point_best = min(reference_times), min(fixed_point_times)
+    return {
+        'benchmark': 'compositing',
+        'avatars': avatar_count,
+        'resolution': f"{width}x{height}",
+        'reference_seconds': round(reference_best, 4),
+        'fixed_point_seconds': round(fixed_point_best, 4),
+        'speedup': round(reference_best / fixed_point_best, 2) if fixed_point_best else None,
+        'max_abs_diff': max_abs_diff,
+        'within_one_lsb': max_abs_diff <= 1,
+    }
+
+
+# --- Synthetic Clips ---
+
+def parse_resolution(resolution):
+    width, height = (int(part) for part in resolution.lower().split('x'))
+    return width, height
+
+
+def make_synthetic_main(path, width, height, duration):
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate={SYNTHETIC_FPS}:duration={duration}",
+                    '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+                    '-y', str(path)], check=True, capture_output=True, text=True)
+
+
+def make_synthetic_avatar_clip(path, height, duration, variant):
+    """A portrait green-screen clip with a moving test pattern standing in for the person."""
+    height = height - height % 2
+    width = (height * 9 // 16) - (height * 9 // 16) % 2
+    filter_complex = (
+        f"color=c=0x00FF00:size={width}x{height}:rate={SYNTHETIC_FPS}:duration={duration}[bg];"
+        f"testsrc=size={width // 2}x{height // 2}:rate={SYNTHETIC_FPS}:duration={duration}[fg];"
+        f"[bg][fg]overlay=x='(W-w)/2+(W-w)/4*sin(t+{variant})':y=(H-h)/2[v];"
+        f"sine=frequency={500 + 20 * variant}:duration={duration}[a]"
+    )
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-filter_complex', filter_complex,
+                    '-map', '[v]', '-map', '[a]', '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', '-y', str(path)], check=True, capture_output=True, text=True)
+
+
+def prepare_inputs(work_dir, resolution, duration, avatar_count):
+    """Creates (or reuses) the synthetic inputs for one scenario and returns (main_path, avatar_paths)."""
+    width, height = parse_resolution(resolution)
+    input_dir = Path(work_dir) / "inputs"
+    input_dir.mkdir(parents=True, exist_ok=True)
+    main_path = input_dir / f"main_{width}x{height}_{duration}s.mp4"
+    if not main_path.exists():
+        make_synthetic_main(main_path, width, height, duration)
+    avatar_paths = []
+    for variant in range(avatar_count):
+        avatar_path = input_dir / f"avatar_{height}_{duration}s_{variant}.mp4"
+        if not avatar_path.exists():
+            make_synthetic_avatar_clip(avatar_path, height, duration, variant)
+        avatar_paths.append(str(avatar_path))
+    return str(main_path), avatar_paths
+
+
+# --- Scenarios ---
+
+class _BenchProgress:
+    """Progress sink with the parts of the gr.Progress interface the overlayer uses."""
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def tqdm(self, iterable, *args, **kwargs):
+        return iterable
+
+
+def scenario_id(scenario):
+    return f"{scenario['mode']}:{scenario['resolution']}:{scenario['duration']}s:{scenario['avatars']}av"
+
+
+def run_scenario(scenario):
+    """Runs one scenario in this process and returns its result dict."""
+    import overlayer
+
+    progress = _BenchProgress()
+    main_path, avatar_paths = prepare_inputs(scenario['work_dir'], scenario['resolution'], scenario['duration'],
+                                             scenario['avatars'])
+    random.seed(scenario.get('seed', 0))
+    mode = scenario['mode']
+    start = time.perf_counter()
+    video_params, preview_paths, _ = overlayer.generate_all_previews(main_path, avatar_paths, progress=progress)
+    preview_seconds = time.perf_counter() - start
+
+    if mode == 'previews':
+        wall_seconds = preview_seconds
+        output_paths = preview_paths
+        frames = len(preview_paths)
+        output_bytes = sum(os.path.getsize(path) for path in output_paths)
+    else:
+        # A fresh output directory per run: the app's folder keeps a render manifest, which would skip
+        # outputs already rendered by an earlier scenario or run and inflate the throughput.
+        renders_dir = Path(scenario['work_dir']) / "renders"
+        renders_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=renders_dir) as output_dir:
+            start = time.perf_counter()
+            output_paths = overlayer.render_videos(
+                main_path, avatar_paths, video_params, parallel_mode=mode.startswith('parallel'),
+                max_workers=scenario.get('workers'), fanout_mode=mode == 'parallel-fanout',
+                segment_cache_mode=mode == 'sequential-segmented', stream_zip=True, output_dir=output_dir,
+                progress=progress)[0]
+            wall_seconds = time.perf_counter() - start
+            output_bytes = sum(os.path.getsize(path) for path in output_paths)
+        # Parallel outputs last as long as the main clip; sequential ones play the avatar, then the main clip.
+        seconds_per_output = scenario['duration'] * (1 if mode.startswith('parallel') else 2)
+        frames = len(output_paths) * seconds_per_output * SYNTHETIC_FPS
+
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        'id': scenario_id(scenario),
+        'mode': mode,
+        'resolution': scenario['resolution'],
+        'duration': scenario['duration'],
+        'avatars': scenario['avatars'],
+        'outputs': len(output_paths),
+        'wall_seconds': round(wall_seconds, 3),
+        'frames_per_second': round(frames / wall_seconds, 2) if wall_seconds else None,
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'output_bytes': output_bytes,
+    }
+
+
+def run_scenario_in_child(scenario, warm_cache):
+    """Runs a scenario in a fresh interpreter so peak RSS and cache state are per scenario."""
+    env = os.environ.copy()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if not warm_cache:
+            env["OVERLAY_CACHE_DIR"] = cache_dir
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "scenario", json.dumps(scenario)],
+                                capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        return {'id': scenario_id(scenario), 'error': result.stderr.strip()[-2000:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# --- Chunked Encoding ---
+
+def count_video_frames(path):
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+                             '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', str(path)],
+                            check=True, capture_output=True, text=True)
+    return int(result.stdout.strip())
+
+
+def video_psnr(path, reference_path):
+    """Average PSNR (dB) of path against reference_path, frame by frame; None if ffmpeg reports none."""
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-i', str(path), '-i', str(reference_path),
+                             '-lavfi', '[0:v][1:v]psnr', '-f', 'null', '-'], capture_output=True, text=True)
+    match = re.search(r"average:(inf|[\d.]+)", result.stderr)
+    return float(match.group(1)) if match else None
+
+
+def fixed_layout(main_info, avatar_info):
+    """A deterministic layout: a slight zoom with the avatar a third of the frame high, bottom left."""
+    width, height = main_info['width'], main_info['height']
+    zoom_factor = 1.1
+    avatar_h = height // 3
+    return {'zoom_factor': zoom_factor, 'crop_x': int(width - width / zoom_factor) // 2,
+            'crop_y': int(height - height / zoom_factor) // 2, 'scaled_avatar_h': avatar_h,
+            'scaled_avatar_w': int(avatar_h * avatar_info['width'] / avatar_info['height']),
+            'x_pos': width // 8, 'y_pos': height - avatar_h}
+
+
+def bench_chunking(resolution, duration, chunk_counts, work_dir, threads=None):
+    """
+    Renders one avatar over a synthetic main clip in a single pass and then chunked with each chunk
+    count, reporting the wall time, the speedup over the single pass, and whether the chunked output
+    has the same frames (frame count and PSNR against the single-pass render).
+    """
+    import overlayer
+    from media_probe import probe_media
+
+    main_path, avatar_paths = prepare_inputs(work_dir, resolution, duration, 1)
+    main_info, avatar_info = probe_media(main_path), probe_media(avatar_paths[0])
+    width, height = main_info['width'], main_info['height']
+    params = fixed_layout(main_info, avatar_info)
+    threads = threads or os.cpu_count() or 1
+    output_dir = Path(work_dir) / "chunking"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    single_path = output_dir / "single_pass.mp4"
+    start = time.perf_counter()
+    overlayer.run_ffmpeg_job(overlayer.build_overlay_command(main_path, avatar_paths[0], params, width, height,
+                                                             main_info['fps'], True, single_path, threads=threads,
+                                                             main_info=main_info, avatar_info=avatar_info))
+    single_seconds = time.perf_counter() - start
+    reference_frames = count_video_frames(single_path)
+
+    results = []
+    for chunk_count in chunk_counts:
+        output_path = output_dir / f"chunked_{chunk_count}.mp4"
+        start = time.perf_counter()
+        chunks_used = overlayer.render_parallel_chunked(main_path, avatar_paths[0], params, width, height,
+                                                        main_info['fps'], output_path, chunk_count, threads=threads,
+                                                        main_info=main_info, avatar_info=avatar_info)
+        wall_seconds = time.perf_counter() - start
+        frames = count_video_frames(output_path)
+        results.append({
+            'chunk_count': chunk_count,
+            'chunks_used': chunks_used,
+            'wall_seconds': round(wall_seconds, 3),
+            'speedup': round(single_seconds / wall_seconds, 2) if wall_seconds else None,
+            'frames': frames,
+            'frames_match': frames == reference_frames,
+            'psnr_vs_single_pass_db': video_psnr(output_path, single_path),
+        })
+    return {
+        'host': {'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+        'resolution': resolution,
+        'duration': duration,
+        'threads': threads,
+        'single_pass': {'wall_seconds': round(single_seconds, 3), 'frames': reference_frames},
+        'chunked': results,
+    }
+
+
+# --- Encode Profile Calibration ---
+
+def calibrate_encode_profiles(resolution, duration, work_dir, workers=None, profiles=None):
+    """
+    Measures each encode profile's batch throughput on this host: `workers` parallel-mode renders of a
+    synthetic clip run at once (as a UI batch would), and the output frames over the wall time give
+    the profile's batch fps. The result is what overlayer's render time estimates read.
+    """
+    import overlayer
+    from media_probe import probe_media
+
+    workers = workers or overlayer.default_render_workers()
+    main_path, avatar_paths = prepare_inputs(work_dir, resolution, duration, workers)
+    main_info = probe_media(main_path)
+    avatar_infos = [probe_media(path) for path in avatar_paths]
+    threads = overlayer.threads_per_render_job(workers)
+    output_dir = Path(work_dir) / "calibration"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    for name in profiles or list(overlayer.ENCODE_PROFILES):
+        profile = overlayer.encode_profile(name)
+        commands = [overlayer.build_overlay_command(main_path, avatar_path, fixed_layout(main_info, avatar_info),
+                                                    main_info['width'], main_info['height'], main_info['fps'], True,
+                                                    output_dir / f"{name}_{k}.mp4", threads=threads,
+                                                    main_info=main_info, avatar_info=avatar_info, profile=profile)
+                    for k, (avatar_path, avatar_info) in enumerate(zip(avatar_paths, avatar_infos))]
+        print(f"Calibrating {name} with {workers} concurrent renders...", file=sys.stderr)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(overlayer.run_ffmpeg_job, commands))
+        wall_seconds = time.perf_counter() - start
+        frames = sum(count_video_frames(output_dir / f"{name}_{k}.mp4") for k in range(len(commands)))
+        results[name] = {'settings': profile, 'wall_seconds': round(wall_seconds, 3), 'frames': frames,
+                         'batch_fps': round(frames / wall_seconds, 2) if wall_seconds else None}
+    return {
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'width': main_info['width'],
+        'height': main_info['height'],
+        'duration': duration,
+        'workers': workers,
+        'profiles': results,
+    }
+
+
+def run_suite(resolutions, durations, avatar_counts, modes, work_dir, workers=None, warm_cache=False):
+    results = []
+    for resolution in resolutions:
+        for duration in durations:
+            for avatar_count in avatar_counts:
+                for mode in modes:
+                    scenario = {'mode': mode, 'resolution': resolution, 'duration': duration,
+                                'avatars': avatar_count, 'work_dir': str(work_dir), 'workers': workers}
+                    print(f"Running {scenario_id(scenario)}...", file=sys.stderr)
+                    results.append(run_scenario_in_child(scenario, warm_cache))
+    return {
+        'host': {'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare_runs(baseline, candidate, threshold):
+    """
+    Returns a list of regressions between two suite runs, one dict per scenario metric that got
+    worse by more than threshold (a fraction, e.g. 0.1 = 10%).
+    """
+    baseline_results = {result['id']: result for result in baseline['results'] if 'error' not in result}
+    regressions = []
+    for result in candidate['results']:
+        before = baseline_results.get(result['id'])
+        if before is None or 'error' in result:
+            continue
+        for field in HIGHER_IS_WORSE + LOWER_IS_WORSE:
+            old_value, new_value = before.get(field), result.get(field)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            if (field in HIGHER_IS_WORSE and change > threshold) or (field in LOWER_IS_WORSE and -change > threshold):
+                regressions.append({'id': result['id'], 'metric': field, 'baseline': old_value,
+                                    'candidate': new_value, 'change': round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the avatar overlay pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compositing_parser = subparsers.add_parser("compositing", help="Preview compositing microbenchmark.")
+    compositing_parser.add_argument("--avatars", type=int, default=100)
+    compositing_parser.add_argument("--width", type=int, default=1920)
+    compositing_parser.add_argument("--height", type=int, default=1080)
+    compositing_parser.add_argument("--repeat", type=int, default=3)
+
+    suite_parser = subparsers.add_parser("suite", help="End-to-end preview/render benchmarks on synthetic clips.")
+    suite_parser.add_argument("--resolutions", nargs="+", default=["640x360", "1280x720", "1920x1080"])
+    suite_parser.add_argument("--durations", nargs="+", type=int, default=[5])
+    suite_parser.add_argument("--avatar-counts", nargs="+", type=int, default=[1, 4])
+    suite_parser.add_argument("--modes", nargs="+", choices=SUITE_MODES, default=list(DEFAULT_SUITE_MODES))
+    suite_parser.add_argument("--workers", type=int, default=None, help="Render pool size (default: core-aware).")
+    suite_parser.add_argument("--work-dir", default=str(Path(tempfile.gettempdir()) / "overlay_bench"))
+    suite_parser.add_argument("--warm-cache", action="store_true", help="Keep the shared overlay caches.")
+    suite_parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions between two suite runs.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    chunking_parser = subparsers.add_parser("chunking", help="Chunked parallel encoding speedup vs chunk count.")
+    chunking_parser.add_argument("--resolution", default="1920x1080")
+    chunking_parser.add_argument("--duration", type=int, default=120)
+    chunking_parser.add_argument("--chunk-counts", nargs="+", type=int, default=[1, 2, 4, 8])
+    chunking_parser.add_argument("--threads", type=int, default=None,
+                                 help="Thread budget of the job (default: all cores).")
+    chunking_parser.add_argument("--work-dir", default=str(Path(tempfile.gettempdir()) / "overlay_bench"))
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="Measure each encode profile's batch fps on this "
+                                                               "host for the UI's render time estimates.")
+    calibrate_parser.add_argument("--resolution", default="1920x1080")
+    calibrate_parser.add_argument("--duration", type=int, default=20)
+    calibrate_parser.add_argument("--workers", type=int, default=None,
+                                  help="Concurrent renders, as in a UI batch (default: core-aware).")
+    calibrate_parser.add_argument("--profiles", nargs="+", default=None, help="Profiles to measure (default: all).")
+    calibrate_parser.add_argument("--work-dir", default=str(Path(tempfile.gettempdir()) / "overlay_bench"))
+    calibrate_parser.add_argument("--output", default=None,
+                                  help="Where to write the calibration (default: overlayer's calibration file).")
+
+    scenario_parser = subparsers.add_parser("scenario", help=argparse.SUPPRESS)
+    scenario_parser.add_argument("scenario_json")
+
+    args = parser.parse_args()
+    if args.command == "compositing":
+        result = bench_compositing(args.avatars, args.width, args.height, args.repeat)
+        print(json.dumps(result, indent=2))
+    elif args.command == "suite":
+        report = run_suite(args.resolutions, args.durations, args.avatar_counts, args.modes, args.work_dir,
+                           workers=args.workers, warm_cache=args.warm_cache)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+    elif args.command == "compare":
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.candidate, "r", encoding="utf-8") as f:
+            candidate = json.load(f)
+        regressions = compare_runs(baseline, candidate, args.threshold)
+        print(json.dumps({'threshold': args.threshold, 'regressions': regressions}, indent=2))
+        sys.exit(1 if regressions else 0)
+    elif args.command == "chunking":
+        result = bench_chunking(args.resolution, args.duration, args.chunk_counts, args.work_dir, threads=args.threads)
+        print(json.dumps(result, indent=2))
+    elif args.command == "calibrate":
+        import overlayer
+
+        output_path = Path(args.output) if args.output else overlayer.ENCODE_CALIBRATION_PATH
+        calibration = calibrate_encode_profiles(args.resolution, args.duration, args.work_dir, workers=args.workers,
+                                                profiles=args.profiles)
+        previous = overlayer.load_encode_calibration(output_path)
+        # Profiles not measured this time keep their earlier numbers if the clip size matches.
+        if previous and (previous['width'], previous['height']) == (calibration['width'], calibration['height']):
+            calibration['profiles'] = {**previous['profiles'], **calibration['profiles']}
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(calibration, f, indent=2)
+        print(json.dumps(calibration, indent=2))
+    elif args.command == "scenario":
+        print(json.dumps(run_scenario(json.loads(args.scenario_json))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+import fcntl
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from media_probe import probe_media
+
+
+CACHE_ROOT = Path(os.environ.get("OVERLAY_CACHE_DIR", Path(__file__).parent / "cache"))
+FIRST_FRAME_CACHE_DIR = CACHE_ROOT / "first_frames"
+FIRST_FRAME_CACHE_MAX_BYTES = 2 * 1024 ** 3
+KEYED_AVATAR_CACHE_DIR = CACHE_ROOT / "keyed_avatars"
+KEYED_AVATAR_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Bump when the intermediate's codec/pixel format changes so old entries stop matching.
+KEYED_AVATAR_FORMAT = "ffv1-yuva444p-v1"
+MAIN_SEGMENT_CACHE_DIR = CACHE_ROOT / "main_segments"
+MAIN_SEGMENT_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+
+def file_fingerprint(path):
+    """Cheap identity of a file's current contents: (device, inode, size, mtime) hashed."""
+    st = os.stat(path)
+    identity = f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    """SHA-256 of the file contents, for caches that must survive copies and re-downloads."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Bytes read from each of the start, middle and end of a file by sampled_content_hash.
+SAMPLED_HASH_CHUNK = 4 * 1024 * 1024
+
+_sampled_hash_memo = {}
+_sampled_hash_memo_lock = threading.Lock()
+
+
+def sampled_content_hash(path):
+    """
+    Content identity that survives re-uploads and copies without reading whole multi-GB videos:
+    SHA-256 of the size plus 4 MiB from the start, middle and end of the file. Memoized per
+    file_fingerprint for the life of the process.
+    """
+    fingerprint = file_fingerprint(path)
+    with _sampled_hash_memo_lock:
+        if fingerprint in _sampled_hash_memo:
+            return _sampled_hash_memo[fingerprint]
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - SAMPLED_HASH_CHUNK // 2), max(0, size - SAMPLED_HASH_CHUNK)}):
+            f.seek(offset)
+            digest.update(f.read(SAMPLED_HASH_CHUNK))
+    value = digest.hexdigest()
+    with _sampled_hash_memo_lock:
+        _sampled_hash_memo[fingerprint] = value
+    return value
+
+
+def directory_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+class DiskLRUCache:
+    """
+    A directory of cache entries with a size cap and least-recently-used eviction.
+
+    Each entry is a sub-directory holding whatever files the writer puts there, plus a small JSON
+    metadata dict kept in index.json. Entries are written to a temporary directory and renamed
+    into place, so readers never see half-written entries. Safe to share between threads; with
+    shared=True also between processes, at the cost of re-reading the index under a file lock
+    on every call. Within a process, open caches with for_directory so every user of a directory
+    works on the same index.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, cache_dir, max_bytes, shared=False):
+        """
+        The process-wide cache of cache_dir. Separate instances on one directory would each write back
+        only their own index, dropping the others' entries while leaving their files on disk.
+        """
+        key = str(Path(cache_dir).absolute())
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(cache_dir, max_bytes, shared=shared)
+            return cls._instances[key]
+
+    def __init__(self, cache_dir, max_bytes, shared=False):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.cache_dir / "index.json"
+        self._lock_path = self.cache_dir / "index.lock"
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._index = self._load_index()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if not self.shared:
+                yield
+                return
+            with open(self._lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Pick up entries other processes added or evicted since our last call.
+                self._index = self._load_index()
+                yield
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Drop entries whose directory disappeared (e.g. cleaned up by hand).
+        return {key: entry for key, entry in index.items() if self._entry_dir(key).is_dir()}
+
+    def _entry_dir(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def _write_index(self):
+        tmp_path = self._index_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def flush(self):
+        """Persists access times recorded by get()."""
+        with self._locked():
+            if self._dirty:
+                self._write_index()
+
+    def get(self, key):
+        """Returns (entry_dir, meta) for a cached entry, or (None, None) on a miss."""
+        with self._locked():
+            entry = self._index.get(key)
+            if entry is None:
+                return None, None
+            entry_dir = self._entry_dir(key)
+            if not entry_dir.is_dir():
+                del self._index[key]
+                self._dirty = True
+                return None, None
+            entry['last_access'] = time.time()
+            self._dirty = True
+            if self.shared:
+                self._write_index()
+            return entry_dir, entry['meta']
+
+    def put(self, key, meta, write_files):
+        """
+        Stores an entry. write_files(entry_dir) writes the entry's files into a fresh directory.
+        Returns the final entry directory.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir.with_name(f"{key}.tmp{os.getpid()}_{threading.get_ident()}")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+        try:
+            write_files(tmp_dir)
+            size = directory_size(tmp_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        with self._locked():
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir)
+            os.replace(tmp_dir, entry_dir)
+            self._index[key] = {'size': size, 'last_access': time.time(), 'meta': meta}
+            self._evict(keep_key=key)
+            self._write_index()
+        return entry_dir
+
+    def remove(self, key):
+        with self._locked():
+            if self._index.pop(key, None) is not None:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                self._write_index()
+
+    def total_bytes(self):
+        with self._locked():
+            return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self, keep_key=None):
+        total = sum(entry['size'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            total -= self._index.pop(key)['size']
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+
+class FirstFrameCache:
+    """
+    Caches the first frame and basic stream info (width, height, fps, duration) of video files,
+    keyed by file_fingerprint. Frames can be stored downscaled to the largest size a caller needs,
+    so avatar entries stay small; an entry is reused as long as it is at least as large as requested.
+    """
+
+    def __init__(self, cache_dir=FIRST_FRAME_CACHE_DIR, max_bytes=FIRST_FRAME_CACHE_MAX_BYTES):
+        self.cache = DiskLRUCache.for_directory(cache_dir, max_bytes)
+
+    def load(self, video_path, max_height=None):
+        """
+        Returns (first_frame_bgr, info) where info has the *original* width/height/fps/duration,
+        or (None, None) if the video can't be read. With max_height, the returned frame may be
+        downscaled (aspect preserved) to no less than max_height rows.
+        """
+        key = file_fingerprint(video_path)
+        entry_dir, info = self.cache.get(key)
+        if entry_dir is not None:
+            wanted_height = info['height'] if max_height is None else min(int(max_height), info['height'])
+            if info['stored_height'] >= wanted_height:
+                try:
+                    return np.load(entry_dir / "frame.npy"), info
+                except (OSError, ValueError):
+                    self.cache.remove(key)
+
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            return None, None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        ret, frame = cap.read()
+        cap.release()
+        if not ret:
+            return None, None
+        height, width = frame.shape[:2]
+        duration = frame_count / fps if fps else 0.0
+        # Prefer ffprobe's exact rate/duration over the container guesses cv2 reports.
+        probe = probe_media(video_path)
+        if probe:
+            fps, duration = probe['fps_float'], probe['duration']
+        if max_height is not None and height > max_height:
+            stored_height = int(math.ceil(max_height))
+            stored_width = max(1, int(round(width * stored_height / height)))
+            frame = cv2.resize(frame, (stored_width, stored_height), interpolation=cv2.INTER_AREA)
+        info = {
+            'width': width,
+            'height': height,
+            'fps': fps,
+            'duration': duration,
+            'stored_height': frame.shape[0],
+        }
+        self.cache.put(key, info, lambda entry_dir: np.save(entry_dir / "frame.npy", frame))
+        return frame, info
+
+    def flush(self):
+        self.cache.flush()
+
+
+class KeyedAvatarCache:
+    """
+    Chroma-keys each avatar once into a lossless FFV1/yuva444p intermediate (avatar audio stream-copied
+    alongside) and caches it keyed by the avatar's file_fingerprint plus the key filter settings.
+    Renders that use the intermediate only need to scale and overlay it.
+    """
+
+    def __init__(self, key_filter, cache_dir=KEYED_AVATAR_CACHE_DIR, max_bytes=KEYED_AVATAR_CACHE_MAX_BYTES):
+        self.key_filter = key_filter
+        self.cache = DiskLRUCache.for_directory(cache_dir, max_bytes)
+
+    def cache_key(self, avatar_path):
+        identity = f"{file_fingerprint(avatar_path)}|{self.key_filter}|{KEYED_AVATAR_FORMAT}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def build_command(self, avatar_path, output_path, threads=None):
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(avatar_path),
+                   '-map', '0:v:0', '-map', '0:a?',
+                   '-vf', f"format=yuv444p,{self.key_filter},format=yuva444p",
+                   '-c:v', 'ffv1', '-level', '3']
+        if threads:
+            command.extend(['-threads', str(threads)])
+        command.extend(['-c:a', 'copy', '-y', str(output_path)])
+        return command
+
+    def get_or_build(self, avatar_path, threads=None):
+        """Returns (keyed_path, cache_hit). Raises subprocess.CalledProcessError if keying fails."""
+        key = self.cache_key(avatar_path)
+        entry_dir, _ = self.cache.get(key)
+        if entry_dir is not None and (entry_dir / "keyed.mkv").exists():
+            return entry_dir / "keyed.mkv", True
+
+        def write_files(tmp_dir):
+            subprocess.run(self.build_command(avatar_path, tmp_dir / "keyed.mkv", threads),
+                           check=True, capture_output=True, text=True)
+
+        entry_dir = self.cache.put(key, {'source': str(avatar_path), 'key_filter': self.key_filter}, write_files)
+        return entry_dir / "keyed.mkv", False
+
+    def flush(self):
+        self.cache.flush()
+
+
+class SegmentCache:
+    """
+    Caches ffmpeg-rendered segments keyed by a list of key parts (input fingerprints, filter and
+    encoder settings). Builds of the same key are serialized across the process (every instance on
+    a directory shares its locks), so concurrent jobs that need the same segment render it once and
+    the others reuse it.
+    """
+
+    _key_locks = {}
+    _key_locks_guard = threading.Lock()
+
+    def __init__(self, cache_dir=MAIN_SEGMENT_CACHE_DIR, max_bytes=MAIN_SEGMENT_CACHE_MAX_BYTES):
+        self.cache = DiskLRUCache.for_directory(cache_dir, max_bytes)
+
+    def _lock_for(self, key):
+        with self._key_locks_guard:
+            return self._key_locks.setdefault((str(self.cache.cache_dir.absolute()), key), threading.Lock())
+
+    def get_or_build(self, key_parts, build_command, filename="segment.mp4", run_command=None):
+        """
+        Returns (segment_path, cache_hit). On a miss, runs build_command(output_path) (through
+        run_command if given) and caches the result. Raises subprocess.CalledProcessError if the build fails.
+        """
+        key = hashlib.sha1("|".join(str(part) for part in key_parts).encode()).hexdigest()
+        with self._lock_for(key):
+            entry_dir, _ = self.cache.get(key)
+            if entry_dir is not None and (entry_dir / filename).exists():
+                return entry_dir / filename, True
+
+            def write_files(tmp_dir):
+                command = build_command(tmp_dir / filename)
+                if run_command:
+                    run_command(command)
+                else:
+                    subprocess.run(command, check=True, capture_output=True, text=True)
+
+            entry_dir = self.cache.put(key, {'key_parts': [str(part) for part in key_parts]}, write_files)
+            return entry_dir / filename, False
+
+    def flush(self):
+        self.cache.flush()
+
+
+class RenderManifest:
+    """
+    Build-system style record of which render key produced each output file in a directory.
+
+    An output is up to date when the manifest has the same key for it and the file still has the
+    size and mtime recorded when it was finished, so partially written or replaced files re-render.
+    Outputs are recorded one by one as they finish, which lets an interrupted batch resume.
+    """
+
+    FILENAME = "render_manifest.json"
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, output_dir):
+        """The process-wide manifest of output_dir, so concurrent batches there keep each other's records."""
+        key = str(Path(output_dir).absolute())
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(output_dir)
+            return cls._instances[key]
+
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / self.FILENAME
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def is_up_to_date(self, output_path, render_key):
+        entry = self._entries.get(Path(output_path).name)
+        if not entry or entry['key'] != render_key:
+            return False
+        try:
+            st = os.stat(output_path)
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime_ns']
+
+    def record(self, output_path, render_key):
+        st = os.stat(output_path)
+        with self._lock:
+            self._entries[Path(output_path).name] = {'key': render_key, 'size': st.st_size,
+                                                     'mtime_ns': st.st_mtime_ns, 'recorded': time.time()}
+            tmp_path = self.path.with_suffix(f".tmp{os.getpid()}")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, indent=1)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,282 @@
+"""
+Headless batch rendering for the avatar overlay pipeline, driven by a JSON or CSV manifest.
+
+    python overlay_cli.py manifest.json --workers 4
+    python overlay_cli.py manifest.csv --jobs 2 --workers 4 --report report.json
+
+A JSON manifest is a list of jobs (or {"jobs": [...]}); each job is one main video with its avatars:
+
+    {"main": "main.mp4", "avatars": ["a.mp4", "b.mp4"], "mode": "parallel", "seed": 7,
+     "layouts": [{"zoom_factor": 1.1, "crop_x": 40, ...}, null],
+     "chunked": false, "fanout": false, "prekey": false, "segment_cache": true, "output_dir": "renders/",
+     "profile": "final"}
+
+profile is an overlayer encode profile (draft, review or final; final by default). Without output_dir,
+a job renders into its own directory, generated_videos/cli/<main video name>_<job id>, since outputs are
+named after the avatar alone and jobs sharing an avatar would overwrite each other. Jobs that do share an
+output_dir must not render the same avatar name in the same mode.
+
+A CSV manifest has one avatar per row with the columns main, avatar and optionally mode, seed,
+output_dir, profile, chunked, fanout, prekey, segment_cache and the layout columns (zoom_factor, crop_x, crop_y,
+scaled_avatar_w, scaled_avatar_h, x_pos, y_pos). Rows with the same main video and settings form one job.
+
+Avatars without a layout get a random one (seeded per job) and a thumbnail preview, exactly like the
+"Generate Previews" button. Resolved layouts are saved next to the manifest (<manifest>.layouts.json)
+and every output directory keeps a render manifest, so running the same command again resumes:
+finished, unchanged videos are skipped and the rest render with the same layouts.
+
+Importing this module (or overlayer) does not build or launch the Gradio app.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import overlayer
+
+
+LAYOUT_FIELDS = ('zoom_factor', 'crop_x', 'crop_y', 'scaled_avatar_w', 'scaled_avatar_h', 'x_pos', 'y_pos')
+FLAG_FIELDS = ('chunked', 'fanout', 'prekey', 'segment_cache')
+FLAG_DEFAULTS = {'chunked': False, 'fanout': False, 'prekey': False, 'segment_cache': True}
+# Layouts come from the global random module, so seeding and drawing them is serialized across jobs.
+_layout_lock = threading.Lock()
+
+
+class ConsoleProgress:
+    """Progress sink with the parts of the gr.Progress interface the overlayer uses, printed to stderr."""
+
+    def __init__(self, label="", min_interval=2.0):
+        self.label = label
+        self.min_interval = min_interval
+        self._last_printed = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, fraction=None, desc=None, *args, **kwargs):
+        now = time.time()
+        with self._lock:
+            if now - self._last_printed < self.min_interval and fraction not in (0, 1):
+                return self
+            self._last_printed = now
+        percent = f"{fraction * 100:5.1f}% " if isinstance(fraction, (int, float)) else ""
+        print(f"[{self.label}] {percent}{desc or ''}", file=sys.stderr)
+        return self
+
+    def tqdm(self, iterable, *args, desc=None, **kwargs):
+        if desc:
+            self(0, desc=desc)
+        return iterable
+
+
+def _parse_flag(value, default):
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def _parse_layout(row):
+    """Layout params from a CSV row or JSON dict, or None if any field is missing."""
+    if not row or any(row.get(field) in (None, "") for field in LAYOUT_FIELDS):
+        return None
+    return {field: float(row[field]) if field == 'zoom_factor' else int(float(row[field]))
+            for field in LAYOUT_FIELDS}
+
+
+def normalize_job(job, base_dir):
+    """Fills in defaults and resolves paths relative to the manifest's directory."""
+    def resolve(path):
+        return str(path if Path(path).is_absolute() else Path(base_dir) / path)
+
+    avatars = job.get('avatars') or ([job['avatar']] if job.get('avatar') else [])
+    layouts = list(job.get('layouts') or [])
+    layouts += [None] * (len(avatars) - len(layouts))
+    mode = str(job.get('mode') or 'parallel').lower()
+    if mode not in ('parallel', 'sequential'):
+        raise ValueError(f"Unknown mode {mode!r} for {job.get('main')}; use 'parallel' or 'sequential'")
+    normalized = {
+        'main': resolve(job['main']),
+        'avatars': [resolve(path) for path in avatars],
+        'layouts': [_parse_layout(layout) for layout in layouts[:len(avatars)]],
+        'mode': mode,
+        'seed': int(job['seed']) if job.get('seed') not in (None, "") else 0,
+        'output_dir': resolve(job['output_dir']) if job.get('output_dir') else None,
+        'profile': job.get('profile') or overlayer.DEFAULT_ENCODE_PROFILE,
+    }
+    overlayer.encode_profile(normalized['profile'])
+    for flag in FLAG_FIELDS:
+        normalized[flag] = _parse_flag(job.get(flag), FLAG_DEFAULTS[flag])
+    if not normalized['output_dir']:
+        job_dir = f"{Path(normalized['main']).stem}_{job_id(normalized)[:8]}"
+        normalized['output_dir'] = str(overlayer.GENERATED_VIDEOS_DIR / "cli" / job_dir)
+    return normalized
+
+
+def check_output_collisions(jobs):
+    """Raises ValueError if two jobs would render to the same output file."""
+    owners = {}
+    for job in jobs:
+        for avatar in job['avatars']:
+            output_path = Path(job['output_dir']).absolute() / overlayer.output_filename(avatar,
+                                                                                         job['mode'] == 'parallel')
+            owner = owners.setdefault(output_path, job)
+            if job_id(owner) != job_id(job):
+                raise ValueError(f"Jobs for {owner['main']} and {job['main']} would both render {output_path}; "
+                                 f"give them different output_dir values")
+
+
+def load_manifest(manifest_path):
+    """Reads a JSON or CSV manifest into a list of normalized jobs."""
+    manifest_path = Path(manifest_path)
+    base_dir = manifest_path.parent
+    if manifest_path.suffix.lower() == '.csv':
+        jobs = {}
+        with open(manifest_path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                group = (row['main'], row.get('mode') or 'parallel', row.get('seed') or '', row.get('output_dir') or '',
+                         row.get('profile') or '', tuple(row.get(flag) or '' for flag in FLAG_FIELDS))
+                job = jobs.setdefault(group, dict(row, avatars=[], layouts=[]))
+                job['avatars'].append(row['avatar'])
+                job['layouts'].append(row)
+        raw_jobs = list(jobs.values())
+    else:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        raw_jobs = data['jobs'] if isinstance(data, dict) else data
+    jobs = [normalize_job(job, base_dir) for job in raw_jobs]
+    check_output_collisions(jobs)
+    return jobs
+
+
+def job_id(job):
+    identity = {key: job[key] for key in ('main', 'avatars', 'mode', 'seed')}
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class LayoutStore:
+    """The resolved layouts of every job, saved after each job so a resumed run reuses them."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._layouts = json.load(f)
+        except (OSError, ValueError):
+            self._layouts = {}
+
+    def get(self, job):
+        return self._layouts.get(job_id(job), {})
+
+    def save(self, job, layouts_by_avatar):
+        with self._lock:
+            self._layouts[job_id(job)] = layouts_by_avatar
+            tmp_path = self.path.with_suffix(f".tmp{os.getpid()}")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._layouts, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def resolve_layouts(job, saved, progress):
+    """
+    Returns {avatar_path: layout} for the job: explicit layouts first, then ones saved by an earlier
+    run, then fresh random layouts (with thumbnail previews) for the rest, seeded by the job.
+    """
+    layouts = dict(saved)
+    layouts.update({avatar: layout for avatar, layout in zip(job['avatars'], job['layouts']) if layout})
+    missing = [avatar for avatar in job['avatars'] if avatar not in layouts]
+    if missing:
+        with _layout_lock:
+            random.seed(job['seed'])
+            video_params, _, preview_avatars = overlayer.generate_all_previews(job['main'], missing,
+                                                                               progress=progress)
+        layouts.update(zip(preview_avatars, video_params))
+    return {avatar: layouts[avatar] for avatar in job['avatars'] if avatar in layouts}
+
+
+def render_job(job, layout_store, workers=None, label=""):
+    """Lays out and renders one job through overlayer.render_videos; returns a result dict."""
+    progress = ConsoleProgress(label or Path(job['main']).name)
+    start = time.perf_counter()
+    layouts = resolve_layouts(job, layout_store.get(job), progress)
+    layout_store.save(job, layouts)
+    avatars = [avatar for avatar in job['avatars'] if avatar in layouts]
+    skipped = [avatar for avatar in job['avatars'] if avatar not in layouts]
+    output_paths, _, _, status, _ = overlayer.render_videos(
+        job['main'], avatars, [layouts[avatar] for avatar in avatars], job['mode'] == 'parallel',
+        max_workers=workers, fanout_mode=job['fanout'], prekey_mode=job['prekey'], stream_zip=True,
+        segment_cache_mode=job['segment_cache'], chunked_mode=job['chunked'], encode_profile_name=job['profile'],
+        output_dir=job['output_dir'], progress=progress)
+    return {
+        'main': job['main'],
+        'mode': job['mode'],
+        'profile': job['profile'],
+        'outputs': output_paths,
+        'unreadable_avatars': skipped,
+        'expected_outputs': len(job['avatars']),
+        'status': status.splitlines() if status else [],
+        'wall_seconds': round(time.perf_counter() - start, 2),
+    }
+
+
+def render_manifest(jobs, layouts_path, workers=None, concurrent_jobs=1, fresh=False):
+    """
+    Library entry point: renders normalized jobs (see load_manifest) and returns one result dict per job.
+    concurrent_jobs > 1 renders several jobs at once; each one still uses up to `workers` ffmpeg jobs.
+    """
+    if fresh:
+        Path(layouts_path).unlink(missing_ok=True)
+    layout_store = LayoutStore(layouts_path)
+
+    def run(indexed_job):
+        index, job = indexed_job
+        try:
+            return render_job(job, layout_store, workers, label=f"{index + 1}/{len(jobs)} {Path(job['main']).name}")
+        except Exception as e:
+            print(f"Job {index + 1} ({job['main']}) failed: {e}", file=sys.stderr)
+            return {'main': job['main'], 'mode': job['mode'], 'outputs': [], 'expected_outputs': len(job['avatars']),
+                    'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrent_jobs))) as executor:
+        return list(executor.map(run, enumerate(jobs)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless batch rendering for the avatar overlay pipeline.")
+    parser.add_argument("manifest", help="JSON or CSV manifest of main videos, avatars, layouts and modes.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Concurrent ffmpeg render jobs per manifest job (default: core-aware).")
+    parser.add_argument("--jobs", type=int, default=1, help="Manifest jobs rendered at the same time.")
+    parser.add_argument("--layouts", default=None,
+                        help="Where resolved layouts are kept for resuming (default: <manifest>.layouts.json).")
+    parser.add_argument("--fresh", action="store_true", help="Forget saved layouts and draw new random ones.")
+    parser.add_argument("--report", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+
+    jobs = load_manifest(args.manifest)
+    layouts_path = args.layouts or str(Path(args.manifest).with_suffix('.layouts.json'))
+    results = render_manifest(jobs, layouts_path, workers=args.workers, concurrent_jobs=args.jobs, fresh=args.fresh)
+    report = {
+        'manifest': str(args.manifest),
+        'jobs': len(jobs),
+        'outputs': sum(len(result['outputs']) for result in results),
+        'expected_outputs': sum(result['expected_outputs'] for result in results),
+        'results': results,
+    }
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(0 if report['outputs'] == report['expected_outputs'] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import cv2
+import numpy as np
+
+
+# Same HSV green range as overlayer.remove_green_background_with_alpha.
+LOWER_GREEN = np.array([35, 100, 100], dtype=np.uint8)
+UPPER_GREEN = np.array([85, 255, 255], dtype=np.uint8)
+# Scratch buffers: name -> (channels, dtype). Channel count None means a 2-D (height, width) buffer.
+BUFFER_LAYOUT = {
+    'hsv': (3, np.uint8),
+    'alpha': (None, np.uint8),
+    'inverse_alpha': (1, np.uint8),
+    'accumulator': (3, np.uint16),
+    'scratch': (3, np.uint16),
+}
+
+
+class PreviewCompositor:
+    """
+    Fixed-point green-screen compositing for preview frames.
+
+    Works directly on BGR frames (no RGBA split/merge or RGB round trips) and blends with
+    uint16 integer arithmetic in scratch buffers that are reused for every following preview: one
+    set, grown to the largest avatar seen so far, so memory stays bounded however many avatar
+    sizes the random layouts produce. The result matches remove_green_background_with_alpha +
+    overlay_alpha within +/-1 per channel (the float path truncates, this one rounds).
+
+    An instance keeps its scratch buffers between calls, so use one instance per thread.
+    """
+
+    def __init__(self, lower_green=LOWER_GREEN, upper_green=UPPER_GREEN):
+        self.lower_green = np.asarray(lower_green, dtype=np.uint8)
+        self.upper_green = np.asarray(upper_green, dtype=np.uint8)
+        self._capacity = 0
+        self._storage = {}
+
+    def _get_buffers(self, height, width):
+        """
+        Contiguous (height, width[, channels]) views into the flat backing buffers, which are only
+        reallocated when an avatar has more pixels than any before it.
+        """
+        pixels = height * width
+        if pixels > self._capacity:
+            self._storage = {name: np.empty(pixels * (channels or 1), dtype=dtype)
+                             for name, (channels, dtype) in BUFFER_LAYOUT.items()}
+            self._capacity = pixels
+        buffers = {}
+        for name, (channels, _) in BUFFER_LAYOUT.items():
+            shape = (height, width) if channels is None else (height, width, channels)
+            buffers[name] = self._storage[name][:pixels * (channels or 1)].reshape(shape)
+        return buffers
+
+    def key_alpha(self, avatar_bgr):
+        """Returns the alpha mask (255 = keep, 0 = green) for a BGR avatar frame, stored in a reused buffer."""
+        height, width = avatar_bgr.shape[:2]
+        buffers = self._get_buffers(height, width)
+        cv2.cvtColor(avatar_bgr, cv2.COLOR_BGR2HSV, dst=buffers['hsv'])
+        cv2.inRange(buffers['hsv'], self.lower_green, self.upper_green, dst=buffers['alpha'])
+        cv2.bitwise_not(buffers['alpha'], dst=buffers['alpha'])
+        return buffers['alpha']
+
+    def composite(self, background_bgr, avatar_bgr, x, y):
+        """
+        Keys the green out of avatar_bgr and blends it onto background_bgr at (x, y), in place.
+        The avatar may hang over any edge of the background; the overhang is clipped.
+        """
+        fg_h, fg_w = avatar_bgr.shape[:2]
+        bg_h, bg_w = background_bgr.shape[:2]
+
+        y1, x1 = max(0, y), max(0, x)
+        y2, x2 = min(bg_h, y + fg_h), min(bg_w, x + fg_w)
+        if y2 <= y1 or x2 <= x1:
+            return background_bgr
+
+        fg_y1, fg_x1 = max(0, -y), max(0, -x)
+        fg_y2, fg_x2 = fg_y1 + (y2 - y1), fg_x1 + (x2 - x1)
+        crop_h, crop_w = y2 - y1, x2 - x1
+
+        alpha_full = self.key_alpha(avatar_bgr)
+        buffers = self._get_buffers(fg_h, fg_w)
+        alpha = alpha_full[fg_y1:fg_y2, fg_x1:fg_x2, np.newaxis]
+        inverse_alpha = buffers['inverse_alpha'][:crop_h, :crop_w]
+        accumulator = buffers['accumulator'][:crop_h, :crop_w]
+        scratch = buffers['scratch'][:crop_h, :crop_w]
+        fg_crop = avatar_bgr[fg_y1:fg_y2, fg_x1:fg_x2]
+        bg_roi = background_bgr[y1:y2, x1:x2]
+
+        # accumulator = fg * a + bg * (255 - a), at most 255 * 255, so it fits in uint16.
+        np.multiply(fg_crop, alpha, out=accumulator, dtype=np.uint16)
+        np.subtract(255, alpha, out=inverse_alpha)
+        np.multiply(bg_roi, inverse_alpha, out=scratch, dtype=np.uint16)
+        np.add(accumulator, scratch, out=accumulator)
+        # Rounded division by 255: v = x + 128; (v + (v >> 8)) >> 8, exact for 0 <= x <= 255 * 255.
+        np.add(accumulator, 128, out=accumulator)
+        np.right_shift(accumulator, 8, out=scratch)
+        np.add(accumulator, scratch, out=accumulator)
+        np.right_shift(accumulator, 8, out=accumulator)
+        np.copyto(bg_roi, accumulator, casting='unsafe')
+        return background_bgr
+
+    def composite_batch(self, jobs):
+        """
+        Composites a batch of (background_bgr, avatar_bgr, x, y) jobs, each in place, and returns
+        the backgrounds, all through the same scratch buffers.
+        """
+        return [self.composite(background_bgr, avatar_bgr, x, y) for background_bgr, avatar_bgr, x, y in jobs]
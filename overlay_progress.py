@@ -0,0 +1,190 @@
+import json
+import subprocess
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+RENDER_LOG_PATH = Path(__file__).parent / "render_progress.log"
+# Minimum seconds between two logged progress records of the same job.
+PROGRESS_LOG_INTERVAL = 5.0
+
+_render_log_lock = threading.Lock()
+
+
+def log_render_event(event, **fields):
+    """Appends one JSON record to the structured render log."""
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'event': event}
+    record.update(fields)
+    with _render_log_lock, open(RENDER_LOG_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _to_float(value):
+    try:
+        return float(str(value).rstrip('x'))
+    except (TypeError, ValueError):
+        return None
+
+
+def run_ffmpeg_with_progress(ffmpeg_command, on_progress):
+    """
+    Runs ffmpeg with `-progress pipe:1` and calls on_progress(block) for every key=value block it
+    reports (frame, fps, out_time_us, speed, progress=continue|end, ...). Raises
+    subprocess.CalledProcessError with the captured stderr on failure, like subprocess.run(check=True).
+    """
+    command = [ffmpeg_command[0], '-progress', 'pipe:1', '-nostats'] + list(ffmpeg_command[1:])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Drain stderr on the side so a chatty ffmpeg can't block on a full pipe while we read progress.
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_thread.start()
+    block = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        if key == 'progress':
+            on_progress(block)
+            block = {}
+    returncode = process.wait()
+    stderr_thread.join()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr="".join(stderr_chunks))
+
+
+class RenderMonitor:
+    """
+    Live per-job view of a render batch, fed by ffmpeg `-progress` blocks from the worker threads.
+
+    A job may run several ffmpeg commands in a row (segmented renders); their output times and
+    frame counts are added up. expected_seconds is the job's expected output duration, used for
+    the completed fraction and the ETA.
+    """
+
+    def __init__(self, job_names, expected_seconds):
+        self._lock = threading.Lock()
+        self.batch_started = time.time()
+        self.jobs = [{
+            'job': name,
+            'expected_seconds': expected or 0.0,
+            'status': 'queued',
+            'frame': 0,
+            'fps': None,
+            'speed': None,
+            'out_seconds': 0.0,
+            'eta_seconds': None,
+            'started': None,
+            'finished': None,
+            '_command_frames': 0,
+            '_command_seconds': 0.0,
+            '_frame_offset': 0,
+            '_seconds_offset': 0.0,
+            '_last_logged': 0.0,
+        } for name, expected in zip(job_names, expected_seconds)]
+
+    def start(self, index):
+        with self._lock:
+            job = self.jobs[index]
+            job['status'] = 'running'
+            job['started'] = time.time()
+        log_render_event('job_started', job=job['job'], expected_seconds=job['expected_seconds'])
+
+    def progress_callback(self, index):
+        return lambda block: self.update(index, block)
+
+    def update(self, index, block):
+        with self._lock:
+            job = self.jobs[index]
+            frame = int(_to_float(block.get('frame')) or 0)
+            out_us = _to_float(block.get('out_time_us')) or _to_float(block.get('out_time_ms'))
+            out_seconds = max(0.0, out_us / 1e6) if out_us is not None else job['_command_seconds']
+            if out_seconds < job['_command_seconds'] or frame < job['_command_frames']:
+                # A new ffmpeg command of the same job started; keep what the previous one produced.
+                job['_seconds_offset'] += job['_command_seconds']
+                job['_frame_offset'] += job['_command_frames']
+            job['_command_seconds'], job['_command_frames'] = out_seconds, frame
+            job['out_seconds'] = job['_seconds_offset'] + out_seconds
+            job['frame'] = job['_frame_offset'] + frame
+            job['fps'] = _to_float(block.get('fps'))
+            job['speed'] = _to_float(block.get('speed'))
+            remaining = max(0.0, job['expected_seconds'] - job['out_seconds'])
+            job['eta_seconds'] = round(remaining / job['speed'], 1) if job['speed'] else None
+            now = time.time()
+            should_log = now - job['_last_logged'] >= PROGRESS_LOG_INTERVAL
+            if should_log:
+                job['_last_logged'] = now
+                record = self._public(job)
+        if should_log:
+            log_render_event('job_progress', **record)
+
+    def finish(self, index, ok):
+        with self._lock:
+            job = self.jobs[index]
+            job['status'] = 'done' if ok else 'failed'
+            job['finished'] = time.time()
+            job['eta_seconds'] = 0.0
+            record = self._public(job)
+        log_render_event('job_finished', **record)
+
+    @staticmethod
+    def _public(job):
+        record = {key: value for key, value in job.items() if not key.startswith('_')}
+        if job['started'] and job['finished']:
+            record['wall_seconds'] = round(job['finished'] - job['started'], 2)
+        return record
+
+    def fraction(self):
+        with self._lock:
+            if not self.jobs:
+                return 1.0
+            total = 0.0
+            for job in self.jobs:
+                if job['status'] in ('done', 'failed'):
+                    total += 1.0
+                elif job['expected_seconds']:
+                    total += min(1.0, job['out_seconds'] / job['expected_seconds'])
+            return total / len(self.jobs)
+
+    def describe(self, max_running=3):
+        """One-line status for gr.Progress: finished count plus frame/fps/speed/ETA of running jobs."""
+        with self._lock:
+            finished = sum(1 for job in self.jobs if job['status'] in ('done', 'failed'))
+            running = [job for job in self.jobs if job['status'] == 'running']
+            parts = [f"{finished}/{len(self.jobs)} jobs done"]
+            for job in running[:max_running]:
+                fps = f"{job['fps']:.0f}fps" if job['fps'] else "-fps"
+                speed = f"{job['speed']:.2f}x" if job['speed'] else "-x"
+                eta = f"ETA {job['eta_seconds']:.0f}s" if job['eta_seconds'] is not None else "ETA ?"
+                parts.append(f"{job['job']}: frame {job['frame']} {fps} {speed} {eta}")
+            if len(running) > max_running:
+                parts.append(f"+{len(running) - max_running} more running")
+            return " | ".join(parts)
+
+    def summary(self):
+        """Per-batch encode throughput, logged and returned as status lines."""
+        with self._lock:
+            finished_jobs = [self._public(job) for job in self.jobs if job['finished']]
+        wall_seconds = time.time() - self.batch_started
+        total_frames = sum(job['frame'] for job in finished_jobs)
+        job_rates = [(job['frame'] / job['wall_seconds'], job) for job in finished_jobs
+                     if job.get('wall_seconds') and job['frame']]
+        job_rates.sort(key=lambda item: item[0])
+        summary = {
+            'jobs': len(self.jobs),
+            'failed': sum(1 for job in finished_jobs if job['status'] == 'failed'),
+            'wall_seconds': round(wall_seconds, 1),
+            'total_frames': total_frames,
+            'batch_fps': round(total_frames / wall_seconds, 1) if wall_seconds else None,
+            'slowest_jobs': [{'job': job['job'], 'fps': round(rate, 1), 'wall_seconds': job['wall_seconds']}
+                             for rate, job in job_rates[:3]],
+        }
+        log_render_event('batch_summary', **summary)
+        lines = [f"Encode throughput: {summary['total_frames']} frames in {summary['wall_seconds']}s "
+                 f"({summary['batch_fps']} fps across {summary['jobs']} jobs, {summary['failed']} failed)"]
+        if summary['slowest_jobs']:
+            lines.append("Slowest jobs: " + ", ".join(f"{job['job']} ({job['fps']} fps, {job['wall_seconds']}s)"
+                                                     for job in summary['slowest_jobs']))
+        return lines
@@ -4,13 +4,31 @@ import numpy as np
 import os
 import tempfile
 import random
-import gdown
 from pathlib import Path
-import re
+import math
 import shutil
 import traceback
 import zipfile
 import subprocess
+import hashlib
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+
+from overlay_cache import (FirstFrameCache, KeyedAvatarCache, RenderManifest, SegmentCache, file_fingerprint,
+                           sampled_content_hash)
+from media_probe import probe_all, probe_keyframes, probe_media
+from overlay_compositor import PreviewCompositor
+from overlay_progress import RenderMonitor, run_ffmpeg_with_progress
+from drive_download import download_drive_file, drive_file_id, iter_folder_downloads
 
 
 # --- Core Video Processing Functions (Used for Previews) ---
@@ -18,7 +36,7 @@ import subprocess
 def remove_green_background_with_alpha(frame):
     """
     Removes green screen from a BGR frame and returns an RGBA image.
-    This is used only for generating the static PNG previews.
+    Float reference for PreviewCompositor, which the previews now use (see overlay_bench.py).
     """
     hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
     lower_green = np.array([35, 100, 100])
@@ -35,7 +53,7 @@ def remove_green_background_with_alpha(frame):
 def overlay_alpha(background_rgb, foreground_rgba, x, y):
     """
     Overlays an RGBA (foreground) image onto an RGB (background) image.
-    This is used only for generating the static PNG previews.
+    Float reference for PreviewCompositor, which the previews now use (see overlay_bench.py).
     """
     fg_h, fg_w, _ = foreground_rgba.shape
     bg_h, bg_w, _ = background_rgb.shape
@@ -64,237 +82,1427 @@ def overlay_alpha(background_rgb, foreground_rgba, x, y):
 
 # --- File Download Functions (Unchanged) ---
 
-def convert_gdrive_url_for_single_mode(gdrive_url):
-    try:
-        file_id_match = re.search(r'[-\w]{25,}(?=/|$)', gdrive_url)
-        if not file_id_match: return None
-        file_id = file_id_match.group(0)
-        return f"https://drive.google.com/uc?export=download&id={file_id}"
-    except:
-        return None
-
-
 def download_gdrive_file_for_single_mode(gdrive_url):
     try:
         if not gdrive_url: return None, gr.update(value="Please provide a Google Drive URL", visible=True)
-        direct_url = convert_gdrive_url_for_single_mode(gdrive_url)
-        if not direct_url: return None, gr.update(value="Invalid Google Drive URL.", visible=True)
+        file_id = drive_file_id(gdrive_url)
+        if not file_id: return None, gr.update(value="Invalid Google Drive URL.", visible=True)
         script_dir = Path(__file__).parent
         download_dir = script_dir / "downloaded_files"
         download_dir.mkdir(parents=True, exist_ok=True)
-        temp_basename = f"gdown_single_temp_{os.urandom(4).hex()}"
-        target_path_for_gdown = download_dir / temp_basename
-        final_downloaded_path = gdown.download(direct_url, quiet=False, output=str(target_path_for_gdown))
-        temp_file_path = Path(final_downloaded_path)
-        if not temp_file_path.exists() or temp_file_path.stat().st_size == 0: return None, gr.update(
-            value="Download failed", visible=True)
-        new_file_path = temp_file_path.with_suffix('.mp4')
-        if temp_file_path != new_file_path: os.rename(temp_file_path, new_file_path)
+        # Served from the shared download cache when this file was fetched before (by either app).
+        new_file_path = download_drive_file(file_id, download_dir / f"gdrive_{file_id}.mp4")
         return str(new_file_path), gr.update(value=f"File downloaded as {new_file_path.name}", visible=True)
     except Exception as e:
         return None, gr.update(value=f"Error: {str(e)}", visible=True)
 
 
-def download_gdrive_folder(gdrive_url, progress=gr.Progress()):
+def download_gdrive_folder(gdrive_url, main_video_path=None, progress=gr.Progress()):
+    """
+    Downloads the avatar folder with a bounded pool of concurrent downloads, moving each file into
+    downloaded_avatar_folders as it lands, and yields the growing avatar list after every file.
+    With a main video loaded, each avatar's layout and preview are made as soon as it arrives.
+    Yields (avatar_files, status, video_params, preview_paths, preview_avatar_paths).
+    """
+    unchanged = (gr.update(), gr.update(), gr.update())
+    if not gdrive_url:
+        yield (None, gr.update(value="Please provide a Google Drive Folder URL.", visible=True)) + unchanged
+        return
+    persistent_dir = Path(__file__).parent / "downloaded_avatar_folders"
+    if persistent_dir.exists(): shutil.rmtree(persistent_dir)
+    persistent_dir.mkdir(parents=True, exist_ok=True)
+
+    previewer = StreamingPreviewer(main_video_path) if main_video_path else None
+    if previewer and previewer.main_frame is None:
+        gr.Warning(f"Could not read first frame from main video: {main_video_path}")
+        previewer = None
+    avatar_paths, failures = [], []
+
+    def preview_outputs():
+        if not previewer:
+            return unchanged
+        return previewer.video_params, previewer.preview_paths, previewer.avatar_paths
+
+    progress(0, desc="Listing folder")
     try:
-        if not gdrive_url: return None, gr.update(value="Please provide a Google Drive Folder URL.", visible=True)
-        with tempfile.TemporaryDirectory(dir=str(Path(__file__).parent)) as temp_dir:
-            temp_dir_path = Path(temp_dir)
-            progress(0.1, desc="Starting folder download")
-            output_dir = str(temp_dir_path / "avatar_folder")
-            Path(output_dir).mkdir(parents=True, exist_ok=True)
-            gdown.download_folder(gdrive_url, output=output_dir, quiet=False, use_cookies=True, remaining_ok=True)
-            downloaded_folder_path = Path(output_dir)
-            if not downloaded_folder_path.exists() or not downloaded_folder_path.is_dir(): return None, gr.update(
-                value="Folder download failed", visible=True)
-            progress(0.5, desc="Processing downloaded videos")
-            video_files_list = []
-            for file_path in downloaded_folder_path.rglob('*'):
-                if file_path.is_file() and file_path.suffix.lower() in (
-                '.mp4', '.avi', '.mov', '.webm', '.flv', '.wmv'):
-                    new_file_path = file_path.with_suffix('.mp4')
-                    if file_path != new_file_path:
-                        try:
-                            os.rename(file_path, new_file_path)
-                        except Exception as e:
-                            continue
-                    video_files_list.append(new_file_path)
-            if not video_files_list: return None, gr.update(value="No valid video files found.", visible=True)
-            script_dir = Path(__file__).parent
-            persistent_dir = script_dir / "downloaded_avatar_folders"
-            if persistent_dir.exists(): shutil.rmtree(persistent_dir)
-            persistent_dir.mkdir(parents=True, exist_ok=True)
-            persistent_file_paths = []
-            for file_path in video_files_list:
-                dest_path = persistent_dir / file_path.name
-                shutil.copy(file_path, dest_path)
-                persistent_file_paths.append(str(dest_path))
-            progress(1.0, desc="Folder download complete")
-            return persistent_file_paths, gr.update(value=f"Downloaded {len(persistent_file_paths)} files.",
-                                                    visible=True)
+        for path, error in iter_folder_downloads(gdrive_url, persistent_dir):
+            if error:
+                failures.append(error)
+                continue
+            if previewer:
+                # Avatars that can't be previewed can't be laid out either, so they are left out.
+                if not previewer.add(path):
+                    failures.append(f"{path.name}: unreadable video")
+                    continue
+            avatar_paths.append(str(path))
+            status = f"Downloaded {len(avatar_paths)} files..."
+            yield (avatar_paths, gr.update(value=status, visible=True)) + tuple(preview_outputs())
     except Exception as e:
         print(traceback.format_exc())
-        return None, gr.update(value=f"Error: {str(e)}", visible=True)
+        yield (None, gr.update(value=f"Error: {str(e)}", visible=True)) + unchanged
+        return
+    finally:
+        if previewer:
+            previewer.close()
+    if not avatar_paths:
+        yield (None, gr.update(value="No valid video files found.", visible=True)) + unchanged
+        return
+    status = f"Downloaded {len(avatar_paths)} files."
+    if failures:
+        status += f" {len(failures)} failed: " + "; ".join(failures[:5])
+    yield (avatar_paths, gr.update(value=status, visible=True)) + tuple(preview_outputs())
+
+
+# --- Preview Generation Functions ---
+
+def random_layout_params(main_w, main_h, avatar_w, avatar_h):
+    """Picks a random zoom/crop of the main video and a random avatar size and position in its lower left half."""
+    params = {}
+    params['zoom_factor'] = random.uniform(1.0, 1.2)
+    cropped_width = int(main_w / params['zoom_factor'])
+    cropped_height = int(main_h / params['zoom_factor'])
+    params['crop_x'] = random.randint(0, main_w - cropped_width)
+    params['crop_y'] = random.randint(0, main_h - cropped_height)
+    target_avatar_height = random.uniform(main_h / 4, main_h / 3)
+    avatar_aspect_ratio = avatar_w / avatar_h
+    params['scaled_avatar_h'] = int(target_avatar_height)
+    params['scaled_avatar_w'] = int(params['scaled_avatar_h'] * avatar_aspect_ratio)
+    right_boundary = (main_w // 2) - params['scaled_avatar_w']
+    params['x_pos'] = random.randint(0, max(0, right_boundary))
+    params['y_pos'] = main_h - params['scaled_avatar_h']
+    return params
+
+
+# Previews are rendered at gallery size; the full-resolution composite is only made when one is opened.
+PREVIEW_THUMBNAIL_WIDTH = 640
+PREVIEW_THUMBNAIL_FORMAT = ".jpg"
+PREVIEW_JPEG_QUALITY = 85
+# cv2 resizing, compositing and JPEG encoding release the GIL, so previews render on a thread pool.
+PREVIEW_WORKERS = min(8, os.cpu_count() or 1)
+
+_thread_state = threading.local()
+
+
+def thread_compositor():
+    """PreviewCompositor keeps scratch buffers between calls, so each thread gets its own."""
+    compositor = getattr(_thread_state, 'compositor', None)
+    if compositor is None:
+        compositor = _thread_state.compositor = PreviewCompositor()
+    return compositor
+
+
+def render_preview(main_frame_bgr, main_size, avatar_frame_bgr, params, compositor, preview_path):
+    """
+    Composites the layout onto a copy of the main frame and writes it as an image. main_frame_bgr may
+    be a downscaled copy of the (main_w, main_h) = main_size frame; the layout is scaled to match.
+    """
+    main_w, main_h = main_size
+    frame_h, frame_w = main_frame_bgr.shape[:2]
+    scale = frame_w / main_w
+    cropped_width = int(main_w / params['zoom_factor'])
+    cropped_height = int(main_h / params['zoom_factor'])
+    crop_x, crop_y = int(round(params['crop_x'] * scale)), int(round(params['crop_y'] * scale))
+    processed_main_frame = main_frame_bgr[crop_y:crop_y + max(1, int(round(cropped_height * scale))),
+                           crop_x:crop_x + max(1, int(round(cropped_width * scale)))]
+    processed_main_frame = cv2.resize(processed_main_frame, (frame_w, frame_h), interpolation=cv2.INTER_AREA)
+    avatar_size = (max(1, int(round(params['scaled_avatar_w'] * scale))),
+                   max(1, int(round(params['scaled_avatar_h'] * scale))))
+    resized_avatar_frame = cv2.resize(avatar_frame_bgr, avatar_size, interpolation=cv2.INTER_AREA)
+    composite_frame_bgr = compositor.composite(processed_main_frame, resized_avatar_frame,
+                                               int(round(params['x_pos'] * scale)), int(round(params['y_pos'] * scale)))
+    suffix = Path(preview_path).suffix.lower()
+    if suffix in ('.jpg', '.jpeg'):
+        encode_params = [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY]
+    elif suffix == '.webp':
+        encode_params = [cv2.IMWRITE_WEBP_QUALITY, PREVIEW_JPEG_QUALITY]
+    else:
+        encode_params = []
+    cv2.imwrite(str(preview_path), composite_frame_bgr, encode_params)
+    return str(preview_path)
+
+
+class StreamingPreviewer:
+    """
+    Lays out and previews avatars against one main video, either all at once or one at a time as
+    they arrive. With thumbnail_width, previews are rendered at that width as fast-encoding thumbnails;
+    with None, at full resolution. render() is safe to call from several threads.
+    """
+
+    def __init__(self, main_video_path, thumbnail_width=PREVIEW_THUMBNAIL_WIDTH):
+        self.frame_cache = FirstFrameCache()
+        self.main_frame, _ = self.frame_cache.load(main_video_path)
+        self.main_size = None
+        if self.main_frame is not None:
+            main_h, main_w = self.main_frame.shape[:2]
+            self.main_size = (main_w, main_h)
+            if thumbnail_width and main_w > thumbnail_width:
+                thumbnail_height = max(1, int(round(main_h * thumbnail_width / main_w)))
+                self.main_frame = cv2.resize(self.main_frame, (thumbnail_width, thumbnail_height),
+                                             interpolation=cv2.INTER_AREA)
+        self.suffix = PREVIEW_THUMBNAIL_FORMAT if thumbnail_width else ".png"
+        self.name_suffix = "" if thumbnail_width else "_full"
+        self.output_dir = Path(__file__).parent / "generated_previews"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.avatar_paths = []
+        self.video_params = []
+        self.preview_paths = []
+
+    def layout(self, avatar_video_path):
+        """Random layout params for one avatar (from its probed size), or None if it can't be read."""
+        avatar_info = probe_media(avatar_video_path)
+        if not avatar_info or not avatar_info['height']:
+            return None
+        main_w, main_h = self.main_size
+        return random_layout_params(main_w, main_h, avatar_info['width'], avatar_info['height'])
+
+    def render(self, avatar_video_path, params):
+        """Writes one preview and returns its path, or None if the avatar can't be read."""
+        avatar_video_path = Path(avatar_video_path)
+        main_w, main_h = self.main_size
+        scale = self.main_frame.shape[1] / main_w
+        try:
+            # Avatars are never scaled above a third of the main height, so cache them at that size.
+            avatar_frame_bgr, _ = self.frame_cache.load(avatar_video_path,
+                                                        max_height=int(math.ceil(main_h / 3 * scale)))
+            if avatar_frame_bgr is None:
+                return None
+            return render_preview(self.main_frame, self.main_size, avatar_frame_bgr, params, thread_compositor(),
+                                  self.output_dir / f"preview_{avatar_video_path.stem}{self.name_suffix}{self.suffix}")
+        except Exception:
+            print(traceback.format_exc())
+            return None
+
+    def record(self, avatar_video_path, params, preview_path):
+        self.avatar_paths.append(str(avatar_video_path))
+        self.video_params.append(params)
+        self.preview_paths.append(preview_path)
+
+    def add(self, avatar_video_path):
+        """Lays out and previews one avatar; returns False if the avatar can't be read."""
+        params = self.layout(avatar_video_path)
+        preview_path = self.render(avatar_video_path, params) if params else None
+        if preview_path is None:
+            return False
+        self.record(avatar_video_path, params, preview_path)
+        return True
+
+    def close(self):
+        self.frame_cache.flush()
 
 
-# --- Preview Generation Function (Unchanged) ---
 def generate_all_previews(main_video_path, avatar_file_paths, progress=gr.Progress()):
+    """Returns (video_params, preview_paths, preview_avatar_paths), aligned by index."""
     if not main_video_path or not avatar_file_paths:
         gr.Warning("Upload both a main video and avatar videos for previews.")
-        return [], []
-    video_params_list = []
-    preview_paths = []
-    main_cap_temp = cv2.VideoCapture(str(main_video_path))
-    if not main_cap_temp.isOpened():
-        gr.Warning(f"Could not open main video: {main_video_path}")
-        return [], []
-    ret_main, initial_main_frame_bgr = main_cap_temp.read()
-    main_cap_temp.release()
-    if not ret_main:
-        gr.Warning("Could not read first frame from main video.")
-        return [], []
-    main_h, main_w, _ = initial_main_frame_bgr.shape
-    script_dir = Path(__file__).parent
-    preview_output_dir = script_dir / "generated_previews"
-    preview_output_dir.mkdir(parents=True, exist_ok=True)
-    for avatar_video_path_str in progress.tqdm(avatar_file_paths, desc="Generating Previews"):
+        return [], [], []
+    # Probe every input concurrently up front; the frame cache and later renders reuse the memoized results.
+    probe_all([main_video_path] + list(avatar_file_paths))
+    previewer = StreamingPreviewer(main_video_path)
+    if previewer.main_frame is None:
+        gr.Warning(f"Could not read first frame from main video: {main_video_path}")
+        return [], [], []
+    # Layouts are drawn in upload order on this thread, so a seeded run always gets the same layouts.
+    layouts = [(path, previewer.layout(path)) for path in avatar_file_paths]
+    layouts = [(path, params) for path, params in layouts if params]
+    with ThreadPoolExecutor(max_workers=max(1, min(PREVIEW_WORKERS, len(layouts)))) as executor:
+        preview_paths = list(progress.tqdm(executor.map(lambda item: previewer.render(*item), layouts),
+                                           total=len(layouts), desc="Generating Previews"))
+    for (path, params), preview_path in zip(layouts, preview_paths):
+        if preview_path:
+            previewer.record(path, params, preview_path)
+    previewer.close()
+    return previewer.video_params, previewer.preview_paths, previewer.avatar_paths
+
+
+def open_full_preview(main_video_path, preview_avatar_paths, video_params, evt: gr.SelectData):
+    """Renders the full-resolution composite of the preview clicked in the gallery."""
+    index = evt.index
+    if not main_video_path or index is None or index >= min(len(preview_avatar_paths or []), len(video_params or [])):
+        return gr.update(value=None, visible=False)
+    previewer = StreamingPreviewer(main_video_path, thumbnail_width=None)
+    if previewer.main_frame is None:
+        return gr.update(value=None, visible=False)
+    preview_path = previewer.render(preview_avatar_paths[index], video_params[index])
+    previewer.close()
+    return gr.update(value=preview_path, visible=preview_path is not None)
+
+
+# --- REFACTORED Video Generation Function (All FFMPEG) ---
+
+# Rough number of encoder threads one libx264 job can keep busy before extra threads stop paying off.
+RENDER_THREADS_PER_JOB = 4
+
+
+def default_render_workers(job_count=None):
+    """
+    Picks a concurrency limit for the render pool from the number of available cores,
+    so that each ffmpeg job gets about RENDER_THREADS_PER_JOB threads.
+    """
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, cpu_count // RENDER_THREADS_PER_JOB)
+    if job_count:
+        workers = min(workers, job_count)
+    return workers
+
+
+def threads_per_render_job(max_workers):
+    """Splits the available cores between the concurrent ffmpeg jobs so they don't oversubscribe the CPU."""
+    cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // max(1, int(max_workers)))
+
+
+COLORKEY_SETTING = "colorkey=0x00FF00:0.4:0.1"
+
+# Frames each fan-out branch may hold in flight (encoder lookahead + frame threads + filter queues).
+FANOUT_FRAMES_PER_BRANCH = 48
+# Upper bound on avatars per fan-out pass, regardless of memory, to keep each ffmpeg process manageable.
+FANOUT_MAX_CHUNK_SIZE = 16
+
+
+def silent_audio_source(label, seconds=None):
+    """Filter that stands in for a missing audio stream with silence (of the given length, if any)."""
+    duration = f":d={seconds:.3f}" if seconds else ""
+    return f"anullsrc=r=48000:cl=stereo{duration}[{label}];"
+
+
+def build_avatar_filter_graph(params, main_width, main_height, fps, parallel_mode, main_v_labels, main_a_label,
+                              avatar_v_label, avatar_a_label, out_v_label, out_a_label, suffix="", prekeyed=False,
+                              main_audio_seconds=None, avatar_audio_seconds=None):
+    """
+    Returns the filter_complex section that crops/scales the main video, keys the avatar and composites them.
+    Sequential mode reads the main video twice (frozen first frame + full clip), so main_v_labels holds two labels.
+    With prekeyed, the avatar input already carries alpha (see KeyedAvatarCache) and is only scaled.
+    An audio label of None means that input has no audio; silence of the given length is used instead.
+    """
+    x_pos, y_pos = params['x_pos'], params['y_pos']
+    crop_and_scale = main_crop_and_scale_filter(params, main_width, main_height)
+    avatar_chain = avatar_filter_chain(params, prekeyed)
+    silence = ""
+    if main_a_label is None:
+        main_a_label = f"silent_main_a{suffix}"
+        silence += silent_audio_source(main_a_label, main_audio_seconds)
+    if avatar_a_label is None:
+        avatar_a_label = f"silent_avatar_a{suffix}"
+        silence += silent_audio_source(avatar_a_label, avatar_audio_seconds)
+
+    if parallel_mode:
+        return silence + (
+            f"[{main_v_labels[0]}]{crop_and_scale}[main_processed{suffix}];"
+            f"[{avatar_v_label}]{avatar_chain}[avatar_processed{suffix}];"
+            f"[main_processed{suffix}][avatar_processed{suffix}]overlay={x_pos}:{y_pos}[{out_v_label}];"
+            f"[{main_a_label}][{avatar_a_label}]amix=inputs=2:duration=first[{out_a_label}]"
+        )
+    return silence + (
+        f"[{main_v_labels[0]}]trim=end_frame=1,loop=-1:size=1,setpts=PTS-STARTPTS,fps={fps},{crop_and_scale}[frozen_bg{suffix}];"
+        f"[{avatar_v_label}]{avatar_chain}[avatar_processed{suffix}];"
+        f"[frozen_bg{suffix}][avatar_processed{suffix}]overlay={x_pos}:{y_pos}:shortest=1[part1_v{suffix}];"
+        f"[{main_v_labels[1]}]{crop_and_scale}[part2_v{suffix}];"
+        f"[part1_v{suffix}][{avatar_a_label}][part2_v{suffix}][{main_a_label}]concat=n=2:v=1:a=1[{out_v_label}][{out_a_label}]"
+    )
+
+
+def main_crop_and_scale_filter(params, main_width, main_height):
+    """The zoom crop of the main video, scaled back to its full size."""
+    cropped_width = int(main_width / params['zoom_factor'])
+    cropped_height = int(main_height / params['zoom_factor'])
+    return (f"crop={cropped_width}:{cropped_height}:{params['crop_x']}:{params['crop_y']},"
+            f"scale={main_width}:{main_height},setsar=1")
+
+
+def avatar_filter_chain(params, prekeyed=False):
+    """Keys (unless already pre-keyed) and scales the avatar to its layout size."""
+    avatar_key = "" if prekeyed else f"format=yuv444p,{COLORKEY_SETTING},"
+    return f"{avatar_key}scale={params['scaled_avatar_w']}:{params['scaled_avatar_h']},setsar=1"
+
+
+# Named encode profiles, fastest first: x264 preset and CRF, an output height cap (None keeps the
+# main video's size) and the AAC bitrate. 'final' is what every render used before profiles existed.
+ENCODE_PROFILES = OrderedDict([
+    ('draft', {'preset': 'ultrafast', 'crf': 28, 'max_height': 540, 'audio_bitrate': '96k'}),
+    ('review', {'preset': 'veryfast', 'crf': 23, 'max_height': 1080, 'audio_bitrate': '128k'}),
+    ('final', {'preset': 'fast', 'crf': 18, 'max_height': None, 'audio_bitrate': '192k'}),
+])
+DEFAULT_ENCODE_PROFILE = 'final'
+# Written by `python overlay_bench.py calibrate`: measured batch fps of each profile on this host.
+ENCODE_CALIBRATION_PATH = Path(__file__).parent / "encode_calibration.json"
+
+
+def encode_profile(name=None):
+    """The settings of a named profile (the default one for None)."""
+    name = name or DEFAULT_ENCODE_PROFILE
+    if name not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile {name!r}; choose one of {', '.join(ENCODE_PROFILES)}")
+    return ENCODE_PROFILES[name]
+
+
+def audio_encoder_args(profile=None):
+    profile = profile or encode_profile()
+    return ['-c:a', 'aac', '-b:a', profile['audio_bitrate']]
+
+
+def encoder_args(threads=None, profile=None):
+    profile = profile or encode_profile()
+    args = ['-c:v', 'libx264', '-preset', profile['preset'], '-crf', str(profile['crf'])]
+    if threads:
+        args.extend(['-threads', str(threads)])
+    args.extend(audio_encoder_args(profile))
+    return args
+
+
+def output_scale_filter(profile, main_height):
+    """The scale filter that applies the profile's height cap, or "" when the main video already fits."""
+    max_height = profile and profile['max_height']
+    if not max_height or main_height <= max_height:
+        return ""
+    return f"scale=-2:{max_height - max_height % 2},setsar=1"
+
+
+def cap_output_video(filter_complex, label, profile, main_height):
+    """Appends the profile's height cap to the graph output `label`; returns (filter_complex, label to map)."""
+    scale = output_scale_filter(profile, main_height)
+    if not scale:
+        return filter_complex, f"[{label}]"
+    return filter_complex + f";[{label}]{scale}[{label}_out]", f"[{label}_out]"
+
+
+def has_audio(info):
+    """Inputs that couldn't be probed are assumed to have audio, as before."""
+    return info is None or info['has_audio']
+
+
+def build_overlay_command(main_video_path, avatar_path, params, main_width, main_height, fps, parallel_mode,
+                          output_path, threads=None, prekeyed=False, main_info=None, avatar_info=None, profile=None):
+    """
+    Builds the ffmpeg command that renders one avatar over the main video with the given layout params.
+    main_info/avatar_info (from media_probe) let inputs without an audio stream render with silence.
+    profile is an ENCODE_PROFILES entry (the default one for None).
+    """
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if threads:
+        ffmpeg_command.extend(['-filter_complex_threads', str(threads)])
+    ffmpeg_command.extend([
+        '-i', str(main_video_path),
+        '-i', str(avatar_path),
+    ])
+    filter_complex = build_avatar_filter_graph(params, main_width, main_height, fps, parallel_mode,
+                                               ['0:v', '0:v'], '0:a' if has_audio(main_info) else None, '1:v',
+                                               '1:a' if has_audio(avatar_info) else None, 'final_v', 'final_a',
+                                               prekeyed=prekeyed,
+                                               main_audio_seconds=main_info['duration'] if main_info else None,
+                                               avatar_audio_seconds=avatar_info['duration'] if avatar_info else None)
+    filter_complex, video_label = cap_output_video(filter_complex, 'final_v', profile, main_height)
+    ffmpeg_command.extend(['-filter_complex', filter_complex, '-map', video_label, '-map', '[final_a]'])
+    ffmpeg_command.extend(encoder_args(threads, profile))
+    ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+def build_fanout_command(main_video_path, avatar_paths, params_list, main_width, main_height, fps, output_paths,
+                         threads=None, prekeyed=None, main_info=None, avatar_infos=None, profile=None):
+    """
+    Builds one ffmpeg command that decodes the main video once, splits it into one branch per avatar
+    and writes every output in a single pass (parallel mode only). prekeyed and avatar_infos are per-avatar lists.
+    """
+    prekeyed = prekeyed or [False] * len(avatar_paths)
+    avatar_infos = avatar_infos or [None] * len(avatar_paths)
+    branch_count = len(avatar_paths)
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if threads:
+        ffmpeg_command.extend(['-filter_complex_threads', str(threads)])
+    ffmpeg_command.extend(['-i', str(main_video_path)])
+    for avatar_path in avatar_paths:
+        ffmpeg_command.extend(['-i', str(avatar_path)])
+
+    main_v_labels = [f"main_v{k}" for k in range(branch_count)]
+    main_a_labels = [f"main_a{k}" for k in range(branch_count)]
+    filter_parts = [
+        f"[0:v]split={branch_count}" + "".join(f"[{label}]" for label in main_v_labels),
+        ("[0:a]" if has_audio(main_info) else silent_audio_source("silent_main_a", main_info['duration'])
+         + "[silent_main_a]") + f"asplit={branch_count}" + "".join(f"[{label}]" for label in main_a_labels),
+    ]
+    for k, params in enumerate(params_list):
+        filter_parts.append(build_avatar_filter_graph(params, main_width, main_height, fps, True,
+                                                      [main_v_labels[k]], main_a_labels[k], f"{k + 1}:v",
+                                                      f"{k + 1}:a" if has_audio(avatar_infos[k]) else None,
+                                                      f"final_v{k}", f"final_a{k}", suffix=str(k),
+                                                      prekeyed=prekeyed[k]))
+    filter_complex = ";".join(filter_parts)
+    video_labels = []
+    for k in range(branch_count):
+        filter_complex, video_label = cap_output_video(filter_complex, f"final_v{k}", profile, main_height)
+        video_labels.append(video_label)
+    ffmpeg_command.extend(['-filter_complex', filter_complex])
+
+    # Every output gets its own encoder, so the job's thread budget is shared between them.
+    encoder_threads = max(1, threads // branch_count) if threads else None
+    for k, output_path in enumerate(output_paths):
+        ffmpeg_command.extend(['-map', video_labels[k], '-map', f"[final_a{k}]"])
+        ffmpeg_command.extend(encoder_args(encoder_threads, profile))
+        ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+# --- Segmented Sequential Rendering ---
+
+# Both sequential segments are conformed to these so the concat demuxer can join them with stream copy.
+SEGMENT_CONFORM_ARGS = ['-pix_fmt', 'yuv420p', '-ar', '48000', '-ac', '2', '-video_track_timescale', '90000']
+SEGMENT_FORMAT_VERSION = "sequential-segment-v1"
+# Stream fields that must agree between segments for a stream-copy concat.
+CONCAT_SIGNATURE_FIELDS = ('codec_type', 'codec_name', 'profile', 'width', 'height', 'pix_fmt', 'r_frame_rate',
+                           'sample_rate', 'channels')
+
+
+def build_main_segment_command(main_video_path, params, main_width, main_height, fps, output_path, threads=None,
+                               main_info=None, profile=None):
+    """The second half of a sequential video: the cropped/zoomed main clip with its own audio (or silence)."""
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(main_video_path)]
+    if has_audio(main_info):
+        ffmpeg_command.extend(['-map', '0:v:0', '-map', '0:a:0'])
+    else:
+        ffmpeg_command.extend(['-f', 'lavfi', '-t', f"{main_info['duration']:.3f}", '-i', 'anullsrc=r=48000:cl=stereo',
+                               '-map', '0:v:0', '-map', '1:a:0'])
+    video_filter = f"{main_crop_and_scale_filter(params, main_width, main_height)},fps={fps}"
+    scale = output_scale_filter(profile, main_height)
+    ffmpeg_command.extend(['-vf', f"{video_filter},{scale}" if scale else video_filter])
+    ffmpeg_command.extend(encoder_args(threads, profile))
+    ffmpeg_command.extend(SEGMENT_CONFORM_ARGS)
+    ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+def build_avatar_segment_command(main_video_path, avatar_path, params, main_width, main_height, fps, output_path,
+                                 threads=None, prekeyed=False, avatar_info=None, profile=None):
+    """The first half of a sequential video: the avatar over the frozen first main frame, with the avatar's audio."""
+    crop_and_scale = main_crop_and_scale_filter(params, main_width, main_height)
+    filter_complex = (
+        f"[0:v]trim=end_frame=1,loop=-1:size=1,setpts=PTS-STARTPTS,fps={fps},{crop_and_scale}[frozen_bg];"
+        f"[1:v]{avatar_filter_chain(params, prekeyed)}[avatar_processed];"
+        f"[frozen_bg][avatar_processed]overlay={params['x_pos']}:{params['y_pos']}:shortest=1[final_v]"
+    )
+    filter_complex, video_label = cap_output_video(filter_complex, 'final_v', profile, main_height)
+    audio_map = '1:a:0'
+    if not has_audio(avatar_info):
+        filter_complex += ";" + silent_audio_source("final_a", avatar_info['duration']).rstrip(";")
+        audio_map = '[final_a]'
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if threads:
+        ffmpeg_command.extend(['-filter_complex_threads', str(threads)])
+    # Only the first main frame is used, so don't decode the rest of the clip.
+    ffmpeg_command.extend(['-t', '1', '-i', str(main_video_path), '-i', str(avatar_path),
+                           '-filter_complex', filter_complex, '-map', video_label, '-map', audio_map])
+    ffmpeg_command.extend(encoder_args(threads, profile))
+    ffmpeg_command.extend(SEGMENT_CONFORM_ARGS)
+    ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+def probe_concat_signature(path):
+    """The codec parameters of each stream that have to match for a stream-copy concat."""
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries',
+                             'stream=' + ','.join(CONCAT_SIGNATURE_FIELDS), '-of', 'json', str(path)],
+                            check=True, capture_output=True, text=True)
+    streams = json.loads(result.stdout).get('streams', [])
+    return sorted(tuple(str(stream.get(field)) for field in CONCAT_SIGNATURE_FIELDS) for stream in streams)
+
+
+def write_concat_list(paths, output_path):
+    """Writes the concat demuxer file list for paths next to output_path and returns its path."""
+    list_path = Path(output_path).with_suffix('.concat.txt')
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in paths:
+            escaped = str(Path(path).absolute()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    return list_path
+
+
+def concat_segments(segment_paths, output_path, threads=None, profile=None):
+    """
+    Joins the segments with the concat demuxer and stream copy when their codec parameters match,
+    otherwise re-encodes them through the concat filter.
+    """
+    signatures = [probe_concat_signature(path) for path in segment_paths]
+    if all(signature == signatures[0] for signature in signatures):
+        list_path = write_concat_list(segment_paths, output_path)
+        try:
+            run_ffmpeg_job(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                            '-i', str(list_path), '-map', '0', '-c', 'copy', '-movflags', '+faststart',
+                            '-y', str(output_path)])
+        finally:
+            list_path.unlink(missing_ok=True)
+        return True
+
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    for path in segment_paths:
+        ffmpeg_command.extend(['-i', str(path)])
+    inputs = "".join(f"[{k}:v][{k}:a]" for k in range(len(segment_paths)))
+    ffmpeg_command.extend(['-filter_complex', f"{inputs}concat=n={len(segment_paths)}:v=1:a=1[final_v][final_a]",
+                           '-map', '[final_v]', '-map', '[final_a]'])
+    ffmpeg_command.extend(encoder_args(threads, profile))
+    ffmpeg_command.extend(['-y', str(output_path)])
+    run_ffmpeg_job(ffmpeg_command)
+    return False
+
+
+def render_sequential_segmented(main_video_path, avatar_path, params, main_width, main_height, fps, output_path,
+                                segment_cache, threads=None, prekeyed=False, on_progress=None, main_info=None,
+                                avatar_info=None, profile=None):
+    """
+    Renders a sequential-mode video as two segments: the main-video segment comes from segment_cache
+    (it only depends on the main video and the crop/zoom), and only the avatar segment is encoded.
+    Returns (main_segment_cache_hit, stream_copied).
+    """
+    segment_key = [file_fingerprint(main_video_path), main_crop_and_scale_filter(params, main_width, main_height),
+                   fps, ' '.join(encoder_args(profile=profile)), output_scale_filter(profile, main_height),
+                   ' '.join(SEGMENT_CONFORM_ARGS), SEGMENT_FORMAT_VERSION]
+    main_segment_path, cache_hit = segment_cache.get_or_build(
+        segment_key,
+        lambda path: build_main_segment_command(main_video_path, params, main_width, main_height, fps, path,
+                                                threads, main_info=main_info, profile=profile),
+        run_command=partial(run_ffmpeg_job, on_progress=on_progress))
+    avatar_segment_path = Path(output_path).with_name(Path(output_path).stem + ".avatar_segment.mp4")
+    try:
+        run_ffmpeg_job(build_avatar_segment_command(main_video_path, avatar_path, params, main_width, main_height,
+                                                    fps, avatar_segment_path, threads, prekeyed,
+                                                    avatar_info=avatar_info, profile=profile),
+                       on_progress=on_progress)
+        stream_copied = concat_segments([avatar_segment_path, main_segment_path], output_path, threads, profile)
+    finally:
+        avatar_segment_path.unlink(missing_ok=True)
+    return cache_hit, stream_copied
+
+
+# --- Chunked Parallel Rendering ---
+
+# Chunks shorter than this aren't worth another encoder start-up and the extra IDR frame.
+MIN_CHUNK_SECONDS = 30
+
+
+def chunk_count_for(main_info, threads):
+    """One chunk per RENDER_THREADS_PER_JOB threads of the job's budget, but none shorter than MIN_CHUNK_SECONDS."""
+    by_threads = max(1, int(threads or os.cpu_count() or 1) // RENDER_THREADS_PER_JOB)
+    by_length = max(1, int(main_info['duration'] // MIN_CHUNK_SECONDS)) if main_info else 1
+    return min(by_threads, by_length)
+
+
+def plan_keyframe_chunks(frame_times, keyframe_times, chunk_count):
+    """
+    Cuts the main video at the keyframes nearest to chunk_count equal parts.
+    Returns [(start_seconds, frame_count)]; the first chunk starts at 0 and the last has no
+    frame_count (it runs to the end). Fewer chunks come back when there are too few keyframes.
+    """
+    if not frame_times or chunk_count <= 1:
+        return [(0.0, None)]
+    first, last = frame_times[0], frame_times[-1]
+    starts = [first]
+    for k in range(1, chunk_count):
+        target = first + (last - first) * k / chunk_count
+        candidates = keyframe_times[bisect_left(keyframe_times, starts[-1] + 1e-9):]
+        if not candidates:
+            break
+        nearest = min(candidates, key=lambda t: abs(t - target))
+        if nearest > starts[-1]:
+            starts.append(nearest)
+    chunks = []
+    for k, start in enumerate(starts):
+        if k + 1 < len(starts):
+            frame_count = bisect_left(frame_times, starts[k + 1]) - bisect_left(frame_times, start)
+        else:
+            frame_count = None
+        # -ss takes microseconds; round down so the keyframe itself lands at t >= 0 and is kept.
+        chunks.append((0.0 if k == 0 else math.floor(start * 1e6) / 1e6, frame_count))
+    return chunks
+
+
+def build_chunk_command(main_video_path, avatar_path, params, main_width, main_height, start, frame_count,
+                        output_path, threads=None, prekeyed=False, profile=None):
+    """
+    One keyframe-aligned chunk of a parallel-mode video, video only. The main video is seeked to start
+    and the avatar's timestamps are shifted back by the same amount, so overlay pairs the same frames
+    as a single-pass render (including the repeated last avatar frame once the avatar has ended).
+    """
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if threads:
+        ffmpeg_command.extend(['-filter_complex_threads', str(threads)])
+    if start:
+        ffmpeg_command.extend(['-ss', f"{start:.6f}"])
+    ffmpeg_command.extend(['-i', str(main_video_path), '-i', str(avatar_path)])
+    shift = f"setpts=PTS-{start:.6f}/TB," if start else ""
+    filter_complex = (
+        f"[0:v]{main_crop_and_scale_filter(params, main_width, main_height)}[main_processed];"
+        f"[1:v]{shift}{avatar_filter_chain(params, prekeyed)}[avatar_processed];"
+        f"[main_processed][avatar_processed]overlay={params['x_pos']}:{params['y_pos']}[final_v]"
+    )
+    filter_complex, video_label = cap_output_video(filter_complex, 'final_v', profile, main_height)
+    ffmpeg_command.extend(['-filter_complex', filter_complex, '-map', video_label])
+    if frame_count:
+        ffmpeg_command.extend(['-frames:v', str(frame_count)])
+    ffmpeg_command.extend(encoder_args(threads, profile))
+    ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+def build_audio_mix_command(main_video_path, avatar_path, output_path, main_info=None, avatar_info=None,
+                            profile=None):
+    """The audio of a parallel-mode video on its own, mixed exactly as in the single-pass graph."""
+    silence = ""
+    main_a_label, avatar_a_label = '0:a', '1:a'
+    if not has_audio(main_info):
+        main_a_label = "silent_main_a"
+        silence += silent_audio_source(main_a_label, main_info['duration'])
+    if not has_audio(avatar_info):
+        avatar_a_label = "silent_avatar_a"
+        silence += silent_audio_source(avatar_a_label, avatar_info['duration'])
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', str(main_video_path),
+                      '-i', str(avatar_path), '-filter_complex',
+                      silence + f"[{main_a_label}][{avatar_a_label}]amix=inputs=2:duration=first[final_a]",
+                      '-map', '[final_a]', '-vn']
+    ffmpeg_command.extend(audio_encoder_args(profile))
+    ffmpeg_command.extend(['-y', str(output_path)])
+    return ffmpeg_command
+
+
+def _combined_progress(blocks):
+    """Adds up the latest -progress blocks of concurrently running chunks into one block for the job."""
+    combined = {'progress': 'continue'}
+    for key in ('frame', 'fps', 'out_time_us', 'speed'):
+        total = 0.0
+        for block in blocks:
+            try:
+                total += float(str(block.get(key, 0)).rstrip('x'))
+            except ValueError:
+                continue
+        combined[key] = str(int(total)) if key in ('frame', 'out_time_us') else f"{total:.2f}"
+    return combined
+
+
+def render_parallel_chunked(main_video_path, avatar_path, params, main_width, main_height, fps, output_path,
+                            chunk_count, threads=None, prekeyed=False, on_progress=None, main_info=None,
+                            avatar_info=None, profile=None):
+    """
+    Renders a parallel-mode video as keyframe-aligned chunks of the main video that are encoded
+    concurrently (sharing the job's thread budget), then joins them with stream copy and muxes in
+    the audio track, which is mixed once over the whole length. Returns the number of chunks used.
+    """
+    keyframes = probe_keyframes(main_video_path)
+    chunks = plan_keyframe_chunks(keyframes[0], keyframes[1], chunk_count) if keyframes else [(0.0, None)]
+    if len(chunks) == 1:
+        run_ffmpeg_job(build_overlay_command(main_video_path, avatar_path, params, main_width, main_height, fps,
+                                             True, output_path, threads=threads, prekeyed=prekeyed,
+                                             main_info=main_info, avatar_info=avatar_info, profile=profile),
+                       on_progress=on_progress)
+        return 1
+
+    output_path = Path(output_path)
+    chunk_paths = [output_path.with_name(f"{output_path.stem}.chunk{k:03d}.mp4") for k in range(len(chunks))]
+    audio_path = output_path.with_name(f"{output_path.stem}.audio.m4a")
+    chunk_threads = max(1, threads // len(chunks)) if threads else None
+    progress_blocks = [{} for _ in chunks]
+    progress_lock = threading.Lock()
+
+    def chunk_progress(k):
+        def update(block):
+            with progress_lock:
+                progress_blocks[k] = block
+                on_progress(_combined_progress(progress_blocks))
+        return update if on_progress else None
+
+    try:
+        run_ffmpeg_job(build_audio_mix_command(main_video_path, avatar_path, audio_path, main_info, avatar_info,
+                                               profile))
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(run_ffmpeg_job,
+                                       build_chunk_command(main_video_path, avatar_path, params, main_width,
+                                                           main_height, start, frame_count, chunk_path,
+                                                           chunk_threads, prekeyed, profile),
+                                       on_progress=chunk_progress(k))
+                       for k, ((start, frame_count), chunk_path) in enumerate(zip(chunks, chunk_paths))]
+            for future in futures:
+                future.result()
+        list_path = write_concat_list(chunk_paths, output_path)
         try:
-            avatar_video_path = Path(avatar_video_path_str)
-            avatar_cap = cv2.VideoCapture(str(avatar_video_path))
-            if not avatar_cap.isOpened(): continue
-            ret_avatar, avatar_frame_bgr = avatar_cap.read()
-            avatar_cap.release()
-            if not ret_avatar: continue
-            params = {}
-            params['zoom_factor'] = random.uniform(1.0, 1.2)
-            cropped_width = int(main_w / params['zoom_factor'])
-            cropped_height = int(main_h / params['zoom_factor'])
-            params['crop_x'] = random.randint(0, main_w - cropped_width)
-            params['crop_y'] = random.randint(0, main_h - cropped_height)
-            target_avatar_height = random.uniform(main_h / 4, main_h / 3)
-            avatar_aspect_ratio = avatar_frame_bgr.shape[1] / avatar_frame_bgr.shape[0]
-            params['scaled_avatar_h'] = int(target_avatar_height)
-            params['scaled_avatar_w'] = int(params['scaled_avatar_h'] * avatar_aspect_ratio)
-            right_boundary = (main_w // 2) - params['scaled_avatar_w']
-            params['x_pos'] = random.randint(0, max(0, right_boundary))
-            params['y_pos'] = main_h - params['scaled_avatar_h']
-            video_params_list.append(params)
-            processed_main_frame = initial_main_frame_bgr[params['crop_y']:params['crop_y'] + cropped_height,
-                                   params['crop_x']:params['crop_x'] + cropped_width]
-            processed_main_frame = cv2.resize(processed_main_frame, (main_w, main_h), interpolation=cv2.INTER_AREA)
-            resized_avatar_frame = cv2.resize(avatar_frame_bgr, (params['scaled_avatar_w'], params['scaled_avatar_h']),
-                                              interpolation=cv2.INTER_AREA)
-            avatar_rgba = remove_green_background_with_alpha(resized_avatar_frame)
-            processed_main_rgb = cv2.cvtColor(processed_main_frame, cv2.COLOR_BGR2RGB)
-            composite_frame_rgb = overlay_alpha(processed_main_rgb.copy(), avatar_rgba, params['x_pos'],
-                                                params['y_pos'])
-            preview_filename = f"preview_{avatar_video_path.stem}.png"
-            preview_path = preview_output_dir / preview_filename
-            cv2.imwrite(str(preview_path), cv2.cvtColor(composite_frame_rgb, cv2.COLOR_RGB2BGR))
-            preview_paths.append(str(preview_path))
-        except Exception as e:
+            run_ffmpeg_job(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                            '-i', str(list_path), '-i', str(audio_path), '-map', '0:v', '-map', '1:a',
+                            '-c', 'copy', '-movflags', '+faststart', '-y', str(output_path)])
+        finally:
+            list_path.unlink(missing_ok=True)
+    finally:
+        for path in chunk_paths + [audio_path]:
+            path.unlink(missing_ok=True)
+    return len(chunks)
+
+
+def available_memory_bytes():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def fanout_chunk_size(main_width, main_height, avatar_count, max_workers):
+    """
+    Picks how many avatars share one decode of the main video. Each branch keeps up to
+    FANOUT_FRAMES_PER_BRANCH frames in flight, so the chunk is sized to fit half of the
+    free memory split between the concurrently running fan-out jobs.
+    """
+    frame_bytes = main_width * main_height * 3
+    per_branch_bytes = max(1, frame_bytes * FANOUT_FRAMES_PER_BRANCH)
+    budget = available_memory_bytes() // 2 // max(1, int(max_workers))
+    chunk_size = budget // per_branch_bytes
+    return max(1, min(int(chunk_size), FANOUT_MAX_CHUNK_SIZE, avatar_count))
+
+
+# How often the UI progress line is refreshed while render jobs are running.
+PROGRESS_POLL_SECONDS = 1.0
+
+
+def run_ffmpeg_job(ffmpeg_command, on_progress=None):
+    """Runs one ffmpeg command; with on_progress, its live `-progress` blocks are passed along."""
+    if on_progress:
+        run_ffmpeg_with_progress(ffmpeg_command, on_progress)
+    else:
+        subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
+
+
+def print_ffmpeg_failure(e):
+    print("--- FFMPEG COMMAND FAILED ---")
+    print("Command:", ' '.join(str(arg) for arg in e.cmd))
+    print("Return Code:", e.returncode)
+    print("--- FFMPEG STDERR ---")
+    print(e.stderr if e.stderr else "N/A")
+    print("-----------------------------")
+
+
+def _run_monitored_job(job, index, monitor):
+    monitor.start(index)
+    on_progress = monitor.progress_callback(index)
+    # Jobs either carry a single ffmpeg 'command' or a 'run' callable for multi-step renders.
+    if 'run' in job:
+        job['run'](on_progress=on_progress)
+    else:
+        run_ffmpeg_job(job['command'], on_progress=on_progress)
+
+
+def render_monitor_for(render_jobs):
+    return RenderMonitor([Path(str(job['outputs'][0][1])).name if len(job['outputs']) == 1
+                          else f"fan-out x{len(job['outputs'])}" for job in render_jobs],
+                         [job.get('expected_seconds') for job in render_jobs])
+
+
+def iter_render_jobs(render_jobs, monitor, max_workers, progress):
+    """
+    Runs the render jobs on a bounded thread pool (each thread just waits on its ffmpeg process)
+    and yields (avatar_index, output_path) for each video as soon as it is written.
+    A job writes one or more outputs, listed as (avatar_index, output_path) pairs in job['outputs'],
+    and may give its expected output duration in job['expected_seconds'] for ETAs.
+    Jobs finish out of order; live frame/fps/speed/ETA of the running jobs is shown through progress
+    and the structured render log, and monitor.summary() gives the batch throughput afterwards.
+    Failed jobs are logged and skipped. The pool keeps rendering while the caller handles a video.
+    """
+    if not render_jobs:
+        return
+    max_workers = max(1, min(int(max_workers), len(render_jobs)))
+    progress(0, desc=f"Rendering {sum(len(job['outputs']) for job in render_jobs)} videos "
+                     f"({max_workers} jobs at a time)")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_index = {executor.submit(_run_monitored_job, job, index, monitor): index
+                           for index, job in enumerate(render_jobs)}
+        pending = set(future_to_index)
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = future_to_index[future]
+                job = render_jobs[index]
+                ok = False
+                try:
+                    future.result()
+                    ok = True
+                except subprocess.CalledProcessError as e:
+                    print_ffmpeg_failure(e)
+                except Exception as e:
+                    print(f"An unexpected error occurred while processing {', '.join(job['avatar_paths'])}:")
+                    print(traceback.format_exc())
+                monitor.finish(index, ok)
+                if ok:
+                    for avatar_index, output_path in job['outputs']:
+                        yield avatar_index, str(output_path)
+            progress(monitor.fraction(), desc=monitor.describe())
+
+
+def prekey_avatars(avatar_paths, max_workers, threads, progress):
+    """
+    Makes sure every avatar has a cached keyed intermediate, keying the misses on the pool.
+    Returns ({avatar_path: keyed_path}, status_lines). Avatars that fail to key are left out
+    and get keyed inline by their render job as before.
+    """
+    keyed_cache = KeyedAvatarCache(COLORKEY_SETTING)
+    unique_paths = list(dict.fromkeys(str(path) for path in avatar_paths))
+    keyed_paths, hits, misses, failures = {}, [], [], []
+    progress(0, desc=f"Pre-keying {len(unique_paths)} avatars")
+    with ThreadPoolExecutor(max_workers=max(1, min(int(max_workers), len(unique_paths)))) as executor:
+        future_to_path = {executor.submit(keyed_cache.get_or_build, path, threads): path for path in unique_paths}
+        for done_count, future in enumerate(as_completed(future_to_path), start=1):
+            path = future_to_path[future]
+            try:
+                keyed_path, cache_hit = future.result()
+                keyed_paths[path] = str(keyed_path)
+                (hits if cache_hit else misses).append(Path(path).name)
+            except subprocess.CalledProcessError as e:
+                print_ffmpeg_failure(e)
+                failures.append(Path(path).name)
+            except Exception as e:
+                print(f"An unexpected error occurred while pre-keying {path}:")
+                print(traceback.format_exc())
+                failures.append(Path(path).name)
+            progress(done_count / len(unique_paths), desc=f"Pre-keyed {done_count}/{len(unique_paths)} avatars")
+    keyed_cache.flush()
+    status_lines = [f"Keyed avatar cache: {len(hits)} hits, {len(misses)} misses, {len(failures)} failed"]
+    if misses:
+        status_lines.append("Keyed now: " + ", ".join(misses))
+    if failures:
+        status_lines.append("Keying failed (keyed inline instead): " + ", ".join(failures))
+    return keyed_paths, status_lines
+
+
+# --- Animated Proxy Previews ---
+
+# Proxy previews run the real filter graph on downscaled, frame-dropped inputs with a throwaway encode,
+# to check timing and keying in seconds before committing to full renders.
+PROXY_WIDTH = 480
+PROXY_FPS = 12
+PROXY_DEFAULT_SECONDS = 4
+PROXY_PROFILE = {'preset': 'ultrafast', 'crf': 30, 'max_height': None, 'audio_bitrate': '64k'}
+
+
+def scale_layout_params(params, scale):
+    """The layout params for the main video resized by `scale` (the zoom factor is unchanged)."""
+    scaled = dict(params)
+    for key in ('crop_x', 'crop_y', 'x_pos', 'y_pos'):
+        scaled[key] = int(round(params[key] * scale))
+    for key in ('scaled_avatar_w', 'scaled_avatar_h'):
+        scaled[key] = max(2, int(round(params[key] * scale)))
+    return scaled
+
+
+def proxy_size(main_width, main_height, proxy_width=PROXY_WIDTH):
+    """Even (width, height) of the proxy frame, never larger than the main video."""
+    width = min(proxy_width, main_width)
+    height = int(round(main_height * width / main_width))
+    return width - width % 2, max(2, height - height % 2)
+
+
+def build_proxy_command(main_video_path, avatar_path, params, main_info, avatar_info, parallel_mode, start_seconds,
+                        duration_seconds, output_path, threads=None):
+    """
+    Builds the ffmpeg command for one animated proxy preview: both inputs are scaled down to the proxy
+    size and frame rate first, then go through the same avatar filter graph with the layout scaled to match.
+    Parallel mode seeks both inputs to start_seconds; sequential mode (avatar first, then the main clip)
+    renders from the start and keeps only the requested range.
+    """
+    proxy_width, proxy_height = proxy_size(main_info['width'], main_info['height'])
+    scale = proxy_width / main_info['width']
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if threads:
+        ffmpeg_command.extend(['-filter_complex_threads', str(threads)])
+    input_seek = ['-ss', f"{start_seconds:.3f}"] if parallel_mode and start_seconds else []
+    ffmpeg_command.extend(input_seek + ['-i', str(main_video_path)])
+    ffmpeg_command.extend(input_seek + ['-i', str(avatar_path)])
+    # Sequential mode reads the main video twice (frozen first frame + full clip), so it is split.
+    main_labels = ['proxy_main0'] if parallel_mode else ['proxy_main0', 'proxy_main1']
+    main_split = f",split={len(main_labels)}" if len(main_labels) > 1 else ""
+    downscale = (
+        f"[0:v]scale={proxy_width}:{proxy_height},fps={PROXY_FPS},setsar=1{main_split}"
+        + "".join(f"[{label}]" for label in main_labels) + ";"
+        f"[1:v]scale=trunc(iw*{scale:.6f}/2)*2:trunc(ih*{scale:.6f}/2)*2,fps={PROXY_FPS}[proxy_avatar];"
+    )
+    filter_complex = downscale + build_avatar_filter_graph(
+        scale_layout_params(params, scale), proxy_width, proxy_height, PROXY_FPS, parallel_mode, main_labels,
+        '0:a' if has_audio(main_info) else None, 'proxy_avatar', '1:a' if has_audio(avatar_info) else None,
+        'final_v', 'final_a', main_audio_seconds=main_info['duration'],
+        avatar_audio_seconds=avatar_info['duration'] if avatar_info else None)
+    ffmpeg_command.extend(['-filter_complex', filter_complex, '-map', '[final_v]', '-map', '[final_a]'])
+    if not parallel_mode and start_seconds:
+        ffmpeg_command.extend(['-ss', f"{start_seconds:.3f}"])
+    ffmpeg_command.extend(['-t', f"{duration_seconds:.3f}"])
+    ffmpeg_command.extend(encoder_args(threads, PROXY_PROFILE))
+    ffmpeg_command.extend(['-movflags', '+faststart', '-y', str(output_path)])
+    return ffmpeg_command
+
+
+def generate_proxy_previews(main_video_path, preview_avatar_paths, video_params, parallel_mode, start_seconds=0,
+                            duration_seconds=PROXY_DEFAULT_SECONDS, progress=gr.Progress()):
+    """
+    Renders a short low-resolution animated preview of every laid-out avatar, all in parallel, using the
+    layouts from the preview step. Returns (proxy_video_paths, status).
+    """
+    if not main_video_path or not preview_avatar_paths or not video_params:
+        gr.Warning("Generate previews first; proxy previews use their layouts.")
+        return [], ""
+    main_info = probe_media(main_video_path)
+    if not main_info:
+        gr.Warning(f"Could not read main video: {main_video_path}")
+        return [], ""
+    start_seconds = max(0.0, float(start_seconds or 0))
+    duration_seconds = float(duration_seconds or PROXY_DEFAULT_SECONDS)
+    output_dir = Path(__file__).parent / "generated_previews" / "proxies"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    items = list(zip(preview_avatar_paths, video_params))
+    media_info = probe_all([path for path, _ in items])
+    # Proxy encodes are tiny, so run about one per core with a single thread each.
+    max_workers = max(1, min(len(items), os.cpu_count() or 1))
+
+    def render(item):
+        avatar_path, params = item
+        mode = 'parallel' if parallel_mode else 'sequential'
+        output_path = output_dir / f"proxy_{mode}_{Path(avatar_path).stem}.mp4"
+        try:
+            run_ffmpeg_job(build_proxy_command(main_video_path, avatar_path, params, main_info,
+                                               media_info.get(str(avatar_path)), parallel_mode, start_seconds,
+                                               duration_seconds, output_path, threads=1))
+            return str(output_path)
+        except subprocess.CalledProcessError as e:
+            print_ffmpeg_failure(e)
+        except Exception:
             print(traceback.format_exc())
-            continue
-    return video_params_list, preview_paths
+        return None
 
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        proxy_paths = list(progress.tqdm(executor.map(render, items), total=len(items),
+                                         desc="Rendering Proxy Previews"))
+    rendered = [path for path in proxy_paths if path]
+    status = (f"Rendered {len(rendered)}/{len(items)} proxy previews of {duration_seconds:g}s from "
+              f"{start_seconds:g}s at {proxy_size(main_info['width'], main_info['height'])[0]}px, "
+              f"{PROXY_FPS} fps in {time.time() - start:.1f}s")
+    return rendered, status
 
-# --- REFACTORED Video Generation Function (All FFMPEG) ---
-def generate_videos(main_video_path, avatar_file_paths, video_params, parallel_mode, progress=gr.Progress()):
+
+# Where generate_videos renders when no output_dir is given.
+GENERATED_VIDEOS_DIR = Path(__file__).parent / "generated_videos"
+
+
+def output_filename(avatar_path, parallel_mode):
+    """The name of an avatar's rendered video in the output directory."""
+    return f"final_{'parallel' if parallel_mode else 'sequential'}_{Path(avatar_path).stem}.mp4"
+
+
+def compute_render_key(main_video_path, avatar_path, params, parallel_mode, segmented, profile=None):
+    """
+    Hash of everything that determines an output's content: the main and avatar contents, the layout,
+    the mode and the encode profile. Fan-out and pre-keying are left out; they produce the same video.
+    """
+    profile = profile or encode_profile()
+    identity = {
+        'main': sampled_content_hash(main_video_path),
+        'avatar': sampled_content_hash(avatar_path),
+        'params': params,
+        'mode': 'parallel' if parallel_mode else 'sequential',
+        'segmented': bool(segmented and not parallel_mode),
+        'encoder': encoder_args(profile=profile),
+        'max_height': profile['max_height'],
+    }
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+# --- Render Time Estimates ---
+
+def load_encode_calibration(path=ENCODE_CALIBRATION_PATH):
+    """The calibration written by `overlay_bench.py calibrate`, or None if this host hasn't been calibrated."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return calibration if calibration.get('profiles') else None
+
+
+def estimate_batch_seconds(main_info, avatar_infos, parallel_mode, calibration):
+    """
+    Estimated wall time of a batch for each calibrated profile, {profile_name: seconds}. The batch's
+    output frames are divided by the profile's calibrated batch fps, scaled by the main video's pixel
+    count relative to the calibration clip.
+    """
+    output_seconds = 0.0
+    for avatar_info in avatar_infos:
+        output_seconds += main_info['duration']
+        if not parallel_mode and avatar_info:
+            output_seconds += avatar_info['duration']
+    output_frames = output_seconds * main_info['fps_float']
+    pixel_ratio = (main_info['width'] * main_info['height']) / (calibration['width'] * calibration['height'])
+    return {name: output_frames * pixel_ratio / calibration['profiles'][name]['batch_fps']
+            for name in ENCODE_PROFILES if calibration['profiles'].get(name, {}).get('batch_fps')}
+
+
+def pick_encode_profile(estimates, deadline_seconds):
+    """
+    The highest-quality profile whose estimate meets the deadline; the fastest one if none does,
+    and the default profile without estimates or a deadline.
+    """
+    if not estimates or not deadline_seconds:
+        return DEFAULT_ENCODE_PROFILE
+    fitting = [name for name in ENCODE_PROFILES if name in estimates and estimates[name] <= deadline_seconds]
+    if fitting:
+        return fitting[-1]
+    return min(estimates, key=estimates.get)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def resolve_encode_profile(profile_name, main_info, avatar_infos, parallel_mode, deadline_minutes):
+    """
+    Turns the UI's profile choice ('auto' or a profile name) into (profile_name, status_line).
+    'auto' picks by deadline from the host's calibration.
+    """
+    calibration = load_encode_calibration()
+    estimates = estimate_batch_seconds(main_info, avatar_infos, parallel_mode, calibration) if calibration else {}
+    deadline_seconds = (deadline_minutes or 0) * 60
+    if profile_name in (None, "", "auto"):
+        profile_name = pick_encode_profile(estimates, deadline_seconds)
+    else:
+        encode_profile(profile_name)
+    status = f"Encode profile: {profile_name}"
+    if profile_name in estimates:
+        status += f" (estimated {format_duration(estimates[profile_name])}"
+        if deadline_seconds:
+            verdict = "within" if estimates[profile_name] <= deadline_seconds else "over"
+            status += f", {verdict} the {format_duration(deadline_seconds)} deadline"
+        status += ")"
+    elif not calibration:
+        status += " (no calibration; run `python overlay_bench.py calibrate` for estimates)"
+    return profile_name, status
+
+
+def estimate_render_time(main_video_path, avatar_file_paths, parallel_mode, deadline_minutes):
+    """UI handler: a Markdown table of the estimated batch time of each profile and the one 'auto' would pick."""
+    if not main_video_path or not avatar_file_paths:
+        return "Upload a main video and avatar videos to estimate the render time."
+    calibration = load_encode_calibration()
+    if not calibration:
+        return "This host has no encode calibration yet. Run `python overlay_bench.py calibrate` once."
+    media_info = probe_all([main_video_path] + list(avatar_file_paths))
+    main_info = media_info.get(str(main_video_path))
+    if not main_info:
+        return f"Could not read main video: {main_video_path}"
+    avatar_infos = [media_info.get(str(path)) for path in avatar_file_paths]
+    estimates = estimate_batch_seconds(main_info, avatar_infos, parallel_mode, calibration)
+    deadline_seconds = (deadline_minutes or 0) * 60
+    lines = ["| Profile | Estimated time |", "|---|---|"]
+    lines.extend(f"| {name} | {format_duration(seconds)} |" for name, seconds in estimates.items())
+    if deadline_seconds:
+        lines.append(f"\nAuto picks **{pick_encode_profile(estimates, deadline_seconds)}** for a "
+                     f"{format_duration(deadline_seconds)} deadline.")
+    lines.append(f"\nCalibrated on {calibration.get('host', 'this host')} with {calibration.get('workers')} "
+                 f"concurrent jobs; estimates assume the same concurrency.")
+    return "\n".join(lines)
+
+
+# --- ZIP Assembly ---
+
+# Re-deflating H.264/AAC gains nothing, so these are stored as-is.
+PRECOMPRESSED_SUFFIXES = {'.mp4', '.mov', '.mkv', '.webm', '.m4a', '.mp3', '.png', '.jpg', '.jpeg', '.webp'}
+ZIP_STREAM_ROUTE = "/zip-stream"
+# How many finished batches stay downloadable through the streaming route.
+MAX_STREAMED_ZIP_BATCHES = 32
+STREAMED_ZIP_BATCHES = OrderedDict()
+
+
+def zip_compression_for(path):
+    return zipfile.ZIP_STORED if Path(path).suffix.lower() in PRECOMPRESSED_SUFFIXES else zipfile.ZIP_DEFLATED
+
+
+def add_file_to_zip(zf, file_path):
+    file_path = Path(file_path)
+    zf.write(file_path, arcname=file_path.name, compress_type=zip_compression_for(file_path))
+
+
+class _ZipStreamBuffer:
+    """Write-only file object for zipfile; it has no tell()/seek(), so zipfile writes a streamable archive."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip_stream(file_paths, chunk_size=1024 * 1024):
+    """Yields a ZIP archive of file_paths chunk by chunk, without staging the archive on disk."""
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zf:
+        for file_path in file_paths:
+            file_path = Path(file_path)
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname=file_path.name)
+            zinfo.compress_type = zip_compression_for(file_path)
+            with open(file_path, "rb") as src, zf.open(zinfo, 'w', force_zip64=True) as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dest.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+            data = buffer.take()
+            if data:
+                yield data
+    yield buffer.take()
+
+
+def register_zip_stream(file_paths):
+    """Makes a finished batch downloadable at ZIP_STREAM_ROUTE/<batch_id> and returns the batch id."""
+    batch_id = os.urandom(8).hex()
+    STREAMED_ZIP_BATCHES[batch_id] = [str(path) for path in file_paths]
+    while len(STREAMED_ZIP_BATCHES) > MAX_STREAMED_ZIP_BATCHES:
+        STREAMED_ZIP_BATCHES.popitem(last=False)
+    return batch_id
+
+
+def stream_zip_download(batch_id: str):
+    """FastAPI route that streams a registered batch as a ZIP straight into the response."""
+    file_paths = STREAMED_ZIP_BATCHES.get(batch_id)
+    if file_paths is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch")
+    return StreamingResponse(iter_zip_stream(file_paths), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="videos_{batch_id}.zip"'})
+
+
+def generate_videos(main_video_path, avatar_file_paths, video_params, parallel_mode, max_workers=None,
+                    fanout_mode=False, prekey_mode=False, stream_zip=False, segment_cache_mode=False,
+                    chunked_mode=False, encode_profile_name=DEFAULT_ENCODE_PROFILE, deadline_minutes=0,
+                    output_dir=None, progress=gr.Progress()):
+    """
+    Renders one video per avatar with its layout from video_params (aligned by index) into output_dir
+    (generated_videos by default). encode_profile_name is an ENCODE_PROFILES name, or 'auto' to pick
+    by deadline_minutes from the host's calibration.
+
+    A generator for the UI: yields (video_paths, zip_path, download_button_update, status,
+    zip_stream_link_update) each time a video finishes, so finished videos can be downloaded while
+    the rest render. The ZIP (and its button or stream link) only appears in the last yield, once
+    the batch is complete. Scripts can use render_videos for just the final result.
+    """
     if not main_video_path or not avatar_file_paths:
         gr.Warning("Upload both a main video and avatar videos.")
-        return [], None, gr.update(visible=False)
+        yield [], None, gr.update(visible=False), "", gr.update(visible=False)
+        return
     if not video_params:
         gr.Warning("Please generate previews first to set the video layouts.")
-        return [], None, gr.update(visible=False)
+        yield [], None, gr.update(visible=False), "", gr.update(visible=False)
+        return
 
-    generated_video_paths = []
-    script_dir = Path(__file__).parent
-    video_output_dir = script_dir / "generated_videos"
+    video_output_dir = Path(output_dir) if output_dir else GENERATED_VIDEOS_DIR
     video_output_dir.mkdir(parents=True, exist_ok=True)
 
-    main_clip_info = cv2.VideoCapture(str(main_video_path))
-    main_width = int(main_clip_info.get(cv2.CAP_PROP_FRAME_WIDTH))
-    main_height = int(main_clip_info.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = main_clip_info.get(cv2.CAP_PROP_FPS)
-    main_clip_info.release()
-    if fps == 0:
-        fps = 30
+    # One concurrent ffprobe pass over every input (memoized, so previews already warmed most of it).
+    media_info = probe_all([main_video_path] + list(avatar_file_paths))
+    main_info = media_info.get(str(main_video_path))
+    if not main_info:
+        gr.Warning(f"Could not read main video: {main_video_path}")
+        yield [], None, gr.update(visible=False), "", gr.update(visible=False)
+        return
+    main_width, main_height = main_info['width'], main_info['height']
+    # Exact rational rate (e.g. 30000/1001), so the frozen segment matches the main clip's timing.
+    fps = main_info['fps']
+    main_duration = main_info['duration']
 
-    for i, avatar_path_str in enumerate(progress.tqdm(avatar_file_paths, desc="Generating Videos")):
-        try:
-            params = video_params[i]
-            avatar_path = Path(avatar_path_str)
-            output_filename = f"final_{'parallel' if parallel_mode else 'sequential'}_{avatar_path.stem}.mp4"
-            output_path = video_output_dir / output_filename
-
-            crop_x, crop_y = params['crop_x'], params['crop_y']
-            zoom_factor = params['zoom_factor']
-            cropped_width = int(main_width / zoom_factor)
-            cropped_height = int(main_height / zoom_factor)
-            scaled_avatar_w, scaled_avatar_h = params['scaled_avatar_w'], params['scaled_avatar_h']
-            x_pos, y_pos = params['x_pos'], params['y_pos']
-
-            ffmpeg_command = [
-                'ffmpeg', '-hide_banner', '-loglevel', 'error',
-                '-i', str(main_video_path),
-                '-i', str(avatar_path),
-            ]
-
-            colorkey_setting = "colorkey=0x00FF00:0.4:0.1"
-
-            if parallel_mode:
-                filter_complex = (
-                    f"[0:v]crop={cropped_width}:{cropped_height}:{crop_x}:{crop_y},scale={main_width}:{main_height},setsar=1[main_processed];"
-                    f"[1:v]format=yuv444p,{colorkey_setting},scale={scaled_avatar_w}:{scaled_avatar_h},setsar=1[avatar_processed];"
-                    f"[main_processed][avatar_processed]overlay={x_pos}:{y_pos}[final_v];"
-                    f"[0:a][1:a]amix=inputs=2:duration=first[final_a]"
-                )
-                ffmpeg_command.extend(['-filter_complex', filter_complex, '-map', '[final_v]', '-map', '[final_a]'])
-            else:
-                filter_complex = (
-                    f"[0:v]trim=end_frame=1,loop=-1:size=1,setpts=PTS-STARTPTS,fps={fps},crop={cropped_width}:{cropped_height}:{crop_x}:{crop_y},scale={main_width}:{main_height},setsar=1[frozen_bg];"
-                    f"[1:v]format=yuv444p,{colorkey_setting},scale={scaled_avatar_w}:{scaled_avatar_h},setsar=1[avatar_processed];"
-                    f"[frozen_bg][avatar_processed]overlay={x_pos}:{y_pos}:shortest=1[part1_v];"
-                    f"[0:v]crop={cropped_width}:{cropped_height}:{crop_x}:{crop_y},scale={main_width}:{main_height},setsar=1[part2_v];"
-                    f"[part1_v][1:a][part2_v][0:a]concat=n=2:v=1:a=1[final_v][final_a]"
-                )
-                ffmpeg_command.extend(['-filter_complex', filter_complex, '-map', '[final_v]', '-map', '[final_a]'])
-
-            ffmpeg_command.extend(
-                ['-c:v', 'libx264', '-preset', 'fast', '-crf', '18', '-c:a', 'aac', '-b:a', '192k', '-y',
-                 str(output_path)])
-
-            subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
-            generated_video_paths.append(str(output_path))
+    def expected_seconds(avatar_path):
+        """Output duration used for progress ETAs: the main clip, plus the avatar clip in sequential mode."""
+        if parallel_mode:
+            return main_duration
+        avatar_info = media_info.get(str(avatar_path))
+        return main_duration + (avatar_info['duration'] if avatar_info else 0.0)
 
-        except subprocess.CalledProcessError as e:
-            print("--- FFMPEG COMMAND FAILED ---")
-            print("Command:", ' '.join(e.args))
-            print("Return Code:", e.returncode)
-            print("--- FFMPEG STDERR ---")
-            print(e.stderr if e.stderr else "N/A")
-            print("-----------------------------")
+    if not max_workers:
+        max_workers = default_render_workers(len(avatar_file_paths))
+    threads = threads_per_render_job(max_workers)
+
+    try:
+        profile_name, profile_status = resolve_encode_profile(
+            encode_profile_name, main_info, [media_info.get(str(path)) for path in avatar_file_paths],
+            parallel_mode, deadline_minutes)
+    except ValueError as e:
+        gr.Warning(str(e))
+        yield [], None, gr.update(visible=False), "", gr.update(visible=False)
+        return
+    profile = encode_profile(profile_name)
+
+    avatar_items = []
+    for i, avatar_path_str in enumerate(avatar_file_paths):
+        if i >= len(video_params):
+            print(f"No layout params for {avatar_path_str}, skipping. Regenerate the previews.")
             continue
-        except Exception as e:
-            print(f"An unexpected error occurred while processing {avatar_path_str}:")
+        avatar_path = Path(avatar_path_str)
+        avatar_items.append((i, avatar_path, video_params[i], video_output_dir / output_filename(avatar_path,
+                                                                                                 parallel_mode)))
+
+    # Skip outputs the manifest says are already up to date; anything missing, changed or
+    # left half-written by an interrupted batch is rendered again.
+    manifest = RenderManifest.for_directory(video_output_dir)
+    render_keys, finished_paths, pending_items = {}, {}, []
+    for item in avatar_items:
+        i, avatar_path, params, output_path = item
+        try:
+            render_keys[i] = compute_render_key(main_video_path, avatar_path, params, parallel_mode,
+                                                segment_cache_mode, profile)
+        except OSError:
             print(traceback.format_exc())
             continue
+        if manifest.is_up_to_date(output_path, render_keys[i]):
+            finished_paths[i] = str(output_path)
+        else:
+            pending_items.append(item)
+    skipped_count = len(finished_paths)
+    all_items, avatar_items = avatar_items, pending_items
+
+    status_lines = [profile_status]
+    keyed_paths = {}
+    if prekey_mode:
+        keyed_paths, prekey_lines = prekey_avatars([item[1] for item in avatar_items], max_workers, threads,
+                                                   progress) if avatar_items else ({}, [])
+        status_lines.extend(prekey_lines)
+
+    def render_input(avatar_path):
+        keyed_path = keyed_paths.get(str(avatar_path))
+        return (keyed_path, True) if keyed_path else (avatar_path, False)
+
+    render_jobs = []
+    segment_cache = SegmentCache() if segment_cache_mode and not parallel_mode else None
+    segment_results = []
+
+    def render_segmented(input_path, params, output_path, prekeyed, avatar_info, on_progress=None):
+        segment_results.append(render_sequential_segmented(main_video_path, input_path, params, main_width,
+                                                           main_height, fps, output_path, segment_cache,
+                                                           threads=threads, prekeyed=prekeyed,
+                                                           on_progress=on_progress, main_info=main_info,
+                                                           avatar_info=avatar_info, profile=profile))
+
+    chunked_mode = chunked_mode and parallel_mode
+    chunk_counts = []
+
+    def render_chunked(input_path, params, output_path, prekeyed, avatar_info, on_progress=None):
+        chunk_counts.append(render_parallel_chunked(main_video_path, input_path, params, main_width, main_height,
+                                                    fps, output_path, chunk_count_for(main_info, threads),
+                                                    threads=threads, prekeyed=prekeyed, on_progress=on_progress,
+                                                    main_info=main_info, avatar_info=avatar_info,
+                                                    profile=profile))
+
+    if fanout_mode and parallel_mode and not chunked_mode:
+        # Sequential mode holds the main clip back until the avatar segment ends, which would make
+        # a shared split buffer the whole avatar duration, so fan-out is only used in parallel mode.
+        chunk_size = fanout_chunk_size(main_width, main_height, len(avatar_items), max_workers)
+        for chunk_start in range(0, len(avatar_items), chunk_size):
+            chunk = avatar_items[chunk_start:chunk_start + chunk_size]
+            inputs = [render_input(item[1]) for item in chunk]
+            ffmpeg_command = build_fanout_command(main_video_path, [path for path, _ in inputs],
+                                                  [item[2] for item in chunk], main_width, main_height, fps,
+                                                  [item[3] for item in chunk], threads=threads,
+                                                  prekeyed=[prekeyed for _, prekeyed in inputs], main_info=main_info,
+                                                  avatar_infos=[media_info.get(str(item[1])) for item in chunk],
+                                                  profile=profile)
+            render_jobs.append({'avatar_paths': [str(item[1]) for item in chunk],
+                                'outputs': [(item[0], item[3]) for item in chunk],
+                                'expected_seconds': main_duration, 'command': ffmpeg_command})
+    else:
+        for i, avatar_path, params, output_path in avatar_items:
+            try:
+                input_path, prekeyed = render_input(avatar_path)
+                if segment_cache or chunked_mode:
+                    render_jobs.append({'avatar_paths': [str(avatar_path)], 'outputs': [(i, output_path)],
+                                        'expected_seconds': expected_seconds(avatar_path),
+                                        'run': partial(render_chunked if chunked_mode else render_segmented,
+                                                       input_path, params, output_path, prekeyed,
+                                                       media_info.get(str(avatar_path)))})
+                    continue
+                ffmpeg_command = build_overlay_command(main_video_path, input_path, params, main_width, main_height,
+                                                       fps, parallel_mode, output_path, threads=threads,
+                                                       prekeyed=prekeyed, main_info=main_info,
+                                                       avatar_info=media_info.get(str(avatar_path)), profile=profile)
+                render_jobs.append({'avatar_paths': [str(avatar_path)], 'outputs': [(i, output_path)],
+                                    'expected_seconds': expected_seconds(avatar_path), 'command': ffmpeg_command})
+            except Exception as e:
+                print(f"An unexpected error occurred while processing {avatar_path}:")
+                print(traceback.format_exc())
+                continue
+
+    # The staged ZIP is filled in as each video finishes, so it is complete when the last render is.
+    zip_path, zf = None, None
+    if not stream_zip:
+        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp_zip:
+            zip_path = tmp_zip.name
+        zf = zipfile.ZipFile(zip_path, 'w', allowZip64=True)
+        for path in finished_paths.values():
+            add_file_to_zip(zf, path)
+
+    def ordered_paths():
+        return [finished_paths[index] for index in sorted(finished_paths)]
+
+    def running_status(rendered_count):
+        return "\n".join(status_lines + [f"Rendered {rendered_count}/{len(avatar_items)} videos so far, "
+                                         f"{skipped_count}/{len(all_items)} already up to date"])
+
+    monitor = render_monitor_for(render_jobs)
+    rendered_paths = []
+    try:
+        # Hides the previous batch's ZIP right away and lists the outputs that are already up to date.
+        yield ordered_paths(), None, gr.update(visible=False), running_status(0), gr.update(visible=False)
+        for avatar_index, output_path in iter_render_jobs(render_jobs, monitor, max_workers, progress):
+            manifest.record(output_path, render_keys[avatar_index])
+            finished_paths[avatar_index] = output_path
+            rendered_paths.append(output_path)
+            if zf:
+                add_file_to_zip(zf, output_path)
+            yield (ordered_paths(), None, gr.update(visible=False), running_status(len(rendered_paths)),
+                   gr.update(visible=False))
+    finally:
+        if zf:
+            zf.close()
+    throughput_lines = monitor.summary() if render_jobs else []
+    generated_video_paths = ordered_paths()
+    if segment_cache:
+        segment_cache.flush()
+        hits = sum(1 for cache_hit, _ in segment_results if cache_hit)
+        copied = sum(1 for _, stream_copied in segment_results if stream_copied)
+        status_lines.append(f"Main-video segment cache: {hits} hits, {len(segment_results) - hits} misses; "
+                            f"{copied}/{len(segment_results)} joined with stream copy")
+    if chunk_counts:
+        status_lines.append(f"Chunked encoding: {sum(chunk_counts)} keyframe-aligned chunks over "
+                            f"{len(chunk_counts)} videos")
+    status_lines.append(f"Rendered {len(rendered_paths)}/{len(avatar_items)} videos, "
+                        f"{skipped_count}/{len(all_items)} already up to date")
+    status_lines.extend(throughput_lines)
 
-    # After generating all videos, create the zip file
     if not generated_video_paths:
-        return [], None, gr.update(visible=False)
+        if zip_path:
+            os.remove(zip_path)
+        yield [], None, gr.update(visible=False), "\n".join(status_lines), gr.update(visible=False)
+        return
+
+    if stream_zip:
+        batch_id = register_zip_stream(generated_video_paths)
+        stream_link = f"[Download All as ZIP (streamed)]({ZIP_STREAM_ROUTE}/{batch_id})"
+        yield (generated_video_paths, None, gr.update(visible=False), "\n".join(status_lines),
+               gr.update(value=stream_link, visible=True))
+        return
 
-    progress(0.9, desc="Zipping files...")
-    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp_zip:
-        zip_path = tmp_zip.name
+    # The complete batch: paths for the file list, the path for the zip file, and make the button visible
+    yield (generated_video_paths, zip_path, gr.update(visible=True), "\n".join(status_lines),
+           gr.update(visible=False))
 
-    with zipfile.ZipFile(zip_path, 'w') as zf:
-        for file_path_str in generated_video_paths:
-            file_path = Path(file_path_str)
-            zf.write(file_path, arcname=file_path.name)
 
-    # Return paths for the file list, the path for the zip file, and make the button visible
-    return generated_video_paths, zip_path, gr.update(visible=True)
+def render_videos(*args, **kwargs):
+    """Runs generate_videos to the end and returns its final (video_paths, zip_path, ..., status, ...) tuple."""
+    result = None
+    for result in generate_videos(*args, **kwargs):
+        pass
+    return result
 
 
 def get_zip_path(zip_path_from_state):
@@ -306,73 +1514,132 @@ def get_zip_path(zip_path_from_state):
 
 
 # --- Gradio UI Setup ---
-with gr.Blocks(title="Advanced Avatar Overlay App", theme=gr.themes.Soft()) as demo:
-    gr.Markdown("# Advanced Avatar Overlay App (FFMPEG Powered)")
-    gr.Markdown(
-        "Create dynamic videos by overlaying a green-screen avatar onto a main video. All video processing is handled by FFMPEG for maximum speed.")
-    video_params_state = gr.State([])
-    # State to hold the path of the final zip file
-    zip_path_state = gr.State(None)
-
-    with gr.Row():
-        with gr.Column(scale=1):
-            gr.Markdown("### 1. Upload Main Video")
-            main_video_input = gr.Video(label="Upload Main Video")
-            gdrive_url_main = gr.Textbox(label="Or, Google Drive URL for Main Video",
-                                         placeholder="Enter Google Drive File URL", lines=1)
-            gdrive_main_btn = gr.Button("Download Main Video from URL")
-            main_video_status = gr.Textbox(label="Download Status", interactive=False, visible=False)
-        with gr.Column(scale=1):
-            gr.Markdown("### 2. Upload Avatar Videos")
-            avatar_file_input = gr.File(label="Upload Green Screen Avatar Videos", file_count="multiple",
-                                        file_types=["video"], type="filepath")
-            gdrive_url_avatar = gr.Textbox(label="Or, Google Drive URL for Avatars",
-                                           placeholder="Enter Google Drive Folder URL", lines=1)
-            gdrive_avatar_btn = gr.Button("Download Avatars from Folder URL")
-            avatar_folder_status = gr.Textbox(label="Download Status", interactive=False, visible=False)
-    with gr.Row():
-        with gr.Column(scale=2):
-            gr.Markdown("### 3. Generate Previews & Videos")
-            preview_btn = gr.Button("A) Generate Randomized Previews", variant="secondary")
-            gr.Markdown("First, generate previews to lock-in a random layout for each video.")
-            parallel_mode_checkbox = gr.Checkbox(label="Parallel Mode (Avatar and main video play at the same time)",
-                                                 value=True)
-            generate_btn = gr.Button("B) Generate Final Videos & ZIP", variant="primary")
-            gr.Markdown("Second, generate the final high-quality videos and prepare the ZIP file for download.")
-
-    with gr.Tabs():
-        with gr.TabItem("Previews"):
-            generated_previews_gallery = gr.Gallery(label="Generated Previews", columns=6, object_fit="contain",
-                                                    height="auto")
-        with gr.TabItem("Final Videos"):
-            generated_videos_output = gr.File(label="Generated Videos", file_count="multiple", interactive=False)
-            download_all_btn = gr.DownloadButton("Download All as ZIP", variant="primary", visible=False)
-
-    preview_btn.click(fn=generate_all_previews, inputs=[main_video_input, avatar_file_input],
-                      outputs=[video_params_state, generated_previews_gallery])
-
-    generate_btn.click(
-        fn=generate_videos,
-        inputs=[main_video_input, avatar_file_input, video_params_state, parallel_mode_checkbox],
-        outputs=[generated_videos_output, zip_path_state, download_all_btn]
-    )
+def build_demo():
+    """Builds the Gradio UI. Kept out of module import so scripts (see overlay_cli.py) can use the render logic."""
+    with gr.Blocks(title="Advanced Avatar Overlay App", theme=gr.themes.Soft()) as demo:
+        gr.Markdown("# Advanced Avatar Overlay App (FFMPEG Powered)")
+        gr.Markdown(
+            "Create dynamic videos by overlaying a green-screen avatar onto a main video. All video processing is handled by FFMPEG for maximum speed.")
+        video_params_state = gr.State([])
+        # Avatar path behind each preview, for opening its full-resolution composite
+        preview_avatars_state = gr.State([])
+        # State to hold the path of the final zip file
+        zip_path_state = gr.State(None)
 
-    download_all_btn.click(
-        fn=get_zip_path,
-        inputs=[zip_path_state],
-        outputs=download_all_btn
-    )
+        with gr.Row():
+            with gr.Column(scale=1):
+                gr.Markdown("### 1. Upload Main Video")
+                main_video_input = gr.Video(label="Upload Main Video")
+                gdrive_url_main = gr.Textbox(label="Or, Google Drive URL for Main Video",
+                                             placeholder="Enter Google Drive File URL", lines=1)
+                gdrive_main_btn = gr.Button("Download Main Video from URL")
+                main_video_status = gr.Textbox(label="Download Status", interactive=False, visible=False)
+            with gr.Column(scale=1):
+                gr.Markdown("### 2. Upload Avatar Videos")
+                avatar_file_input = gr.File(label="Upload Green Screen Avatar Videos", file_count="multiple",
+                                            file_types=["video"], type="filepath")
+                gdrive_url_avatar = gr.Textbox(label="Or, Google Drive URL for Avatars",
+                                               placeholder="Enter Google Drive Folder URL", lines=1)
+                gdrive_avatar_btn = gr.Button("Download Avatars from Folder URL")
+                avatar_folder_status = gr.Textbox(label="Download Status", interactive=False, visible=False)
+        with gr.Row():
+            with gr.Column(scale=2):
+                gr.Markdown("### 3. Generate Previews & Videos")
+                preview_btn = gr.Button("A) Generate Randomized Previews", variant="secondary")
+                gr.Markdown("First, generate previews to lock-in a random layout for each video.")
+                parallel_mode_checkbox = gr.Checkbox(label="Parallel Mode (Avatar and main video play at the same time)",
+                                                     value=True)
+                render_workers_slider = gr.Slider(minimum=1, maximum=max(1, os.cpu_count() or 1),
+                                                  value=default_render_workers(), step=1,
+                                                  label="Concurrent Render Jobs")
+                fanout_mode_checkbox = gr.Checkbox(label="Single-Decode Fan-Out (Parallel Mode only: decode the main "
+                                                         "video once for a group of avatars)", value=False)
+                chunked_mode_checkbox = gr.Checkbox(label="Chunked Encoding (Parallel Mode only: split long main "
+                                                          "videos at keyframes and encode the chunks concurrently)",
+                                                    value=False)
+                prekey_mode_checkbox = gr.Checkbox(label="Reuse Pre-Keyed Avatars (chroma-key each avatar once and "
+                                                         "cache the result)", value=False)
+                segment_cache_checkbox = gr.Checkbox(label="Sequential Mode: Reuse Cached Main-Video Segment (only "
+                                                           "the avatar segment is encoded, then stream-copy joined)",
+                                                     value=True)
+                stream_zip_checkbox = gr.Checkbox(label="Stream ZIP Download (build the ZIP on the fly instead of "
+                                                        "staging a copy on disk)", value=False)
+                with gr.Row():
+                    encode_profile_dropdown = gr.Dropdown(choices=["auto"] + list(ENCODE_PROFILES),
+                                                          value=DEFAULT_ENCODE_PROFILE, label="Encode Profile")
+                    deadline_input = gr.Number(value=0, minimum=0, precision=0,
+                                               label="Deadline in Minutes (used by 'auto', 0 = none)")
+                estimate_btn = gr.Button("Estimate Render Time")
+                estimate_output = gr.Markdown()
+                generate_btn = gr.Button("B) Generate Final Videos & ZIP", variant="primary")
+                gr.Markdown("Second, generate the final high-quality videos and prepare the ZIP file for download.")
+
+        with gr.Tabs():
+            with gr.TabItem("Previews"):
+                generated_previews_gallery = gr.Gallery(label="Generated Previews", columns=6, object_fit="contain",
+                                                        height="auto")
+                full_preview_image = gr.Image(label="Full-Resolution Preview (click a preview above)", type="filepath",
+                                              interactive=False, visible=False)
+                with gr.Row():
+                    proxy_start_input = gr.Number(value=0, minimum=0, label="Proxy Start (seconds)")
+                    proxy_duration_input = gr.Number(value=PROXY_DEFAULT_SECONDS, minimum=1, maximum=60,
+                                                     label="Proxy Length (seconds)")
+                    proxy_btn = gr.Button("Render Animated Proxy Previews (low-res, checks timing and keying)")
+                proxy_status = gr.Textbox(label="Proxy Status", interactive=False)
+                proxy_gallery = gr.Gallery(label="Animated Proxy Previews", columns=4, object_fit="contain",
+                                           height="auto")
+            with gr.TabItem("Final Videos"):
+                generated_videos_output = gr.File(label="Generated Videos", file_count="multiple", interactive=False)
+                download_all_btn = gr.DownloadButton("Download All as ZIP", variant="primary", visible=False)
+                zip_stream_link = gr.Markdown(visible=False)
+                render_status = gr.Textbox(label="Render Status", interactive=False, lines=3)
+
+        preview_btn.click(fn=generate_all_previews, inputs=[main_video_input, avatar_file_input],
+                          outputs=[video_params_state, generated_previews_gallery, preview_avatars_state])
+        proxy_btn.click(fn=generate_proxy_previews,
+                        inputs=[main_video_input, preview_avatars_state, video_params_state, parallel_mode_checkbox,
+                                proxy_start_input, proxy_duration_input],
+                        outputs=[proxy_gallery, proxy_status])
+        generated_previews_gallery.select(fn=open_full_preview,
+                                          inputs=[main_video_input, preview_avatars_state, video_params_state],
+                                          outputs=full_preview_image)
+
+        generate_btn.click(
+            fn=generate_videos,
+            inputs=[main_video_input, avatar_file_input, video_params_state, parallel_mode_checkbox,
+                    render_workers_slider, fanout_mode_checkbox, prekey_mode_checkbox, stream_zip_checkbox,
+                    segment_cache_checkbox, chunked_mode_checkbox, encode_profile_dropdown, deadline_input],
+            outputs=[generated_videos_output, zip_path_state, download_all_btn, render_status, zip_stream_link]
+        )
+
+        estimate_btn.click(fn=estimate_render_time,
+                           inputs=[main_video_input, avatar_file_input, parallel_mode_checkbox, deadline_input],
+                           outputs=estimate_output)
+
+        download_all_btn.click(
+            fn=get_zip_path,
+            inputs=[zip_path_state],
+            outputs=download_all_btn
+        )
+
+        gdrive_main_btn.click(fn=download_gdrive_file_for_single_mode, inputs=[gdrive_url_main],
+                              outputs=[main_video_input, main_video_status])
+        gdrive_avatar_btn.click(fn=download_gdrive_folder, inputs=[gdrive_url_avatar, main_video_input],
+                                outputs=[avatar_file_input, avatar_folder_status, video_params_state,
+                                         generated_previews_gallery, preview_avatars_state])
+    return demo
 
-    gdrive_main_btn.click(fn=download_gdrive_file_for_single_mode, inputs=[gdrive_url_main],
-                          outputs=[main_video_input, main_video_status])
-    gdrive_avatar_btn.click(fn=download_gdrive_folder, inputs=[gdrive_url_avatar],
-                            outputs=[avatar_file_input, avatar_folder_status])
 
 if __name__ == "__main__":
     script_dir = Path(__file__).parent
-    for folder in ["generated_videos", "generated_previews", "downloaded_avatar_folders", "downloaded_files"]:
+    # generated_videos is kept: its render manifest lets unchanged outputs be reused across restarts.
+    for folder in ["generated_previews", "downloaded_avatar_folders", "downloaded_files"]:
         dir_to_clean = script_dir / folder
         if dir_to_clean.exists():
             print(f"Cleaning up old directory: {dir_to_clean}")
             shutil.rmtree(dir_to_clean)
-    demo.launch(server_name="0.0.0.0", server_port=7864)
+    # Mount the UI on our own FastAPI app so the streamed ZIP route is served next to it.
+    app = FastAPI()
+    app.add_api_route(ZIP_STREAM_ROUTE + "/{batch_id}", stream_zip_download, methods=["GET"])
+    app = gr.mount_gradio_app(app, build_demo(), path="/")
+    uvicorn.run(app, host="0.0.0.0", port=7864)